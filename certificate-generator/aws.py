@@ -29,9 +29,121 @@ if isinstance(PRINT_QUERIES,basestring):
  #General
 REQUESTS_TIMEOUT = int(ENV_TOKENS.get('REQUESTS_TIMEOUT', REQUESTS_TIMEOUT))
 TIME_BETWEEN_XQUEUE_PULLS = int(ENV_TOKENS.get('TIME_BETWEEN_XQUEUE_PULLS',TIME_BETWEEN_XQUEUE_PULLS))
+XQUEUE_POLL_RUN_SECONDS = int(ENV_TOKENS.get('XQUEUE_POLL_RUN_SECONDS', XQUEUE_POLL_RUN_SECONDS))
+XQUEUE_POLL_MIN_INTERVAL = float(ENV_TOKENS.get('XQUEUE_POLL_MIN_INTERVAL', XQUEUE_POLL_MIN_INTERVAL))
+XQUEUE_POLL_MAX_INTERVAL = float(ENV_TOKENS.get('XQUEUE_POLL_MAX_INTERVAL', XQUEUE_POLL_MAX_INTERVAL))
+XQUEUE_PULLERS = int(ENV_TOKENS.get('XQUEUE_PULLERS', XQUEUE_PULLERS))
+XQUEUE_PULLERS_PER_QUEUE = int(ENV_TOKENS.get('XQUEUE_PULLERS_PER_QUEUE', XQUEUE_PULLERS_PER_QUEUE))
+XQUEUE_LEASE_TTL = int(ENV_TOKENS.get('XQUEUE_LEASE_TTL', XQUEUE_LEASE_TTL))
+SUBMISSION_CLAIM_TTL = int(ENV_TOKENS.get('SUBMISSION_CLAIM_TTL', SUBMISSION_CLAIM_TTL))
+CACHES = ENV_TOKENS.get('CACHES', CACHES) #Required: leases and the status view need a cache shared by every node, e.g. memcached.
 S3_BUCKETNAME=ENV_TOKENS.get('S3_BUCKETNAME',"Certificate")
 S3_PATH_PREFIX=ENV_TOKENS.get('S3_PATH_PREFIX',"Certificate")
+S3_HOST = ENV_TOKENS.get('S3_HOST', S3_HOST)
+S3_PORT = ENV_TOKENS.get('S3_PORT', S3_PORT)
+if S3_PORT is not None:
+    S3_PORT = int(S3_PORT)
+S3_IS_SECURE = ENV_TOKENS.get('S3_IS_SECURE', S3_IS_SECURE)
+if isinstance(S3_IS_SECURE,basestring):
+    S3_IS_SECURE= S3_IS_SECURE.lower()=="true"
+S3_SIGNED_URLS = ENV_TOKENS.get('S3_SIGNED_URLS', S3_SIGNED_URLS)
+if isinstance(S3_SIGNED_URLS,basestring):
+    S3_SIGNED_URLS= S3_SIGNED_URLS.lower()=="true"
+S3_URL_EXPIRES_IN = int(ENV_TOKENS.get('S3_URL_EXPIRES_IN', S3_URL_EXPIRES_IN))
+STORAGE_BACKEND = ENV_TOKENS.get('STORAGE_BACKEND', STORAGE_BACKEND)
+STORAGE_LOCAL_DIR = ENV_TOKENS.get('STORAGE_LOCAL_DIR', STORAGE_LOCAL_DIR)
+STORAGE_LOCAL_URL = ENV_TOKENS.get('STORAGE_LOCAL_URL', "file://" + STORAGE_LOCAL_DIR + "/")
+STORAGE_REPLICATION_LOG = ENV_TOKENS.get('STORAGE_REPLICATION_LOG', STORAGE_REPLICATION_LOG)
+STORAGE_REPLICATION_RETRY_DELAY = int(ENV_TOKENS.get('STORAGE_REPLICATION_RETRY_DELAY', STORAGE_REPLICATION_RETRY_DELAY))
+STORAGE_REPLICATION_MAX_RETRY_DELAY = int(ENV_TOKENS.get('STORAGE_REPLICATION_MAX_RETRY_DELAY', STORAGE_REPLICATION_MAX_RETRY_DELAY))
+STORAGE_REPLICATION_MAX_AGE = int(ENV_TOKENS.get('STORAGE_REPLICATION_MAX_AGE', STORAGE_REPLICATION_MAX_AGE))
 CERTIFICATE_QUEUES_TO_PULL_FROM= ENV_TOKENS.get('CERTIFICATE_QUEUES_TO_PULL_FROM', CERTIFICATE_QUEUES_TO_PULL_FROM)
+if isinstance(CERTIFICATE_QUEUES_TO_PULL_FROM,basestring):
+    CERTIFICATE_QUEUES_TO_PULL_FROM= [name.strip() for name in CERTIFICATE_QUEUES_TO_PULL_FROM.split(",") if name.strip()]
+XQUEUE_MAX_ACTIVE_QUEUES = int(ENV_TOKENS.get('XQUEUE_MAX_ACTIVE_QUEUES', XQUEUE_MAX_ACTIVE_QUEUES))
+XQUEUE_MAX_ITEMS_PER_DRAIN = int(ENV_TOKENS.get('XQUEUE_MAX_ITEMS_PER_DRAIN', XQUEUE_MAX_ITEMS_PER_DRAIN))
+CERTIFICATE_TEMPLATE_DIR = ENV_TOKENS.get('CERTIFICATE_TEMPLATE_DIR', CERTIFICATE_TEMPLATE_DIR)
+COMPILED_TEMPLATE_DIR = ENV_TOKENS.get('COMPILED_TEMPLATE_DIR', COMPILED_TEMPLATE_DIR)
+USE_COMPILED_TEMPLATES = ENV_TOKENS.get('USE_COMPILED_TEMPLATES', USE_COMPILED_TEMPLATES)
+if isinstance(USE_COMPILED_TEMPLATES,basestring):
+    USE_COMPILED_TEMPLATES= USE_COMPILED_TEMPLATES.lower()=="true"
+INKSCAPE_PATH = ENV_TOKENS.get('INKSCAPE_PATH', INKSCAPE_PATH)
+INKSCAPE_SHELL_MODE = ENV_TOKENS.get('INKSCAPE_SHELL_MODE', INKSCAPE_SHELL_MODE)
+if isinstance(INKSCAPE_SHELL_MODE,basestring):
+    INKSCAPE_SHELL_MODE= INKSCAPE_SHELL_MODE.lower()=="true"
+FETCH_WORKERS = int(ENV_TOKENS.get('FETCH_WORKERS', FETCH_WORKERS))
+ASSEMBLE_WORKERS = int(ENV_TOKENS.get('ASSEMBLE_WORKERS', ASSEMBLE_WORKERS))
+RENDER_WORKERS = int(ENV_TOKENS.get('RENDER_WORKERS', RENDER_WORKERS))
+UPLOAD_WORKERS = int(ENV_TOKENS.get('UPLOAD_WORKERS', UPLOAD_WORKERS))
+POST_WORKERS = int(ENV_TOKENS.get('POST_WORKERS', POST_WORKERS))
+PIPELINE_QUEUE_SIZE = int(ENV_TOKENS.get('PIPELINE_QUEUE_SIZE', PIPELINE_QUEUE_SIZE))
+XQUEUE_SESSION_POOL_SIZE = int(ENV_TOKENS.get('XQUEUE_SESSION_POOL_SIZE',
+                                              XQUEUE_MAX_ACTIVE_QUEUES * (FETCH_WORKERS + POST_WORKERS) + 1))
+ADAPTIVE_CONCURRENCY_ENABLED = ENV_TOKENS.get('ADAPTIVE_CONCURRENCY_ENABLED', ADAPTIVE_CONCURRENCY_ENABLED)
+if isinstance(ADAPTIVE_CONCURRENCY_ENABLED,basestring):
+    ADAPTIVE_CONCURRENCY_ENABLED= ADAPTIVE_CONCURRENCY_ENABLED.lower()=="true"
+XQUEUE_CONCURRENCY_MIN = int(ENV_TOKENS.get('XQUEUE_CONCURRENCY_MIN', XQUEUE_CONCURRENCY_MIN))
+XQUEUE_CONCURRENCY_MAX = int(ENV_TOKENS.get('XQUEUE_CONCURRENCY_MAX', XQUEUE_SESSION_POOL_SIZE))
+XQUEUE_TARGET_LATENCY = float(ENV_TOKENS.get('XQUEUE_TARGET_LATENCY', XQUEUE_TARGET_LATENCY))
+S3_CONCURRENCY_MIN = int(ENV_TOKENS.get('S3_CONCURRENCY_MIN', S3_CONCURRENCY_MIN))
+S3_CONCURRENCY_MAX = int(ENV_TOKENS.get('S3_CONCURRENCY_MAX', XQUEUE_MAX_ACTIVE_QUEUES * UPLOAD_WORKERS))
+S3_TARGET_LATENCY = float(ENV_TOKENS.get('S3_TARGET_LATENCY', S3_TARGET_LATENCY))
+INKSCAPE_POOL_SIZE = int(ENV_TOKENS.get('INKSCAPE_POOL_SIZE', RENDER_WORKERS))
+INKSCAPE_MAX_JOBS_PER_PROCESS = int(ENV_TOKENS.get('INKSCAPE_MAX_JOBS_PER_PROCESS', INKSCAPE_MAX_JOBS_PER_PROCESS))
+RENDER_BATCH_SIZE = int(ENV_TOKENS.get('RENDER_BATCH_SIZE', RENDER_BATCH_SIZE))
+RENDER_BATCH_WAIT_MS = int(ENV_TOKENS.get('RENDER_BATCH_WAIT_MS', RENDER_BATCH_WAIT_MS))
+RENDER_MODE = ENV_TOKENS.get('RENDER_MODE', RENDER_MODE)
+RENDER_TIMEOUT = float(ENV_TOKENS.get('RENDER_TIMEOUT', RENDER_TIMEOUT))
+RENDER_TEMPLATE_TIMEOUTS = ENV_TOKENS.get('RENDER_TEMPLATE_TIMEOUTS', RENDER_TEMPLATE_TIMEOUTS)
+SCRATCH_DIR = ENV_TOKENS.get('SCRATCH_DIR', SCRATCH_DIR)
+SCRATCH_QUOTA_BYTES = int(ENV_TOKENS.get('SCRATCH_QUOTA_BYTES', SCRATCH_QUOTA_BYTES))
+SCRATCH_WAIT = int(ENV_TOKENS.get('SCRATCH_WAIT', SCRATCH_WAIT))
+SCRATCH_PDF_RESERVE_BYTES = int(ENV_TOKENS.get('SCRATCH_PDF_RESERVE_BYTES', SCRATCH_PDF_RESERVE_BYTES))
+OVERLAY_BACKGROUND_DIR = ENV_TOKENS.get('OVERLAY_BACKGROUND_DIR', OVERLAY_BACKGROUND_DIR)
+OVERLAY_MAX_BACKGROUNDS = int(ENV_TOKENS.get('OVERLAY_MAX_BACKGROUNDS', OVERLAY_MAX_BACKGROUNDS))
+OVERLAY_PER_COURSE_BACKGROUND = ENV_TOKENS.get('OVERLAY_PER_COURSE_BACKGROUND', OVERLAY_PER_COURSE_BACKGROUND)
+if isinstance(OVERLAY_PER_COURSE_BACKGROUND,basestring):
+    OVERLAY_PER_COURSE_BACKGROUND= OVERLAY_PER_COURSE_BACKGROUND.lower()=="true"
+OVERLAY_FONTS = ENV_TOKENS.get('OVERLAY_FONTS', OVERLAY_FONTS)
+OVERLAY_FALLBACK_FONT = ENV_TOKENS.get('OVERLAY_FALLBACK_FONT', OVERLAY_FALLBACK_FONT)
+OUTBOX_ENABLED = ENV_TOKENS.get('OUTBOX_ENABLED', OUTBOX_ENABLED)
+if isinstance(OUTBOX_ENABLED,basestring):
+    OUTBOX_ENABLED= OUTBOX_ENABLED.lower()=="true"
+OUTBOX_PATH = ENV_TOKENS.get('OUTBOX_PATH', OUTBOX_PATH)
+OUTBOX_BATCH_SIZE = int(ENV_TOKENS.get('OUTBOX_BATCH_SIZE', OUTBOX_BATCH_SIZE))
+OUTBOX_LEASE_SECONDS = int(ENV_TOKENS.get('OUTBOX_LEASE_SECONDS', 3*REQUESTS_TIMEOUT))
+OUTBOX_RETRY_DELAY = int(ENV_TOKENS.get('OUTBOX_RETRY_DELAY', OUTBOX_RETRY_DELAY))
+OUTBOX_MAX_RETRY_DELAY = int(ENV_TOKENS.get('OUTBOX_MAX_RETRY_DELAY', OUTBOX_MAX_RETRY_DELAY))
+OUTBOX_MAX_AGE = int(ENV_TOKENS.get('OUTBOX_MAX_AGE', OUTBOX_MAX_AGE))
+JOURNAL_ENABLED = ENV_TOKENS.get('JOURNAL_ENABLED', JOURNAL_ENABLED)
+if isinstance(JOURNAL_ENABLED,basestring):
+    JOURNAL_ENABLED= JOURNAL_ENABLED.lower()=="true"
+JOURNAL_DIR = ENV_TOKENS.get('JOURNAL_DIR', JOURNAL_DIR)
+JOURNAL_FSYNC = ENV_TOKENS.get('JOURNAL_FSYNC', JOURNAL_FSYNC)
+if isinstance(JOURNAL_FSYNC,basestring):
+    JOURNAL_FSYNC= JOURNAL_FSYNC.lower()=="true"
+JOURNAL_COMPACT_LINES = int(ENV_TOKENS.get('JOURNAL_COMPACT_LINES', JOURNAL_COMPACT_LINES))
+QUARANTINE_PATH = ENV_TOKENS.get('QUARANTINE_PATH', QUARANTINE_PATH)
+QUARANTINE_MAX_FAILURES = int(ENV_TOKENS.get('QUARANTINE_MAX_FAILURES', QUARANTINE_MAX_FAILURES))
+QUARANTINE_FAILURE_TTL = int(ENV_TOKENS.get('QUARANTINE_FAILURE_TTL', QUARANTINE_FAILURE_TTL))
+STAGE_METRICS_ENABLED = ENV_TOKENS.get('STAGE_METRICS_ENABLED', STAGE_METRICS_ENABLED)
+if isinstance(STAGE_METRICS_ENABLED,basestring):
+    STAGE_METRICS_ENABLED= STAGE_METRICS_ENABLED.lower()=="true"
+STAGE_METRICS_SAMPLE_RATE = float(ENV_TOKENS.get('STAGE_METRICS_SAMPLE_RATE', STAGE_METRICS_SAMPLE_RATE))
+METRICS_PUBLISH_INTERVAL = int(ENV_TOKENS.get('METRICS_PUBLISH_INTERVAL', METRICS_PUBLISH_INTERVAL))
+PROFILE_DIR = ENV_TOKENS.get('PROFILE_DIR', PROFILE_DIR)
+PROFILE_ITEMS = int(ENV_TOKENS.get('PROFILE_ITEMS', PROFILE_ITEMS))
+PROFILE_SIGNAL_ITEMS = int(ENV_TOKENS.get('PROFILE_SIGNAL_ITEMS', PROFILE_SIGNAL_ITEMS))
+PROFILE_TOP = int(ENV_TOKENS.get('PROFILE_TOP', PROFILE_TOP))
+RENDER_CACHE_ENABLED = ENV_TOKENS.get('RENDER_CACHE_ENABLED', RENDER_CACHE_ENABLED)
+if isinstance(RENDER_CACHE_ENABLED,basestring):
+    RENDER_CACHE_ENABLED= RENDER_CACHE_ENABLED.lower()=="true"
+RENDER_CACHE_DIR = ENV_TOKENS.get('RENDER_CACHE_DIR', RENDER_CACHE_DIR)
+RENDER_CACHE_MAX_BYTES = int(ENV_TOKENS.get('RENDER_CACHE_MAX_BYTES', RENDER_CACHE_MAX_BYTES))
+RENDER_CACHE_URL_MAX_AGE = int(ENV_TOKENS.get('RENDER_CACHE_URL_MAX_AGE', RENDER_CACHE_URL_MAX_AGE))
+RENDER_CACHE_CHECK_S3 = ENV_TOKENS.get('RENDER_CACHE_CHECK_S3', RENDER_CACHE_CHECK_S3)
+if isinstance(RENDER_CACHE_CHECK_S3,basestring):
+    RENDER_CACHE_CHECK_S3= RENDER_CACHE_CHECK_S3.lower()=="true"
 #Time zone (shows up in logs)
 TIME_ZONE = ENV_TOKENS.get('TIME_ZONE', TIME_ZONE)
 
@@ -53,3 +165,12 @@ BROKER_URL= AUTH_TOKENS.get('BROKER_URL',BROKER_URL)
 CELERY_RESULT_BACKEND=AUTH_TOKENS.get('CELERY_RESULT_BACKEND',CELERY_RESULT_BACKEND)
 CELERY_DEFAULT_QUEUE=ENV_TOKENS.get('CELERY_DEFAULT_QUEUE',CELERY_DEFAULT_QUEUE)
 CELERY_DEFAULT_EXCHANGE=ENV_TOKENS.get('CELERY_DEFAULT_EXCHANGE',CELERY_DEFAULT_EXCHANGE)
+CELERYD_PREFETCH_MULTIPLIER = int(ENV_TOKENS.get('CELERYD_PREFETCH_MULTIPLIER', CELERYD_PREFETCH_MULTIPLIER))
+CERTIFICATE_DISPATCH_MODE = ENV_TOKENS.get('CERTIFICATE_DISPATCH_MODE', CERTIFICATE_DISPATCH_MODE)
+CERTIFICATE_RENDER_QUEUE = ENV_TOKENS.get('CERTIFICATE_RENDER_QUEUE', CERTIFICATE_RENDER_QUEUE)
+CERTIFICATE_RENDER_ROUTING_KEY = ENV_TOKENS.get('CERTIFICATE_RENDER_ROUTING_KEY', CERTIFICATE_RENDER_QUEUE)
+CERTIFICATE_RENDER_RATE_LIMIT = ENV_TOKENS.get('CERTIFICATE_RENDER_RATE_LIMIT', CERTIFICATE_RENDER_RATE_LIMIT)
+CERTIFICATE_RENDER_MAX_RETRIES = int(ENV_TOKENS.get('CERTIFICATE_RENDER_MAX_RETRIES', CERTIFICATE_RENDER_MAX_RETRIES))
+CERTIFICATE_RENDER_RETRY_DELAY = int(ENV_TOKENS.get('CERTIFICATE_RENDER_RETRY_DELAY', CERTIFICATE_RENDER_RETRY_DELAY))
+CELERY_ROUTES = {'controller.tasks.render_and_deliver': {'queue': CERTIFICATE_RENDER_QUEUE,
+                                                         'routing_key': CERTIFICATE_RENDER_ROUTING_KEY}}
@@ -1,6 +1,8 @@
 from logsettings import get_logger_config
 from path import path
+import multiprocessing
 import os
+import sys
 
 # Django settings for grading_controller project.
 ROOT_PATH = path(__file__).dirname()
@@ -9,6 +11,7 @@ ENV_ROOT = REPO_PATH.dirname()
 
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
+TESTING = sys.argv[1:2] == ["test"] #Running manage.py test, which turns DEBUG off.
 PRINT_QUERIES = False
 
 ADMINS = (
@@ -18,11 +21,120 @@ ADMINS = (
 MANAGERS = ADMINS
 
 #General
-CERTIFICATE_QUEUES_TO_PULL_FROM= "Certificate"
+CERTIFICATE_QUEUES_TO_PULL_FROM= ["Certificate"] #List of queue names, or a comma separated string in env.json.
+XQUEUE_MAX_ACTIVE_QUEUES = 4 #Queues drained at the same time by one pull_from_xqueue run.  Each queue has its own loop.
+XQUEUE_MAX_ITEMS_PER_DRAIN = 500 #A queue gives up its slot after this many submissions so the other queues get a turn.
 REQUESTS_TIMEOUT = 60    # seconds
-TIME_BETWEEN_XQUEUE_PULLS = 50 #seconds.  Time between pull_from_xqueue checking to see if new submissions are on queue.
+TIME_BETWEEN_XQUEUE_PULLS = 10 #seconds.  Time between pull_from_xqueue runs.  A run keeps polling for XQUEUE_POLL_RUN_SECONDS.
+XQUEUE_POLL_RUN_SECONDS = 5*60
+XQUEUE_POLL_MIN_INTERVAL = 0.5 #seconds.  Wait after the first poll that finds a queue empty, doubled on each further empty poll...
+XQUEUE_POLL_MAX_INTERVAL = 30 #...up to this ceiling.  A queue that had work is polled again right away.
+
+#Coordination between workers, through leases in the django cache.  Use a cache shared by all nodes.
+XQUEUE_PULLERS = 4 #pull_from_xqueue runs allowed at the same time across the cluster.
+XQUEUE_PULLERS_PER_QUEUE = XQUEUE_PULLERS #Of those, how many may drain the same queue at once.
+XQUEUE_LEASE_TTL = 2*60 #seconds.  Leases are renewed while held; a dead worker's leases expire after this.
+SUBMISSION_CLAIM_TTL = 15*60 #seconds.  How long a submission stays claimed by the worker that fetched it.
 S3_BUCKETNAME="Certificate"
 S3_PATH_PREFIX="certificate"
+S3_HOST = None #Set to use an S3 compatible endpoint, e.g. a local stand-in for tests.
+S3_PORT = None
+S3_IS_SECURE = True
+S3_SIGNED_URLS = True #Post back signed urls valid for S3_URL_EXPIRES_IN.  Unsigned ones never expire, the certificates are public-read.
+S3_URL_EXPIRES_IN = 60*60*24*365 #seconds.
+#Where certificates are stored: "s3"; "local", files in STORAGE_LOCAL_DIR; or "write_behind", written to STORAGE_LOCAL_DIR,
+#posted back with their S3 url right away and replicated to S3 in the background.
+STORAGE_BACKEND = "s3"
+STORAGE_LOCAL_DIR = os.path.join(REPO_PATH, "certificates")
+STORAGE_LOCAL_URL = "file://" + STORAGE_LOCAL_DIR + "/" #Base url of the files in STORAGE_LOCAL_DIR, e.g. where a web server serves them.
+STORAGE_REPLICATION_LOG = os.path.join(REPO_PATH, "replication", "replication.sqlite3") #Durable list of the write_behind files not yet on S3.
+STORAGE_REPLICATION_RETRY_DELAY = 5 #seconds.  Doubled after each failed upload...
+STORAGE_REPLICATION_MAX_RETRY_DELAY = 10*60 #...up to this.
+STORAGE_REPLICATION_MAX_AGE = 7*24*60*60 #seconds.  Certificates still not on S3 after this are given up on, their local copy is kept.
+CERTIFICATE_TEMPLATE_DIR = os.path.join(REPO_PATH, "templates") #Directory holding the svg certificate templates.
+COMPILED_TEMPLATE_DIR = os.path.join(REPO_PATH, "compiled_templates") #Output of manage.py compile_templates.
+USE_COMPILED_TEMPLATES = True #Render from compiled templates when they are up to date with their source.
+
+#Worker pipeline: threads per stage, and size of the bounded queue in front of each stage.
+FETCH_WORKERS = 1
+ASSEMBLE_WORKERS = 1
+RENDER_WORKERS = multiprocessing.cpu_count()
+UPLOAD_WORKERS = 4
+POST_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 50
+#Keep-alive connections to xqueue per worker process: the fetch and post threads of every active queue, plus the outbox sender.
+XQUEUE_SESSION_POOL_SIZE = XQUEUE_MAX_ACTIVE_QUEUES * (FETCH_WORKERS + POST_WORKERS) + 1
+#Adaptive concurrency: calls in flight to xqueue and S3 per worker process, halved when a call fails or takes
+#longer than the target latency and raised back by one per limit fast calls, between the min and max.
+ADAPTIVE_CONCURRENCY_ENABLED = True
+XQUEUE_CONCURRENCY_MIN = 1
+XQUEUE_CONCURRENCY_MAX = XQUEUE_SESSION_POOL_SIZE
+XQUEUE_TARGET_LATENCY = 2.0 #seconds.
+S3_CONCURRENCY_MIN = 1
+S3_CONCURRENCY_MAX = XQUEUE_MAX_ACTIVE_QUEUES * UPLOAD_WORKERS
+S3_TARGET_LATENCY = 5.0 #seconds.
+
+#Rendering
+INKSCAPE_PATH = "/usr/bin/inkscape"
+INKSCAPE_SHELL_MODE = True #Keep inkscape processes running in --shell mode instead of starting one per certificate.
+INKSCAPE_POOL_SIZE = RENDER_WORKERS #Number of warm inkscape processes per worker process.
+INKSCAPE_MAX_JOBS_PER_PROCESS = 200 #Restart an inkscape process after this many renders.
+RENDER_BATCH_SIZE = 20 #Maximum number of submissions converted in a single renderer invocation.
+RENDER_BATCH_WAIT_MS = 500 #Maximum time spent collecting submissions for one batch.
+RENDER_MODE = "full" #"full" renders every certificate with inkscape, "overlay" stamps the names onto a pre-rendered template background.
+RENDER_TIMEOUT = 60 #seconds.  Inkscape is killed, with its children, when a render takes longer; the render is retried once on a fresh process.
+RENDER_TEMPLATE_TIMEOUTS = {} #Per template deadlines overriding RENDER_TIMEOUT, e.g. {"complex-certificate.svg": 120}.
+#Scratch space for the svg and pdf files inkscape reads and writes.  On tmpfs they never reach the disk.
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else "/tmp"
+SCRATCH_QUOTA_BYTES = 256*1024*1024 #Per worker process.  Assembly waits for room once it is used up...
+SCRATCH_WAIT = 60 #...for at most this many seconds.
+SCRATCH_PDF_RESERVE_BYTES = 2*1024*1024 #Room reserved for each pdf inkscape exports.
+OVERLAY_BACKGROUND_DIR = os.path.join(REPO_PATH, "overlay_backgrounds")
+OVERLAY_MAX_BACKGROUNDS = 64 #Backgrounds kept in memory per worker process.
+OVERLAY_PER_COURSE_BACKGROUND = False #Also bake the course name into the background, one background per template and course.
+OVERLAY_FONTS = {
+    #svg font-family (followed by " Bold", " Italic" or " Bold Italic") : path to its ttf file
+    "Philosopher": "/usr/share/fonts/truetype/philosopher/Philosopher-Regular.ttf",
+}
+OVERLAY_FALLBACK_FONT = None #reportlab font, e.g. "Helvetica", stamped for fonts missing from OVERLAY_FONTS.  By default their templates keep full renders.
+
+#Post back outbox: results are stored in a local SQLite database and posted back by a background sender.
+OUTBOX_ENABLED = True
+OUTBOX_PATH = os.path.join(REPO_PATH, "outbox", "outbox.sqlite3")
+OUTBOX_BATCH_SIZE = 50 #Results posted per sender pass.
+OUTBOX_LEASE_SECONDS = 3*REQUESTS_TIMEOUT #A result is leased to one sender while it is posted, it must outlast the post.
+OUTBOX_RETRY_DELAY = 5 #seconds.  Doubled after each failed post back...
+OUTBOX_MAX_RETRY_DELAY = 10*60 #...up to this.
+OUTBOX_MAX_AGE = 7*24*60*60 #seconds.  Results still not posted back after this are dropped.
+
+#In-flight journal: stages each submission completed, so a restarted worker resumes instead of rendering again.
+JOURNAL_ENABLED = True
+JOURNAL_DIR = os.path.join(REPO_PATH, "journal")
+JOURNAL_FSYNC = False #fsync every line.  Only needed to survive machine crashes, process crashes are covered without it.
+JOURNAL_COMPACT_LINES = 1000 #Rewrite the journal with only unfinished submissions past this many lines.
+
+#Quarantine of submissions that cannot be rendered
+QUARANTINE_PATH = os.path.join(REPO_PATH, "quarantine", "dead_letters.sqlite3") #Dead-letter store, inspect it with manage.py dead_letters.
+QUARANTINE_MAX_FAILURES = 3 #Assembly or render failures after which a valid submission is quarantined.
+QUARANTINE_FAILURE_TTL = 24*60*60 #seconds.  Failures older than this are forgotten.
+
+#Latency and size histograms of every stage, xqueue and S3 call.  Lower the sample rate on very busy workers.
+STAGE_METRICS_ENABLED = True
+STAGE_METRICS_SAMPLE_RATE = 1.0
+METRICS_PUBLISH_INTERVAL = 5 #seconds.  Workers publish their in memory counters to the cache for the status view this often.
+
+#Profiling: cProfile dumps and a hotspot summary of the next submissions a worker processes.
+PROFILE_DIR = os.path.join(REPO_PATH, "profiles")
+PROFILE_ITEMS = 0 #Profile this many submissions once a worker process starts.  0 profiles nothing until...
+PROFILE_SIGNAL_ITEMS = 100 #...the worker process receives SIGUSR2, which profiles this many.
+PROFILE_TOP = 30 #Hotspots listed in the summary.
+
+#Render cache
+RENDER_CACHE_ENABLED = True
+RENDER_CACHE_DIR = os.path.join(REPO_PATH, "render_cache")
+RENDER_CACHE_MAX_BYTES = 512 * 1024 * 1024
+RENDER_CACHE_URL_MAX_AGE = 60*60*24*30 #seconds.  Reuse the url of a cached render while it is younger than this.
+RENDER_CACHE_CHECK_S3 = False #Look for an already uploaded pdf for the same submission before rendering, costs a HEAD request per item.
 
 DATABASES = {
     'default': {
@@ -52,10 +164,12 @@ GRADING_CONTROLLER_INTERFACE = {
     }
 }
 
+#Leases, submission claims, quarantine counters and the status view need a cache with an atomic add shared by every
+#worker and the web process: memcached in production.  The in-memory default only coordinates the threads of one
+#process, it is refused outside of DEBUG and the test runner, as is a file based cache.
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
-        'LOCATION': os.path.join(REPO_PATH, "django_cache"),
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
         }
 }
 
@@ -186,4 +300,19 @@ BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 3600}
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/6'
 CELERY_DEFAULT_QUEUE = 'certificates-celery'
 CELERY_DEFAULT_EXCHANGE = 'certificates-celery-exchange'
+#render_and_deliver is acked late: a worker should hold one unacked task at a time, not several behind a long render
+#that a crash would all redeliver.
+CELERYD_PREFETCH_MULTIPLIER = 1
+
+#Dispatch: "pipeline" renders in the pull_from_xqueue worker.  "celery" makes pull_from_xqueue only fetch, each
+#submission becoming a render_and_deliver task on CERTIFICATE_RENDER_QUEUE; start workers consuming that queue
+#(celery worker -Q certificates-render) to scale rendering.
+CERTIFICATE_DISPATCH_MODE = "pipeline"
+CERTIFICATE_RENDER_QUEUE = 'certificates-render'
+CERTIFICATE_RENDER_ROUTING_KEY = CERTIFICATE_RENDER_QUEUE
+CERTIFICATE_RENDER_RATE_LIMIT = None #Per worker, e.g. "10/s".
+CERTIFICATE_RENDER_MAX_RETRIES = 5
+CERTIFICATE_RENDER_RETRY_DELAY = 10 #seconds.  Doubled on each retry.
+CELERY_ROUTES = {'controller.tasks.render_and_deliver': {'queue': CERTIFICATE_RENDER_QUEUE,
+                                                         'routing_key': CERTIFICATE_RENDER_ROUTING_KEY}}
 
@@ -0,0 +1,226 @@
+"""
+Local stand-ins for xqueue and S3, and the end-to-end throughput benchmark
+built on them (see the benchmark_pipeline management command).
+
+FakeXqueue serves the project_urls.XqueueURLs endpoints from a list of seeded
+submissions and records when each result is put back.  FakeS3 accepts the
+bucket creation, key PUT and HEAD requests the storage client makes, over
+plain http with path style addressing.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+import cgi
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+import urlparse
+
+import project_urls
+from .metrics import summarize
+
+log = logging.getLogger(__name__)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    #Keep-alive, like the real services
+    protocol_version = "HTTP/1.1"
+    #Headers and body go out in separate writes, don't let Nagle delay them
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body="", headers=None):
+        self.send_response(status)
+        headers = dict(headers or {})
+        headers.setdefault("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.getheader("Content-Length") or 0))
+
+
+class _FakeService(object):
+    handler = None
+
+    def start(self):
+        self.server = _ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        self.server.service = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name=type(self).__name__)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.port)
+
+
+def _xreply(return_code, content):
+    return json.dumps({'return_code': return_code, 'content': content})
+
+
+class _XqueueHandler(_QuietHandler):
+    def do_GET(self):
+        parsed = urlparse.urlparse(self.path)
+        queue_name = urlparse.parse_qs(parsed.query).get('queue_name', [""])[0]
+        if parsed.path.rstrip("/") == project_urls.XqueueURLs.get_queuelen.rstrip("/"):
+            self._send(200, _xreply(0, self.service.queue_length(queue_name)))
+        elif parsed.path.rstrip("/") == project_urls.XqueueURLs.get_submission.rstrip("/"):
+            submission = self.service.pop(queue_name)
+            if submission is None:
+                self._send(200, _xreply(1, "Queue '{0}' is empty".format(queue_name)))
+            else:
+                self._send(200, _xreply(0, json.dumps(submission)))
+        else:
+            self._send(404)
+
+    def do_POST(self):
+        path = urlparse.urlparse(self.path).path.rstrip("/")
+        form = cgi.parse_qs(self._read_body())
+        if path == project_urls.XqueueURLs.log_in.rstrip("/"):
+            self.service.logins += 1
+            self._send(200, _xreply(0, "Logged in"))
+        elif path == project_urls.XqueueURLs.put_result.rstrip("/"):
+            header = json.loads(form['xqueue_header'][0])
+            body = json.loads(form['xqueue_body'][0])
+            self.service.put_result(header, body)
+            self._send(200, _xreply(0, ""))
+        else:
+            self._send(404)
+
+
+class FakeXqueue(_FakeService):
+    """
+    In memory xqueue.  seed() adds submissions, results maps each submission
+    key to (time seeded, time its result was put back, result body).
+    """
+    handler = _XqueueHandler
+
+    def __init__(self):
+        self.queues = collections.defaultdict(collections.deque)
+        self.seeded = {}
+        self.fetched = {}
+        self.results = {}
+        self.logins = 0
+        self.lock = threading.Lock()
+
+    def seed(self, queue_name, header, body):
+        with self.lock:
+            self.seeded[header['submission_key']] = time.time()
+            self.queues[queue_name].append({'xqueue_header': json.dumps(header),
+                                            'xqueue_body': json.dumps(body)})
+
+    def queue_length(self, queue_name):
+        with self.lock:
+            return len(self.queues[queue_name])
+
+    def pop(self, queue_name):
+        with self.lock:
+            if not self.queues[queue_name]:
+                return None
+            submission = self.queues[queue_name].popleft()
+            self.fetched[json.loads(submission['xqueue_header'])['submission_key']] = time.time()
+            return submission
+
+    def put_result(self, header, body):
+        with self.lock:
+            key = header['submission_key']
+            self.results[key] = (self.seeded.get(key), time.time(), body)
+
+
+class _S3Handler(_QuietHandler):
+    def do_PUT(self):
+        data = self._read_body()
+        parts = urlparse.urlparse(self.path).path.strip("/").split("/", 1)
+        if len(parts) == 1:
+            self.service.buckets.add(parts[0])
+            self._send(200)
+            return
+        self.service.put(parts[0], parts[1], data)
+        #boto checks the etag against the md5 of what it sent
+        self._send(200, headers={'ETag': '"{0}"'.format(hashlib.md5(data).hexdigest())})
+
+    def do_HEAD(self):
+        parts = urlparse.urlparse(self.path).path.strip("/").split("/", 1)
+        data = self.service.objects.get(tuple(parts)) if len(parts) == 2 else None
+        if data is None:
+            self._send(404)
+        else:
+            self._send(200, headers={'ETag': '"{0}"'.format(hashlib.md5(data).hexdigest()),
+                                     'Content-Length': str(len(data))})
+
+    def do_GET(self):
+        parts = urlparse.urlparse(self.path).path.strip("/").split("/", 1)
+        data = self.service.objects.get(tuple(parts)) if len(parts) == 2 else None
+        if data is None:
+            self._send(404)
+        else:
+            self._send(200, data, headers={'Content-Type': "application/pdf"})
+
+
+class FakeS3(_FakeService):
+    """
+    In memory S3 bucket store
+    """
+    handler = _S3Handler
+
+    def __init__(self):
+        self.buckets = set()
+        self.objects = {}
+        self.puts = 0
+        self.lock = threading.Lock()
+
+    def put(self, bucket, key, data):
+        with self.lock:
+            self.objects[(bucket, key)] = data
+            self.puts += 1
+
+    @property
+    def bytes_stored(self):
+        with self.lock:
+            return sum(len(data) for data in self.objects.values())
+
+
+class StageTimer(object):
+    """
+    Pipeline observer collecting per item stage latencies
+    """
+    def __init__(self):
+        self.samples = collections.defaultdict(list)
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def __call__(self, pipeline_name, stage_name, seconds, count):
+        with self.lock:
+            self.calls[stage_name] += 1
+            self.samples[stage_name].extend([seconds / count] * count)
+
+    def report(self):
+        with self.lock:
+            report = {}
+            for stage_name, samples in self.samples.items():
+                report[stage_name] = summarize(samples)
+                report[stage_name]['calls'] = self.calls[stage_name]
+            return report
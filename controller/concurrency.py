@@ -0,0 +1,189 @@
+"""
+Adaptive concurrency limits for the worker's downstream services.
+
+Each downstream, xqueue and S3, has a limiter capping the calls in flight
+from this process.  The limit moves by AIMD, like a TCP congestion window: a
+call that succeeds within the downstream's target latency, while the limit is
+in use, raises it by 1/limit, so by about one per limit calls; a failure or a
+slow call halves it.  Calls that started before a decrease do not decrease it
+again, so one slow spell costs a single halving.  A slowing S3 or xqueue thus
+gets fewer concurrent calls until it recovers, and a healthy one gets up to
+the configured maximum.
+
+The limits are gauged in statsd and included in the worker snapshots the
+status view serves.
+"""
+from django.conf import settings
+import functools
+import logging
+import threading
+import time
+
+from statsd import statsd
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+
+class AIMDLimiter(object):
+    def __init__(self, name, initial, minimum, maximum, target_latency, decrease=0.5):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.target_latency = target_latency
+        self.decrease = decrease
+        self.in_flight = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a free slot.  Returns the call's start time, for release.
+        """
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            return time.time()
+
+    def release(self, start, success):
+        latency = time.time() - start
+        with self._cond:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            old = int(self.limit)
+            if not success or latency > self.target_latency:
+                if start >= self._last_decrease:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = time.time()
+                    statsd.increment("open_ended_assessment.grading_controller.concurrency.decrease",
+                                     tags=["downstream:{0}".format(self.name), "success:{0}".format(success)])
+            elif saturated:
+                #Only grow a limit that is actually holding calls back
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+            changed = int(self.limit) != old
+            limit = int(self.limit)
+        if changed:
+            log.info("{0} concurrency limit now {1}".format(self.name, limit))
+            statsd.gauge("open_ended_assessment.grading_controller.concurrency.limit", limit,
+                         tags=["downstream:{0}".format(self.name)])
+
+    def cancel(self):
+        """
+        Give back a slot that was acquired but not used for a call
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def state(self):
+        with self._cond:
+            return {'limit': int(self.limit), 'in_flight': self.in_flight, 'max': self.maximum}
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name):
+    """
+    Return the limiter of downstream name, configured by the
+    <NAME>_CONCURRENCY_MIN, <NAME>_CONCURRENCY_MAX and <NAME>_TARGET_LATENCY
+    settings.  It starts at the maximum, the concurrency the worker threads
+    would have without it.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            prefix = name.upper()
+            maximum = getattr(settings, prefix + "_CONCURRENCY_MAX")
+            limiter = _limiters[name] = AIMDLimiter(name, maximum, getattr(settings, prefix + "_CONCURRENCY_MIN"),
+                                                    maximum, getattr(settings, prefix + "_TARGET_LATENCY"))
+        return limiter
+
+
+_reserved = threading.local()
+
+
+def _reservations():
+    if not hasattr(_reserved, "slots"):
+        _reserved.slots = {}
+    return _reserved.slots
+
+
+class Reservation(object):
+    """
+    Context manager waiting for a slot of downstream name up front, for the
+    next limited call of this thread to use.  Work leased for that call, like
+    an outbox result, is then only taken once the call can start, rather than
+    its lease running out while the call waits for a slot.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.limiter = None
+        self.start = None
+        self.success = False
+
+    def __enter__(self):
+        if settings.ADAPTIVE_CONCURRENCY_ENABLED:
+            self.limiter = get_limiter(self.name)
+            self.limiter.acquire()
+            _reservations()[self.name] = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.limiter is None:
+            return
+        _reservations().pop(self.name, None)
+        if self.start is None:
+            self.limiter.cancel()
+        else:
+            self.limiter.release(self.start, self.success)
+
+
+def limited(name, healthy=None):
+    """
+    Decorator running a function that returns (success, msg) within the
+    concurrency limit of downstream name.  healthy(result) tells whether the
+    downstream handled the call well, success by default.  A call that raises
+    counts as a failure.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not settings.ADAPTIVE_CONCURRENCY_ENABLED:
+                return func(*args, **kwargs)
+            reservation = _reservations().pop(name, None)
+            if reservation is not None:
+                #Runs in the reserved slot, released when the reservation ends
+                reservation.start = time.time()
+                result = func(*args, **kwargs)
+                reservation.success = healthy(result) if healthy is not None else result[0]
+                return result
+            limiter = get_limiter(name)
+            start = limiter.acquire()
+            success = False
+            try:
+                result = func(*args, **kwargs)
+                success = healthy(result) if healthy is not None else result[0]
+                return result
+            finally:
+                limiter.release(start, success)
+        return wrapper
+    return decorator
+
+
+def limits():
+    """
+    Limit and calls in flight per downstream, for the worker snapshots
+    """
+    with _limiters_lock:
+        limiters = _limiters.values()
+    if not limiters:
+        return None
+    return dict((limiter.name, limiter.state()) for limiter in limiters)
+
+metrics.add_source("concurrency", limits)
@@ -0,0 +1,229 @@
+"""
+Write-ahead journal of in-flight submissions.
+
+Each worker process appends one json line per stage a submission completes
+(fetched, rendered, uploaded, posted) to its own journal file, keyed by the
+xqueue submission key.  After a crash, the next process on the node adopts
+the dead process' journal: its unfinished submissions are processed again
+from the last completed stage, so an uploaded certificate is only posted
+back and a rendered one only uploaded, and the temp files they left behind
+are reused or removed.  The file is rewritten with only the unfinished
+submissions once finished ones dominate it.
+"""
+from django.conf import settings
+import errno
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from statsd import statsd
+
+log = logging.getLogger(__name__)
+
+STAGES = ("fetched", "rendered", "uploaded", "posted")
+#A submission is done once it reaches one of these
+FINAL_STAGES = ("posted", "abandoned")
+
+_HOST = socket.gethostname()
+
+
+def _journal_name(pid):
+    return "journal-{0}-{1}.log".format(_HOST, pid)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def read_entries(path):
+    """
+    Replay a journal file.  Returns {key: state} of its unfinished
+    submissions, state being the merged data of every line for the key.
+    A torn last line from a crash is ignored.
+    """
+    entries = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            key = record.pop('key')
+            if record['stage'] in FINAL_STAGES:
+                entries.pop(key, None)
+            else:
+                entries.setdefault(key, {}).update(record)
+    return entries
+
+
+class Journal(object):
+    def __init__(self, path, fsync=False, compact_lines=1000):
+        self.path = path
+        self.fsync = fsync
+        self.compact_lines = compact_lines
+        self._lock = threading.Lock()
+        self._entries = read_entries(path) if os.path.exists(path) else {}
+        self._lines = len(self._entries)
+        self._file = None
+        self._rewrite()
+
+    def _write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._lines += 1
+
+    def record(self, key, stage, **data):
+        """
+        Record that submission key completed stage, with the data needed to
+        resume from it
+        """
+        data['stage'] = stage
+        data['time'] = time.time()
+        with self._lock:
+            if stage in FINAL_STAGES:
+                if self._entries.pop(key, None) is None:
+                    return
+            else:
+                self._entries.setdefault(key, {}).update(data)
+            record = dict(data, key=key)
+            self._write(record)
+            if self._lines > max(self.compact_lines, 4 * len(self._entries)):
+                self._rewrite()
+
+    def entries(self):
+        with self._lock:
+            return dict((key, dict(state)) for key, state in self._entries.items())
+
+    def get(self, key):
+        with self._lock:
+            state = self._entries.get(key)
+            return dict(state) if state is not None else None
+
+    def adopt(self, entries):
+        """
+        Take over the unfinished submissions of another journal
+        """
+        with self._lock:
+            for key, state in entries.items():
+                self._entries[key] = dict(state)
+                self._write(dict(state, key=key))
+
+    def _rewrite(self):
+        """
+        Compact the journal down to one line per unfinished submission
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            for key, state in self._entries.items():
+                f.write(json.dumps(dict(state, key=key)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'a')
+        self._lines = len(self._entries)
+        statsd.gauge("open_ended_assessment.grading_controller.journal.in_flight", len(self._entries))
+
+
+def adopt_orphans(journal, directory):
+    """
+    Move the unfinished submissions of journals left by dead processes on this
+    host into journal.  Returns their {key: state}.
+    """
+    recovered = {}
+    prefix = "journal-{0}-".format(_HOST)
+    for name in os.listdir(directory):
+        if not name.startswith(prefix) or not name.endswith(".log"):
+            continue
+        try:
+            pid = int(name[len(prefix):-len(".log")])
+        except ValueError:
+            continue
+        if pid == os.getpid() or _pid_alive(pid):
+            continue
+        path = os.path.join(directory, name)
+        claimed = "{0}.adopted-{1}".format(path, os.getpid())
+        try:
+            #Only one process wins the rename
+            os.rename(path, claimed)
+        except OSError:
+            continue
+        entries = read_entries(claimed)
+        journal.adopt(entries)
+        os.remove(claimed)
+        if entries:
+            log.warning("Recovered {0} in-flight submissions from {1}".format(len(entries), name))
+            statsd.increment("open_ended_assessment.grading_controller.journal.recovered", len(entries))
+        recovered.update(entries)
+    return recovered
+
+
+def referenced_paths(directory):
+    """
+    Scratch files the unfinished submissions of every journal of this host,
+    adopted or not yet, point to
+    """
+    paths = set()
+    if not os.path.isdir(directory):
+        return paths
+    prefix = "journal-{0}-".format(_HOST)
+    for name in os.listdir(directory):
+        if not name.startswith(prefix):
+            continue
+        try:
+            entries = read_entries(os.path.join(directory, name))
+        except EnvironmentError:
+            #Adopted or compacted in the meantime
+            continue
+        for state in entries.values():
+            for field in ("svg_path", "pdf_path"):
+                if state.get(field):
+                    paths.add(os.path.normpath(state[field]))
+    return paths
+
+
+_journal = None
+_journal_pid = None
+_recovered = {}
+_journal_lock = threading.Lock()
+
+
+def get_journal():
+    """
+    Return this process' journal, adopting the journals of dead processes
+    the first time
+    """
+    global _journal, _journal_pid, _recovered
+    with _journal_lock:
+        if _journal is None or _journal_pid != os.getpid():
+            if not os.path.isdir(settings.JOURNAL_DIR):
+                os.makedirs(settings.JOURNAL_DIR)
+            _journal = Journal(os.path.join(settings.JOURNAL_DIR, _journal_name(os.getpid())),
+                               fsync=settings.JOURNAL_FSYNC, compact_lines=settings.JOURNAL_COMPACT_LINES)
+            _journal_pid = os.getpid()
+            #Left by an earlier process with the same pid, or by dead ones
+            _recovered = _journal.entries()
+            _recovered.update(adopt_orphans(_journal, settings.JOURNAL_DIR))
+        return _journal
+
+
+def take_recovered(queue_name):
+    """
+    Return, once, the [(key, state)] of recovered submissions from queue_name
+    """
+    get_journal()
+    with _journal_lock:
+        taken = [(key, state) for key, state in _recovered.items() if state.get('queue_name') == queue_name]
+        for key, state in taken:
+            del _recovered[key]
+    return taken
@@ -0,0 +1,252 @@
+"""
+Cache based leases for coordinating workers across nodes.
+
+A lease is a cache key holding its owner's token, taken with an atomic
+cache.add and expiring after its ttl unless renewed.  A holder that dies stops
+renewing, so whatever it held is picked up by another worker once the ttl
+runs out.  A Heartbeat renews leases from a background thread while long
+work runs under them.
+
+Leases are used for the pull_from_xqueue instances, per-queue puller slots
+and per-submission claims.  Claims are renewed by a KeepAlive thread of the
+process for as long as they are held, however long the work takes.
+
+cache.add must be atomic across every worker sharing the leases, which
+memcached's is and the file based cache's is not, and the cache must be shared
+by every worker process, which the in-memory cache is not: workers refuse to
+start with the file based or dummy cache, and with the in-memory cache outside
+of DEBUG and the test runner.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+import errno
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from statsd import statsd
+
+log = logging.getLogger(__name__)
+
+_HOST = socket.gethostname()
+
+#Cache backends whose add is not atomic across processes, or that are private to one process
+UNSAFE_BACKENDS = ("FileBasedCache", "DummyCache", "LocMemCache")
+
+#Good enough for a single process development server or test run
+LOCAL_BACKENDS = ("LocMemCache",)
+
+
+def check_cache(client=None):
+    """
+    Refuse a cache client, the default cache by default, that cannot hold
+    leases or worker metrics for every worker
+    """
+    if client is None:
+        client = cache
+    backend = client.__class__.__name__
+    if backend in LOCAL_BACKENDS and (settings.DEBUG or settings.TESTING):
+        return
+    if backend in UNSAFE_BACKENDS:
+        raise ImproperlyConfigured("Leases and worker metrics need a cache with an atomic add shared by every "
+                                   "worker, e.g. memcached, not {0}".format(backend))
+
+check_cache()
+
+
+class Lease(object):
+    def __init__(self, key, ttl):
+        self.key = key
+        self.ttl = ttl
+        self.token = "{0}:{1}:{2}".format(_HOST, os.getpid(), uuid.uuid4().hex)
+        self.held = False
+        #A renewal racing a release must not bring the lease back
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        self.held = cache.add(self.key, self.token, self.ttl)
+        return self.held
+
+    def renew(self):
+        """
+        Extend the lease by its ttl.  Returns False, and stops holding it, if it
+        expired and was taken by another worker in the meantime.
+        """
+        with self._lock:
+            if not self.held:
+                return False
+            if cache.get(self.key) != self.token:
+                log.warning("Lost lease {0}".format(self.key))
+                statsd.increment("open_ended_assessment.grading_controller.lease.lost")
+                self.held = False
+                return False
+            cache.set(self.key, self.token, self.ttl)
+            return True
+
+    def release(self):
+        with self._lock:
+            if self.held and cache.get(self.key) == self.token:
+                cache.delete(self.key)
+            self.held = False
+
+
+def acquire_slot(name, slots, ttl):
+    """
+    Take any free one of slots leases on name.  Returns the Lease, or None if
+    all are held.
+    """
+    keys = [name] if slots == 1 else ["{0}-{1}".format(name, i) for i in xrange(slots)]
+    for key in keys:
+        lease = Lease(key, ttl)
+        if lease.acquire():
+            return lease
+    return None
+
+
+def _claim_key(kind, identifier):
+    return "claim-{0}-{1}".format(kind, identifier)
+
+
+def _owner_dead(token):
+    """
+    Whether the holder of a lease token is a process of this host that exited
+    """
+    host, pid, unique = token.split(":", 2)
+    if host != _HOST:
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except OSError as e:
+        return e.errno == errno.ESRCH
+    return False
+
+
+def break_claim(kind, identifier):
+    """
+    Drop a claim if its holder is a worker of this node that died, e.g. the one
+    whose journal is being recovered.  A claim held by a live worker, such as
+    one that took a redelivery of the submission, is left alone.  Returns
+    whether the claim was broken.
+    """
+    key = _claim_key(kind, identifier)
+    token = cache.get(key)
+    if token is None or not _owner_dead(token):
+        return False
+    #Another worker may have taken the claim since, once the dead one's expired
+    if cache.get(key) != token:
+        return False
+    cache.delete(key)
+    return True
+
+
+def claim(kind, identifier, ttl):
+    """
+    Claim a unit of work, e.g. a submission, so no other worker processes it
+    at the same time.  Returns the Lease, or None if someone else holds it.
+    """
+    lease = Lease(_claim_key(kind, identifier), ttl)
+    if lease.acquire():
+        get_keep_alive().add(lease)
+        return lease
+    statsd.increment("open_ended_assessment.grading_controller.lease.claim_conflict",
+                     tags=["kind:{0}".format(kind)])
+    return None
+
+
+class Heartbeat(object):
+    """
+    Renew leases every interval seconds (a third of the shortest ttl by
+    default) for as long as the with block runs.
+    """
+    def __init__(self, leases, interval=None):
+        self.leases = list(leases)
+        self.interval = interval or min(lease.ttl for lease in self.leases) / 3.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for lease in self.leases:
+                try:
+                    lease.renew()
+                except Exception:
+                    log.exception("Could not renew lease {0}".format(lease.key))
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, name="lease-heartbeat")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+class KeepAlive(object):
+    """
+    Background thread renewing the leases handed to it a third of their ttl
+    after the last renewal, until they are released or lost
+    """
+    def __init__(self, tick=1):
+        self.tick = tick
+        self._due = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="lease-keep-alive")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def add(self, lease):
+        with self._lock:
+            self._due[lease] = time.time() + lease.ttl / 3.0
+
+    def held(self):
+        with self._lock:
+            return len(self._due)
+
+    def _run(self):
+        while True:
+            time.sleep(self.tick)
+            try:
+                self.renew_due()
+            except Exception:
+                log.exception("Could not renew claims")
+
+    def renew_due(self):
+        now = time.time()
+        with self._lock:
+            due = [lease for lease, at in self._due.items() if at <= now or not lease.held]
+        for lease in due:
+            try:
+                lease.renew()
+            except Exception:
+                log.exception("Could not renew lease {0}".format(lease.key))
+            with self._lock:
+                if lease.held:
+                    self._due[lease] = time.time() + lease.ttl / 3.0
+                else:
+                    self._due.pop(lease, None)
+
+
+_keep_alive = None
+_keep_alive_pid = None
+_keep_alive_lock = threading.Lock()
+
+
+def get_keep_alive():
+    """
+    Return this process' KeepAlive, starting it on first use
+    """
+    global _keep_alive, _keep_alive_pid
+    with _keep_alive_lock:
+        if _keep_alive is None or _keep_alive_pid != os.getpid():
+            _keep_alive = KeepAlive().start()
+            _keep_alive_pid = os.getpid()
+        return _keep_alive
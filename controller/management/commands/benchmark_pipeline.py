@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+from django.core.cache import get_cache
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from optparse import make_option
+from tempfile import mkdtemp
+
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+
+from controller import benchmark
+from controller import leases
+from controller import outbox
+from controller import pipeline
+from controller import quarantine
+from controller import render_cache
+from controller import renderer
+from controller import storage
+from controller import xqueue_session
+from controller import tasks
+
+
+class Command(BaseCommand):
+    help = ("Measure end-to-end certificate throughput and latency against local xqueue and S3 stand-ins, "
+            "and write a json report")
+
+    option_list = BaseCommand.option_list + (
+        make_option('--items', type='int', dest='items', default=200,
+                    help='Number of synthetic submissions, spread over all templates'),
+        make_option('--queue', dest='queue', default='certificate-benchmark',
+                    help='Queue name the submissions are seeded on'),
+        make_option('--output', dest='output', default=None,
+                    help='File to write the json report to, defaults to stdout'),
+        make_option('--no-cache', action='store_false', dest='cache', default=True,
+                    help='Disable the render cache for the run'),
+        make_option('--outbox-timeout', type='int', dest='outbox_timeout', default=300,
+                    help='Seconds to wait for the post back outbox to drain'),
+        make_option('--storage', dest='storage', default='s3', choices=['s3', 'local', 'write_behind'],
+                    help='Storage backend: the S3 stand-in, local files only, or local files replicated to it'),
+        make_option('--min-throughput', type='float', dest='min_throughput', default=None,
+                    help='Fail if fewer certificates per second were delivered'),
+        make_option('--max-p99', type='float', dest='max_p99', default=None,
+                    help='Fail if the p99 end-to-end latency exceeds this many milliseconds'),
+    )
+
+    def handle(self, *args, **options):
+        templates = sorted(name for name in os.listdir(settings.CERTIFICATE_TEMPLATE_DIR) if name.endswith(".svg"))
+        if not templates:
+            raise CommandError("No templates in {0}".format(settings.CERTIFICATE_TEMPLATE_DIR))
+
+        xqueue = benchmark.FakeXqueue().start()
+        s3 = benchmark.FakeS3().start()
+        timer = benchmark.StageTimer()
+        scratch = mkdtemp()
+        self.point_at(xqueue, s3, scratch, options)
+        try:
+            run_id = uuid.uuid4().hex[:8]
+            for i in xrange(options['items']):
+                template = templates[i % len(templates)]
+                header = {'submission_id': i, 'submission_key': "{0}-{1}".format(run_id, i)}
+                body = {'student_name': u"Benchmark Student {0} {1}".format(run_id, i),
+                        'course_name': u"Benchmark Course {0}".format(i % 7),
+                        'student_id': "student-{0}".format(i),
+                        'template_pdf': os.path.splitext(template)[0] + ".pdf"}
+                xqueue.seed(options['queue'], header, body)
+
+            pipeline.add_observer(timer)
+            start = time.time()
+            #A run hands the queue over after XQUEUE_MAX_ITEMS_PER_DRAIN submissions, run again until it is drained
+            tasks.pull_from_xqueue()
+            while xqueue.queue_length(options['queue']) and time.time() < start + options['outbox_timeout']:
+                tasks.pull_from_xqueue()
+            if settings.OUTBOX_ENABLED:
+                self.wait_for_outbox(start + options['outbox_timeout'])
+            elapsed = time.time() - start
+            replication_time = None
+            if settings.STORAGE_BACKEND == "write_behind":
+                self.wait_for_replication(start + options['outbox_timeout'])
+                replication_time = time.time() - start
+        finally:
+            pipeline.remove_observer(timer)
+            xqueue.stop()
+            s3.stop()
+            shutil.rmtree(scratch)
+
+        report = self.report(options, xqueue, s3, timer, elapsed)
+        report['replication_seconds'] = replication_time
+        text = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(text + "\n")
+        else:
+            self.stdout.write(text + "\n")
+
+        failures = []
+        if report['delivered'] < options['items']:
+            failures.append("{0} of {1} certificates delivered".format(report['delivered'], options['items']))
+        if options['min_throughput'] is not None and report['throughput_per_second'] < options['min_throughput']:
+            failures.append("throughput {0:.2f}/s below {1}/s".format(report['throughput_per_second'], options['min_throughput']))
+        if options['max_p99'] is not None and report['latency'].get('p99_ms', sys.maxint) > options['max_p99']:
+            failures.append("p99 latency above {0} ms".format(options['max_p99']))
+        if failures:
+            raise CommandError("; ".join(failures))
+
+    def wait_for_outbox(self, deadline):
+        """
+        Wait until the outbox sender has posted every result back
+        """
+        box = outbox.get_outbox()
+        while box.pending() and time.time() < deadline:
+            time.sleep(0.05)
+
+    def wait_for_replication(self, deadline):
+        """
+        Wait until every certificate stored behind reached the S3 stand-in
+        """
+        replicas = storage.get_storage().log
+        while replicas.pending() and time.time() < deadline:
+            time.sleep(0.05)
+
+    def point_at(self, xqueue, s3, scratch, options):
+        """
+        Point the worker settings at the stand-ins for this process
+        """
+        settings.XQUEUE_INTERFACE = dict(settings.XQUEUE_INTERFACE, url=xqueue.url)
+        settings.CERTIFICATE_QUEUES_TO_PULL_FROM = [options['queue']]
+        #A single pass over the queues, draining the seeded submissions
+        settings.XQUEUE_POLL_RUN_SECONDS = 0
+        settings.S3_HOST = "127.0.0.1"
+        settings.S3_PORT = s3.port
+        settings.S3_IS_SECURE = False
+        settings.AWS_ACCESS_KEY_ID = settings.AWS_ACCESS_KEY_ID or "benchmark"
+        settings.AWS_SECRET_ACCESS_KEY = settings.AWS_SECRET_ACCESS_KEY or "benchmark"
+        settings.RENDER_CACHE_ENABLED = options['cache']
+        settings.RENDER_CACHE_CHECK_S3 = False
+        settings.OUTBOX_PATH = os.path.join(scratch, "outbox.sqlite3")
+        settings.JOURNAL_DIR = os.path.join(scratch, "journal")
+        settings.STORAGE_BACKEND = options['storage']
+        settings.STORAGE_LOCAL_DIR = os.path.join(scratch, "certificates")
+        settings.STORAGE_LOCAL_URL = "file://" + settings.STORAGE_LOCAL_DIR + "/"
+        settings.STORAGE_REPLICATION_LOG = os.path.join(scratch, "replication.sqlite3")
+        settings.QUARANTINE_PATH = os.path.join(scratch, "quarantine.sqlite3")
+        settings.RENDER_CACHE_DIR = os.path.join(scratch, "render_cache")
+        storage._storage = None
+        quarantine._store = None
+        render_cache._cache = None
+        #Leases, claims and failure counts left by earlier runs must not hold up or skip this one's items
+        leases.cache = quarantine.cache = get_cache('django.core.cache.backends.locmem.LocMemCache',
+                                                    LOCATION=os.path.basename(scratch))
+        xqueue_session.reset_session()
+
+    def report(self, options, xqueue, s3, timer, elapsed):
+        delivered = [(done - seeded) for seeded, done, body in xqueue.results.values() if body.get('url')]
+        return {
+            'items': options['items'],
+            'delivered': len(delivered),
+            'undelivered': options['items'] - len(delivered),
+            'elapsed_seconds': elapsed,
+            'throughput_per_second': len(delivered) / elapsed if elapsed else 0.0,
+            'latency': benchmark.summarize(delivered),
+            'stages': timer.report(),
+            's3': {'puts': s3.puts, 'bytes': s3.bytes_stored},
+            'xqueue': {'logins': xqueue.logins},
+            'config': {
+                'renderer_version': renderer.renderer_version(),
+                'render_mode': settings.RENDER_MODE,
+                'inkscape_shell_mode': settings.INKSCAPE_SHELL_MODE,
+                'render_cache': settings.RENDER_CACHE_ENABLED,
+                'render_batch_size': settings.RENDER_BATCH_SIZE,
+                'outbox': settings.OUTBOX_ENABLED,
+                'storage': settings.STORAGE_BACKEND,
+                'workers': dict((stage, getattr(settings, stage.upper() + "_WORKERS"))
+                                for stage in ("fetch", "assemble", "render", "upload", "post")),
+            },
+        }
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from optparse import make_option
+
+import os
+import re
+import timeit
+
+from controller import template_registry
+
+USER_NAME = u"Jean-François Dupont"
+COURSE_NAME = u"Introduction aux certificats"
+
+
+def legacy_render(path, user_name, course_name):
+    """
+    Template assembly as pull_from_single_queue did it before the registry:
+    read, strip and decode the whole file, then two full document re.sub passes.
+    """
+    with open(path, 'r') as f:
+        lines_template = "".join([line.strip('\n') for line in f.readlines()])
+    svg_line = unicode(lines_template, 'unicode-escape')
+    svg_line = re.sub(re.escape('==user_name=='), user_name, svg_line)
+    svg_line = re.sub(re.escape('==course_name=='), course_name, svg_line)
+    return svg_line.encode("utf8")
+
+
+class Command(BaseCommand):
+    help = "Microbenchmark the compiled template registry against the legacy per-item template assembly"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--iterations', type='int', dest='iterations', default=50,
+                    help='Renders per template and per implementation'),
+    )
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        template_dir = settings.CERTIFICATE_TEMPLATE_DIR
+        registry = template_registry.TemplateRegistry(template_dir)
+
+        self.stdout.write("{0:<55} {1:>10} {2:>12} {3:>12} {4:>9}\n".format(
+            "template", "size (KB)", "legacy (ms)", "compiled (ms)", "speedup"))
+        for name in sorted(os.listdir(template_dir)):
+            if not name.endswith(".svg"):
+                continue
+            path = os.path.join(template_dir, name)
+
+            #Names without xml special characters must render byte for byte as before
+            if legacy_render(path, USER_NAME, COURSE_NAME) != registry.render(name, USER_NAME, COURSE_NAME):
+                self.stderr.write("{0}: compiled output differs from legacy output\n".format(name))
+
+            legacy = min(timeit.repeat(lambda: legacy_render(path, USER_NAME, COURSE_NAME),
+                                       repeat=3, number=iterations)) / iterations
+            compiled = min(timeit.repeat(lambda: registry.render(name, USER_NAME, COURSE_NAME),
+                                         repeat=3, number=iterations)) / iterations
+
+            self.stdout.write("{0:<55} {1:>10.1f} {2:>12.3f} {3:>12.3f} {4:>8.1f}x\n".format(
+                name, os.path.getsize(path) / 1024.0, legacy * 1000, compiled * 1000, legacy / compiled))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from optparse import make_option
+from subprocess import Popen, PIPE
+from tempfile import mkdtemp
+
+import os
+import shutil
+
+import numpy
+
+from controller import overlay
+from controller import renderer
+from controller import template_registry
+
+USER_NAME = u"Jean-François Dupont"
+COURSE_NAME = u"Introduction aux certificats"
+
+
+def rasterize(pdftoppm, pdf_path, resolution, directory):
+    """
+    Rasterize the first page of pdf_path to a grayscale numpy array
+    """
+    prefix = os.path.join(directory, os.path.basename(pdf_path))
+    process = Popen([pdftoppm, '-gray', '-r', str(resolution), '-f', '1', '-l', '1', pdf_path, prefix],
+                    stdout=PIPE, stderr=PIPE)
+    out, err = process.communicate()
+    if process.returncode != 0:
+        raise CommandError("pdftoppm failed on {0}: {1}".format(pdf_path, err))
+    name = [name for name in os.listdir(directory) if name.startswith(os.path.basename(prefix)) and name.endswith(".pgm")][0]
+    path = os.path.join(directory, name)
+    with open(path, 'rb') as f:
+        #Binary pgm: magic number, optional comments, width and height, maxval, pixels
+        f.readline()
+        line = f.readline()
+        while line.startswith("#"):
+            line = f.readline()
+        width, height = [int(n) for n in line.split()]
+        maxval = int(f.readline())
+        pixels = numpy.fromstring(f.read(), dtype=numpy.uint8 if maxval < 256 else ">u2")
+    os.remove(path)
+    return pixels.reshape((height, width))
+
+
+class Command(BaseCommand):
+    help = "Compare overlay renders with full inkscape renders for every template"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--resolution', type='int', dest='resolution', default=72,
+                    help='Rasterization resolution in dpi'),
+        make_option('--tolerance', type='int', dest='tolerance', default=64,
+                    help='Gray level difference above which a pixel counts as different'),
+        make_option('--max-diff', type='float', dest='max_diff', default=0.005,
+                    help='Maximum fraction of different pixels for a template to pass'),
+        make_option('--pdftoppm', dest='pdftoppm', default='pdftoppm',
+                    help='Path to the poppler pdftoppm binary'),
+    )
+
+    def handle(self, *args, **options):
+        if not overlay.OVERLAY_AVAILABLE:
+            raise CommandError("reportlab and PyPDF2 are needed for overlay renders")
+
+        template_dir = settings.CERTIFICATE_TEMPLATE_DIR
+        overlay_renderer = overlay.get_renderer()
+        scratch = mkdtemp()
+        failures = 0
+        try:
+            for name in sorted(os.listdir(template_dir)):
+                if not name.endswith(".svg"):
+                    continue
+                if not overlay_renderer.supports(name):
+                    self.stdout.write("{0:<55} unsupported, uses full renders\n".format(name))
+                    continue
+
+                svg_path = os.path.join(scratch, "full.svg")
+                full_pdf = os.path.join(scratch, "full.pdf")
+                overlay_pdf = os.path.join(scratch, "overlay.pdf")
+                with open(svg_path, 'wb') as f:
+                    f.write(template_registry.registry.render(name, USER_NAME, COURSE_NAME))
+                renderer.render_pdf(svg_path, full_pdf)
+                overlay_renderer.render_pdf(name, USER_NAME, COURSE_NAME, overlay_pdf)
+
+                full = rasterize(options['pdftoppm'], full_pdf, options['resolution'], scratch)
+                stamped = rasterize(options['pdftoppm'], overlay_pdf, options['resolution'], scratch)
+                if full.shape != stamped.shape:
+                    failures += 1
+                    self.stdout.write("{0:<55} FAIL page size {1} != {2}\n".format(name, full.shape, stamped.shape))
+                    continue
+
+                diff = numpy.mean(numpy.abs(full.astype(numpy.int32) - stamped.astype(numpy.int32)) > options['tolerance'])
+                passed = diff <= options['max_diff']
+                failures += 0 if passed else 1
+                self.stdout.write("{0:<55} {1} {2:.4%} pixels differ\n".format(name, "ok  " if passed else "FAIL", diff))
+        finally:
+            shutil.rmtree(scratch)
+
+        if failures:
+            raise CommandError("{0} template(s) differ between overlay and full renders".format(failures))
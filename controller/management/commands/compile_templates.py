@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from optparse import make_option
+from tempfile import mkdtemp
+from lxml import etree
+
+import os
+import shutil
+import time
+
+from controller import renderer
+from controller import template_compiler
+from controller import template_registry
+
+USER_NAME = u"Jean-François Dupont"
+COURSE_NAME = u"Introduction aux certificats"
+
+
+def best_of(func, repeat):
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+class Command(BaseCommand):
+    help = "Compile the svg templates into optimized artifacts in COMPILED_TEMPLATE_DIR"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+                    help='Directory to write the artifacts to, defaults to COMPILED_TEMPLATE_DIR'),
+        make_option('--repeat', type='int', dest='repeat', default=3,
+                    help='Timed runs per template, the best one is reported'),
+        make_option('--no-render', action='store_false', dest='render', default=True,
+                    help='Only time parsing, not inkscape renders'),
+    )
+
+    def handle(self, *args, **options):
+        template_dir = settings.CERTIFICATE_TEMPLATE_DIR
+        output = options['output'] or settings.COMPILED_TEMPLATE_DIR
+        repeat = options['repeat']
+        if not os.path.isdir(output):
+            os.makedirs(output)
+
+        names = args or sorted(name for name in os.listdir(template_dir) if name.endswith(".svg"))
+        scratch = mkdtemp()
+        failures = 0
+        self.stdout.write("{0:<55} {1:>18} {2:>18} {3:>20}\n".format(
+            "template", "size (KB)", "parse (ms)", "render (ms)"))
+        try:
+            for name in names:
+                source_path = os.path.join(template_dir, name)
+                source = template_registry.read_template(source_path)
+                try:
+                    artifact, stats = template_compiler.compile_template(source)
+                except (template_compiler.CompileError, etree.XMLSyntaxError) as e:
+                    failures += 1
+                    self.stderr.write("{0}: {1}\n".format(name, e))
+                    continue
+
+                compiled_path = os.path.join(output, name)
+                with open(compiled_path + ".tmp", 'w') as f:
+                    f.write(artifact)
+                os.rename(compiled_path + ".tmp", compiled_path)
+
+                sizes, parses, renders = [], [], []
+                for path in (source_path, compiled_path):
+                    sizes.append(os.path.getsize(path) / 1024.0)
+                    text = template_registry.read_template(path).encode("utf8")
+                    parses.append(best_of(lambda: etree.fromstring(text), repeat) * 1000)
+                    if options['render']:
+                        renders.append(self.time_render(path, scratch, repeat) * 1000)
+
+                self.stdout.write("{0:<55} {1:>7.1f} -> {2:>7.1f} {3:>7.2f} -> {4:>7.2f} {5}\n".format(
+                    name, sizes[0], sizes[1], parses[0], parses[1],
+                    "{0:>8.1f} -> {1:>8.1f}".format(*renders) if renders else "{0:>20}".format("-")))
+                self.stdout.write("    " + ", ".join("{0} {1}".format(key.replace("_", " "), value)
+                                                   for key, value in sorted(stats.items())) + "\n")
+        finally:
+            shutil.rmtree(scratch)
+
+        if failures:
+            raise CommandError("{0} template(s) could not be compiled".format(failures))
+
+    def time_render(self, path, scratch, repeat):
+        """
+        Best time to render path to pdf with the sample names
+        """
+        registry = template_registry.TemplateRegistry(os.path.dirname(path))
+        svg_path = os.path.join(scratch, "timing.svg")
+        pdf_path = os.path.join(scratch, "timing.pdf")
+        with open(svg_path, 'wb') as f:
+            f.write(registry.render(os.path.basename(path), USER_NAME, COURSE_NAME))
+        return best_of(lambda: renderer.render_pdf(svg_path, pdf_path), repeat)
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+import time
+
+from controller import quarantine
+
+
+class Command(BaseCommand):
+    help = "List the quarantined submissions, or release some so their next delivery is processed"
+    args = "[key ...]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--release', action='store_true', dest='release', default=False,
+                    help='Release the submissions given by key, or every one with --all'),
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='With --release, release every quarantined submission'),
+        make_option('--verbose-bodies', action='store_true', dest='bodies', default=False,
+                    help='Also print the xqueue header and body of each submission'),
+    )
+
+    def handle(self, *args, **options):
+        store = quarantine.get_store()
+        if options['release']:
+            keys = [entry[0] for entry in store.entries()] if options['all'] else args
+            if not keys:
+                raise CommandError("Give the keys to release, or --all")
+            missing = [key for key in keys if not quarantine.release(key)]
+            self.stdout.write("Released {0} submission(s)\n".format(len(keys) - len(missing)))
+            if missing:
+                raise CommandError("Not quarantined: {0}".format(", ".join(missing)))
+            return
+
+        entries = store.entries()
+        for key, queue_name, header, body, reason, failures, created, last_seen, deliveries in entries:
+            self.stdout.write(u"{0} queue={1} failures={2} deliveries={3} since {4}\n    {5}\n".format(
+                key, queue_name, failures, deliveries,
+                time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(created)), reason))
+            if options['bodies']:
+                self.stdout.write(u"    header: {0}\n    body: {1}\n".format(header, body))
+        self.stdout.write("{0} quarantined submission(s)\n".format(len(entries)))
@@ -0,0 +1,271 @@
+"""
+Latency and size metrics.
+
+Helpers over statsd for timing the worker's stages and its xqueue and S3
+calls, tagged by queue and template.  Every measurement is a single UDP packet
+to the local statsd agent, cheap enough to leave on in production.
+STAGE_METRICS_SAMPLE_RATE thins them out on very busy workers and
+STAGE_METRICS_ENABLED turns them off.
+
+Each worker process also keeps in memory counters (the recorder) of its
+throughput, latencies, render cache and queue depths, and publishes a snapshot
+of them to the django cache every METRICS_PUBLISH_INTERVAL seconds.  The
+status view merges the snapshots of live workers, so serving it never touches
+xqueue or S3.  The cache must be shared by the workers and the web process,
+like the one leases need.
+"""
+from django.conf import settings
+from django.core.cache import cache
+import collections
+import functools
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+from statsd import statsd
+
+from . import leases
+
+log = logging.getLogger(__name__)
+
+#A cache private to each process would leave the status view without workers
+leases.check_cache(cache)
+
+PREFIX = "open_ended_assessment.grading_controller."
+
+
+def histogram(name, value, tags=None):
+    if settings.STAGE_METRICS_ENABLED:
+        statsd.histogram(PREFIX + name, value, tags=tags, sample_rate=settings.STAGE_METRICS_SAMPLE_RATE)
+
+
+def item_tags(item):
+    """
+    Tags of a submission flowing through the worker
+    """
+    return ["queue_name:{0}".format(item.get('queue_name')), "template:{0}".format(item['template'])]
+
+
+class Timer(object):
+    """
+    Context manager sending the time its block took as a histogram.  Set
+    success on it to tag the outcome; a block that raises is tagged
+    success:False.
+    """
+    def __init__(self, name, tags=None):
+        self.name = name
+        self.tags = list(tags or [])
+        self.success = None
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.success = False
+        tags = self.tags
+        if self.success is not None:
+            tags = tags + ["success:{0}".format(self.success)]
+        histogram(self.name, time.time() - self.start, tags)
+
+
+def timed(name, tags=None):
+    """
+    Decorator timing a function that returns (success, msg).  tags is a list,
+    or a callable returning the list from the function's arguments.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            call_tags = tags(*args, **kwargs) if callable(tags) else tags
+            with Timer(name, call_tags) as timer:
+                result = func(*args, **kwargs)
+                timer.success = result[0]
+            return result
+        return wrapper
+    return decorator
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile of values, None when there are none
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(math.ceil(fraction * len(ordered))) - 1))]
+
+
+def summarize(values):
+    """
+    Latency summary in milliseconds
+    """
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean_ms': 1000.0 * sum(values) / len(values),
+        'p50_ms': 1000.0 * percentile(values, 0.5),
+        'p90_ms': 1000.0 * percentile(values, 0.9),
+        'p99_ms': 1000.0 * percentile(values, 0.99),
+        'max_ms': 1000.0 * max(values),
+    }
+
+
+#Sliding windows items/sec are reported over, in seconds
+RATE_WINDOWS = (10, 60, 300)
+
+
+class Window(object):
+    """
+    Event counts per second over the last max(RATE_WINDOWS) seconds
+    """
+    def __init__(self):
+        self.buckets = collections.deque()
+        self.total = 0
+
+    def add(self, count, now):
+        second = int(now)
+        if self.buckets and self.buckets[-1][0] == second:
+            self.buckets[-1][1] += count
+        else:
+            self.buckets.append([second, count])
+        self.total += count
+        self._prune(now)
+
+    def _prune(self, now):
+        while self.buckets and self.buckets[0][0] <= now - max(RATE_WINDOWS):
+            self.buckets.popleft()
+
+    def rates(self, now):
+        self._prune(now)
+        return dict(("{0}s".format(seconds), sum(count for second, count in self.buckets if second > now - seconds) / float(seconds))
+                    for seconds in RATE_WINDOWS)
+
+
+class Recorder(object):
+    """
+    In memory counters of one worker process
+    """
+    def __init__(self, max_samples=500):
+        self.items = collections.defaultdict(Window)
+        self.depths = {}
+        self.counts = collections.Counter()
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=max_samples))
+        self._lock = threading.Lock()
+
+    def item_done(self, queue_name, latency):
+        now = time.time()
+        with self._lock:
+            self.items[queue_name].add(1, now)
+            self.samples['latency'].append(latency)
+
+    def sample(self, name, value):
+        with self._lock:
+            self.samples[name].append(value)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+    def queue_depth(self, queue_name, depth):
+        with self._lock:
+            self.depths[queue_name] = (depth, time.time())
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            queues = {}
+            for queue_name in set(self.items) | set(self.depths):
+                depth, depth_time = self.depths.get(queue_name, (None, None))
+                window = self.items.get(queue_name)
+                queues[queue_name] = {
+                    'depth': depth,
+                    'depth_time': depth_time,
+                    'items': window.total if window else 0,
+                    'items_per_second': window.rates(now) if window else {},
+                }
+            return {
+                'queues': queues,
+                'counts': dict(self.counts),
+                'samples': dict((name, list(values)) for name, values in self.samples.items()),
+            }
+
+
+recorder = Recorder()
+
+#Cache key listing the workers that publish snapshots
+INDEX_KEY = "worker-metrics-index"
+
+_publisher_pid = None
+_publisher_lock = threading.Lock()
+_sources = []
+
+
+def add_source(name, func):
+    """
+    Include name: func() in every snapshot, e.g. the renderer pool
+    utilization.  func returns None when it has nothing to report.
+    """
+    _sources.append((name, func))
+
+
+def snapshot():
+    data = recorder.snapshot()
+    data.update(host=socket.gethostname(), pid=os.getpid(), time=time.time())
+    for name, func in _sources:
+        try:
+            data[name] = func()
+        except Exception:
+            log.exception("Could not collect {0}".format(name))
+            data[name] = None
+    return data
+
+
+def publish():
+    key = "worker-metrics-{0}-{1}".format(socket.gethostname(), os.getpid())
+    ttl = 3 * settings.METRICS_PUBLISH_INTERVAL
+    cache.set(key, snapshot(), ttl)
+    #Workers racing on the index may drop each other's key for one interval
+    index = cache.get(INDEX_KEY) or {}
+    now = time.time()
+    index = dict((worker, seen) for worker, seen in index.items() if now - seen < ttl)
+    index[key] = now
+    cache.set(INDEX_KEY, index, ttl)
+
+
+def _publish_forever():
+    while True:
+        try:
+            publish()
+        except Exception:
+            log.exception("Could not publish worker metrics")
+        time.sleep(settings.METRICS_PUBLISH_INTERVAL)
+
+
+def start_publisher():
+    """
+    Publish this process' snapshot in the background, once per process
+    """
+    global _publisher_pid
+    with _publisher_lock:
+        if _publisher_pid == os.getpid():
+            return
+        _publisher_pid = os.getpid()
+    thread = threading.Thread(target=_publish_forever, name="metrics-publisher")
+    thread.daemon = True
+    thread.start()
+
+
+def worker_snapshots():
+    """
+    Snapshots of the workers that published recently
+    """
+    index = cache.get(INDEX_KEY) or {}
+    snapshots = cache.get_many(index.keys()).values() if index else []
+    return [data for data in snapshots if time.time() - data['time'] < 3 * settings.METRICS_PUBLISH_INTERVAL]
@@ -0,0 +1 @@
+#No models; the django test runner needs this module to find controller.tests
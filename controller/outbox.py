@@ -0,0 +1,227 @@
+"""
+Durable outbox for xqueue post backs.
+
+A result is written to a local SQLite database before it is posted, and a
+background sender drains the database over the keep-alive xqueue session, retrying
+failed posts with exponential backoff.  A certificate that was rendered and
+uploaded is therefore never lost, nor rendered again, because xqueue was
+briefly unreachable.  Worker processes on one node can share the database:
+rows are leased to one sender at a time, one row per post and only once the
+post has an xqueue concurrency slot, so the lease only has to outlast a single
+request.
+"""
+from django.conf import settings
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from statsd import statsd
+
+from . import concurrency
+from . import util
+from . import xqueue_session
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue_name TEXT NOT NULL,
+    header TEXT NOT NULL,
+    body TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error TEXT
+)
+"""
+
+
+class Outbox(object):
+    def __init__(self, path, lease_seconds=60):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_next_attempt ON results (next_attempt)")
+        self.added = threading.Event()
+
+    def add(self, queue_name, header, body):
+        """
+        Record a result to post back.  Durable once this returns.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT INTO results (queue_name, header, body, created, next_attempt) VALUES (?, ?, ?, ?, ?)",
+                               (queue_name, header, body, now, now))
+        self.added.set()
+
+    def take(self, limit):
+        """
+        Lease up to limit results that are due to this process and return them
+        as (id, queue_name, header, body, attempts, created, lease) tuples.
+        lease identifies this holder to remove and failed.
+        """
+        now = time.time()
+        lease = now + self.lease_seconds
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute("SELECT id, queue_name, header, body, attempts, created FROM results "
+                                          "WHERE next_attempt <= ? ORDER BY id LIMIT ?", (now, limit)).fetchall()
+                self._conn.executemany("UPDATE results SET next_attempt = ? WHERE id = ?",
+                                       [(lease, row[0]) for row in rows])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [row + (lease,) for row in rows]
+
+    def remove(self, result_id, lease):
+        """
+        Drop a result, unless its lease ran out and another sender took it.
+        Returns whether it was removed.
+        """
+        with self._lock:
+            return self._conn.execute("DELETE FROM results WHERE id = ? AND next_attempt = ?",
+                                      (result_id, lease)).rowcount > 0
+
+    def failed(self, result_id, lease, attempts, error, delay):
+        """
+        Schedule the retry of a result, unless its lease ran out and another
+        sender took it.  Returns whether it was rescheduled.
+        """
+        with self._lock:
+            return self._conn.execute("UPDATE results SET attempts = ?, next_attempt = ?, last_error = ? "
+                                      "WHERE id = ? AND next_attempt = ?",
+                                      (attempts, time.time() + delay, error, result_id, lease)).rowcount > 0
+
+    def next_due(self):
+        """
+        Time the next result is due, or None if the outbox is empty
+        """
+        with self._lock:
+            return self._conn.execute("SELECT MIN(next_attempt) FROM results").fetchone()[0]
+
+    def pending(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+class OutboxSender(object):
+    """
+    Background thread posting the outbox to xqueue in batches over the
+    process' keep-alive xqueue session
+    """
+    def __init__(self, outbox, batch_size, retry_delay, max_retry_delay, max_age, idle_wait=5):
+        self.outbox = outbox
+        self.batch_size = batch_size
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_age = max_age
+        self.idle_wait = idle_wait
+        self.thread = threading.Thread(target=self._run, name="outbox-sender")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                sent = self.send_batch()
+            except Exception:
+                log.exception("Error sending the outbox")
+                sent = 0
+            statsd.gauge("open_ended_assessment.grading_controller.outbox.pending", self.outbox.pending())
+            if sent < self.batch_size:
+                self._wait()
+
+    def _wait(self):
+        """
+        Sleep until a result is added or the next retry is due
+        """
+        next_due = self.outbox.next_due()
+        timeout = self.idle_wait if next_due is None else min(self.idle_wait, max(next_due - time.time(), 0))
+        self.outbox.added.wait(timeout)
+        self.outbox.added.clear()
+
+    def send_batch(self):
+        """
+        Post up to batch_size results that are due.  Returns how many were
+        taken.
+        """
+        taken = 0
+        while taken < self.batch_size:
+            #Waiting for a slot under backoff could outlast the lease
+            with concurrency.Reservation("xqueue"):
+                rows = self.outbox.take(1)
+                if not rows:
+                    break
+                taken += 1
+                self.send(*rows[0])
+        return taken
+
+    def send(self, result_id, queue_name, header, body, attempts, created, lease):
+        try:
+            success, msg = util.post_results_to_xqueue(xqueue_session.get_session(), header, body)
+        except Exception as e:
+            success, msg = False, str(e)
+        statsd.increment("open_ended_assessment.grading_controller.post_to_xqueue",
+                         tags=["success:{0}".format(success), "queue_name:{0}".format(queue_name)])
+        if success:
+            if self.outbox.remove(result_id, lease):
+                statsd.histogram("open_ended_assessment.grading_controller.outbox.delivery_time", time.time() - created)
+            else:
+                log.warning("Outbox lease of result {0} ran out while posting it back".format(result_id))
+            return
+
+        attempts += 1
+        if time.time() - created > self.max_age:
+            log.error("Giving up posting back after {0} attempts: {1} {2}".format(attempts, header, msg))
+            statsd.increment("open_ended_assessment.grading_controller.outbox.expired")
+            self.outbox.remove(result_id, lease)
+            return
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** (attempts - 1))
+        log.warning("Could not post back, retrying in {0}s.  Error: {1}".format(delay, msg))
+        if not self.outbox.failed(result_id, lease, attempts, msg, delay):
+            log.warning("Outbox lease of result {0} ran out while posting it back".format(result_id))
+
+_outbox = None
+_sender = None
+_outbox_pid = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    """
+    Return this process' outbox, starting its sender on first use
+    """
+    global _outbox, _sender, _outbox_pid
+    with _outbox_lock:
+        if _outbox is None or _outbox_pid != os.getpid():
+            _outbox = Outbox(settings.OUTBOX_PATH, settings.OUTBOX_LEASE_SECONDS)
+            _sender = OutboxSender(_outbox, settings.OUTBOX_BATCH_SIZE, settings.OUTBOX_RETRY_DELAY,
+                                   settings.OUTBOX_MAX_RETRY_DELAY, settings.OUTBOX_MAX_AGE).start()
+            _outbox_pid = os.getpid()
+        return _outbox
+
+
+def pending_count():
+    """
+    Results waiting in this node's outbox, if this process uses it
+    """
+    if _outbox is None or _outbox_pid != os.getpid():
+        return None
+    return _outbox.pending()
+
+metrics.add_source("outbox_pending", pending_count)
@@ -0,0 +1,373 @@
+"""
+Overlay render mode: a pre-rendered template background plus per student text.
+
+Everything on a certificate except the ==user_name== and ==course_name== text is
+the same for every student, so the template is rendered by inkscape once with
+those texts blanked out, and each certificate only stamps its strings onto a
+copy of that background pdf with reportlab.  With OVERLAY_PER_COURSE_BACKGROUND
+the course name is baked into a background per (template, course) as well.
+
+Templates whose slots use features the stamping does not reproduce (rotated or
+skewed text, letter spacing, per glyph positions...) are reported unsupported
+and keep going through the full inkscape render.  check_overlay_fidelity
+compares both modes for every template.
+"""
+from django.conf import settings
+from collections import OrderedDict
+from cStringIO import StringIO
+from tempfile import NamedTemporaryFile
+import copy
+import hashlib
+import logging
+import os
+import re
+import threading
+
+from lxml import etree
+
+from . import renderer
+from . import scratch
+from . import template_registry
+
+try:
+    from reportlab.lib.colors import HexColor
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont, TTFError
+    from reportlab.pdfgen import canvas
+    from PyPDF2 import PdfFileReader, PdfFileWriter
+    OVERLAY_AVAILABLE = True
+except ImportError:
+    OVERLAY_AVAILABLE = False
+
+log = logging.getLogger(__name__)
+
+SVG_NS = "http://www.w3.org/2000/svg"
+TEXT_TAGS = ("{%s}text" % SVG_NS, "{%s}tspan" % SVG_NS)
+TRANSFORM_RE = re.compile(r'(matrix|translate|scale|rotate|skewX|skewY)\s*\(([^)]*)\)')
+NUMBER_RE = re.compile(r'[\s,]+')
+LENGTH_RE = re.compile(r'^\s*([-+0-9.eE]+)\s*(px)?\s*$')
+IDENTITY = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+#Properties inherited from the ancestors of a text element
+INHERITED_STYLE = ("font-family", "font-size", "font-weight", "font-style", "fill", "text-anchor", "letter-spacing")
+
+
+class UnsupportedTemplate(Exception):
+    pass
+
+
+def multiply(m1, m2):
+    """
+    Compose two svg matrices (a, b, c, d, e, f): m2 is applied first
+    """
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a1 * a2 + c1 * b2, b1 * a2 + d1 * b2,
+            a1 * c2 + c1 * d2, b1 * c2 + d1 * d2,
+            a1 * e2 + c1 * f2 + e1, b1 * e2 + d1 * f2 + f1)
+
+
+def parse_transform(value):
+    matrix = IDENTITY
+    for name, args in TRANSFORM_RE.findall(value or ""):
+        numbers = [float(n) for n in NUMBER_RE.split(args.strip()) if n]
+        if name == "matrix":
+            step = tuple(numbers)
+        elif name == "translate":
+            step = (1.0, 0.0, 0.0, 1.0, numbers[0], numbers[1] if len(numbers) > 1 else 0.0)
+        elif name == "scale":
+            step = (numbers[0], 0.0, 0.0, numbers[1] if len(numbers) > 1 else numbers[0], 0.0, 0.0)
+        else:
+            raise UnsupportedTemplate("{0} transform on text".format(name))
+        matrix = multiply(matrix, step)
+    return matrix
+
+
+def parse_style(element):
+    style = {}
+    for prop in INHERITED_STYLE:
+        if element.get(prop) is not None:
+            style[prop] = element.get(prop)
+    for declaration in (element.get("style") or "").split(";"):
+        if ":" in declaration:
+            prop, value = declaration.split(":", 1)
+            style[prop.strip()] = value.strip()
+    return style
+
+
+def parse_length(value):
+    match = LENGTH_RE.match(value or "")
+    if match is None:
+        raise UnsupportedTemplate("Unsupported length {0!r}".format(value))
+    return float(match.group(1))
+
+
+class TextSlot(object):
+    """
+    A text element holding a slot: where and how its text is drawn, in svg user units
+    """
+    def __init__(self, element, name):
+        self.element = element
+        self.name = name
+        self.prefix, self.suffix = element.text.split("=={0}==".format(name), 1)
+
+        chain = [element] + list(element.iterancestors())
+        chain.reverse()
+        matrix = IDENTITY
+        style = {}
+        for node in chain:
+            #transform is not valid on tspan in SVG 1.1 and renderers ignore it there
+            if node.tag != "{%s}tspan" % SVG_NS:
+                matrix = multiply(matrix, parse_transform(node.get("transform")))
+            style.update(parse_style(node))
+        if matrix[1] or matrix[2]:
+            raise UnsupportedTemplate("Rotated or skewed text")
+        if parse_length(style.get("letter-spacing", "0")):
+            raise UnsupportedTemplate("Letter spacing on text")
+
+        x, y = None, None
+        for node in (element, element.getparent()):
+            if node.tag in TEXT_TAGS:
+                if x is None and node.get("x") is not None:
+                    x = node.get("x")
+                if y is None and node.get("y") is not None:
+                    y = node.get("y")
+        if x is None or y is None or len(x.split()) > 1 or len(y.split()) > 1:
+            raise UnsupportedTemplate("Text without a single x/y position")
+
+        self.x = matrix[0] * float(x) + matrix[4]
+        self.y = matrix[3] * float(y) + matrix[5]
+        self.font_size = parse_length(style.get("font-size", "16px")) * abs(matrix[3])
+        self.font_family = style.get("font-family", "sans-serif").strip("'\"")
+        self.bold = style.get("font-weight", "normal") in ("bold", "bolder", "600", "700", "800", "900")
+        self.italic = style.get("font-style", "normal") in ("italic", "oblique")
+        self.fill = style.get("fill", "#000000")
+        self.anchor = style.get("text-anchor", "start")
+
+    def font_key(self):
+        """
+        OVERLAY_FONTS key of this slot's font: the svg family, followed by
+        " Bold", " Italic" or " Bold Italic"
+        """
+        return self.font_family + {(False, False): "", (True, False): " Bold",
+                                   (False, True): " Italic", (True, True): " Bold Italic"}[(self.bold, self.italic)]
+
+    def font_name(self):
+        """
+        reportlab font for this slot, registered from OVERLAY_FONTS
+        """
+        return register_font(self.font_key())
+
+
+_fonts = {}
+_fonts_lock = threading.Lock()
+
+
+def register_font(name):
+    with _fonts_lock:
+        if name not in _fonts:
+            path = settings.OVERLAY_FONTS.get(name)
+            if path is None:
+                if not settings.OVERLAY_FALLBACK_FONT:
+                    raise UnsupportedTemplate(u"No font configured in OVERLAY_FONTS for {0}".format(name))
+                log.warning(u"No font configured in OVERLAY_FONTS for {0}, using {1}".format(
+                    name, settings.OVERLAY_FALLBACK_FONT))
+                _fonts[name] = settings.OVERLAY_FALLBACK_FONT
+            else:
+                try:
+                    pdfmetrics.registerFont(TTFont(name, path))
+                except (TTFError, EnvironmentError) as e:
+                    raise UnsupportedTemplate(u"Could not load font {0} from {1}: {2}".format(name, path, e))
+                _fonts[name] = name
+        return _fonts[name]
+
+
+class TemplateOverlay(object):
+    """
+    Parsed slot layout of one compiled template
+    """
+    def __init__(self, compiled):
+        self.digest = compiled.digest
+        self.tree = etree.fromstring(template_registry.read_template(compiled.path).encode("utf8"))
+        viewbox = self.tree.get("viewBox")
+        if viewbox:
+            self.width = float(NUMBER_RE.split(viewbox.strip())[2])
+        else:
+            self.width = parse_length(self.tree.get("width"))
+
+        self.slots = []
+        for element in self.tree.iter(etree.Element):
+            text = element.text or ""
+            tail = element.tail or ""
+            names = template_registry.SLOT_RE.findall(text)
+            if names:
+                if element.tag not in TEXT_TAGS or len(element) or len(names) > 1:
+                    raise UnsupportedTemplate("Slot {0} outside of a plain text element".format(names[0]))
+                self.slots.append(TextSlot(element, names[0]))
+            if template_registry.SLOT_RE.search(tail) or template_registry.SLOT_RE.search(
+                    " ".join(element.attrib.values())):
+                raise UnsupportedTemplate("Slot outside of element text")
+        if sorted(set(slot.name for slot in self.slots)) != sorted(set(compiled.slots)):
+            raise UnsupportedTemplate("Could not locate every slot")
+        #Stamping in another font than inkscape renders would change the certificate, and a
+        #font that does not load would fail every certificate of the template
+        for slot in self.slots:
+            slot.font_name()
+
+    def background_svg(self, course_name=None):
+        """
+        Svg source with the slot texts blanked, or with course_name filled in
+        """
+        tree = copy.deepcopy(self.tree)
+        for original, element in zip(self.tree.iter(), tree.iter()):
+            for slot in self.slots:
+                if slot.element is original:
+                    if slot.name == "course_name" and course_name is not None:
+                        element.text = slot.prefix + course_name + slot.suffix
+                    else:
+                        element.text = ""
+        return etree.tostring(tree, encoding="utf-8", xml_declaration=True)
+
+
+class Background(object):
+    def __init__(self, pdf):
+        self.pdf = pdf
+        box = PdfFileReader(StringIO(pdf)).getPage(0).mediaBox
+        self.page_width = float(box.getWidth())
+        self.page_height = float(box.getHeight())
+
+
+class OverlayRenderer(object):
+    """
+    Keeps the overlay layout of each template and a bounded set of rendered
+    backgrounds, in memory and in OVERLAY_BACKGROUND_DIR.
+    """
+    def __init__(self, directory, max_backgrounds, per_course):
+        self.directory = directory
+        self.max_backgrounds = max_backgrounds
+        self.per_course = per_course
+        self._overlays = {}
+        self._backgrounds = OrderedDict()
+        self._rendering = {}
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def overlay(self, template):
+        """
+        Return the TemplateOverlay of template, or None if it cannot be stamped
+        """
+        compiled = template_registry.registry.get(template)
+        cached = self._overlays.get(template)
+        if cached is None or cached[0] != compiled.digest:
+            try:
+                overlay = TemplateOverlay(compiled)
+            except UnsupportedTemplate as e:
+                log.warning(u"Template {0} falls back to full renders: {1}".format(template, e))
+                overlay = None
+            cached = (compiled.digest, overlay)
+            self._overlays[template] = cached
+        return cached[1]
+
+    def supports(self, template):
+        return OVERLAY_AVAILABLE and self.overlay(template) is not None
+
+    def background(self, overlay, course_name):
+        key = hashlib.sha1("\0".join([overlay.digest, course_name.encode("utf8") if course_name else "",
+                                      renderer.renderer_version()])).hexdigest()
+        with self._lock:
+            background = self._backgrounds.pop(key, None)
+            if background is not None:
+                self._backgrounds[key] = background
+                return background
+            #Renders of one background wait for each other, other templates keep stamping
+            key_lock = self._rendering.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                background = self._backgrounds.get(key)
+            if background is None:
+                path = os.path.join(self.directory, key + ".pdf")
+                if not os.path.exists(path):
+                    self._render_background(overlay, course_name, path)
+                with open(path, 'rb') as f:
+                    background = Background(f.read())
+            with self._lock:
+                self._backgrounds.pop(key, None)
+                self._backgrounds[key] = background
+                while len(self._backgrounds) > self.max_backgrounds:
+                    self._backgrounds.popitem(last=False)
+                self._rendering.pop(key, None)
+        return background
+
+    def _render_background(self, overlay, course_name, path):
+        space = scratch.get_scratch()
+        svg_path = space.write(".svg", overlay.background_svg(course_name))
+        #Next to path, so the finished pdf is renamed into place
+        pdf_file = NamedTemporaryFile(suffix=".pdf", dir=self.directory, delete=False)
+        pdf_file.close()
+        try:
+            renderer.render_pdf(svg_path, pdf_file.name)
+            os.rename(pdf_file.name, path)
+        finally:
+            space.release(svg_path)
+            if os.path.exists(pdf_file.name):
+                os.remove(pdf_file.name)
+
+    def render_pdf(self, template, user_name, course_name, pdf_path):
+        """
+        Write the certificate for user_name and course_name to pdf_path
+        """
+        with open(pdf_path, 'wb') as f:
+            f.write(self.render_pdf_data(template, user_name, course_name))
+
+    def render_pdf_data(self, template, user_name, course_name):
+        """
+        Return the certificate for user_name and course_name as pdf data,
+        without running inkscape once the background exists
+        """
+        overlay = self.overlay(template)
+        background = self.background(overlay, course_name if self.per_course else None)
+        scale = background.page_width / overlay.width
+        values = {'user_name': user_name, 'course_name': course_name}
+
+        packet = StringIO()
+        c = canvas.Canvas(packet, pagesize=(background.page_width, background.page_height))
+        for slot in overlay.slots:
+            if slot.name == "course_name" and self.per_course:
+                continue
+            text = slot.prefix + values[slot.name] + slot.suffix
+            x = slot.x * scale
+            y = background.page_height - slot.y * scale
+            c.setFont(slot.font_name(), slot.font_size * scale)
+            c.setFillColor(HexColor(slot.fill) if slot.fill.startswith("#") else slot.fill)
+            if slot.anchor == "middle":
+                c.drawCentredString(x, y, text)
+            elif slot.anchor == "end":
+                c.drawRightString(x, y, text)
+            else:
+                c.drawString(x, y, text)
+        c.save()
+        packet.seek(0)
+
+        page = PdfFileReader(StringIO(background.pdf)).getPage(0)
+        page.mergePage(PdfFileReader(packet).getPage(0))
+        writer = PdfFileWriter()
+        writer.addPage(page)
+        output = StringIO()
+        writer.write(output)
+        return output.getvalue()
+
+
+_overlay_renderer = None
+_overlay_lock = threading.Lock()
+
+
+def get_renderer():
+    global _overlay_renderer
+    with _overlay_lock:
+        if _overlay_renderer is None:
+            _overlay_renderer = OverlayRenderer(settings.OVERLAY_BACKGROUND_DIR,
+                                                settings.OVERLAY_MAX_BACKGROUNDS,
+                                                settings.OVERLAY_PER_COURSE_BACKGROUND)
+        return _overlay_renderer
@@ -0,0 +1,211 @@
+"""
+Thread based staged pipeline.
+
+A Pipeline runs a source stage and a chain of processing stages, each with its
+own number of worker threads, joined by bounded queues.  A full queue blocks the
+stage feeding it, so a slow stage pushes back on everything upstream instead of
+letting work pile up in memory.  Queue depths and the time of every stage call
+are reported to statsd so the bottleneck stage can be spotted.
+"""
+import logging
+import Queue
+import threading
+import time
+
+from statsd import statsd
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+#Sentinel put on a stage queue once all upstream workers are done
+_STOP = object()
+
+#Callables told about every stage call, see add_observer
+_observers = []
+
+
+def add_observer(observer):
+    """
+    Call observer(pipeline_name, stage_name, seconds, count) after every stage
+    call, count being the number of inputs it handled.  Used by benchmarks.
+    """
+    _observers.append(observer)
+
+
+def remove_observer(observer):
+    _observers.remove(observer)
+
+
+def _observe(pipeline_name, stage_name, elapsed, count):
+    for observer in list(_observers):
+        try:
+            observer(pipeline_name, stage_name, elapsed, count)
+        except Exception:
+            log.exception("Error in pipeline observer")
+
+
+class Stage(object):
+    """
+    One step of a Pipeline.
+
+    name - used in logs and metrics tags
+    func - for the source stage, called with no arguments and returns the next
+           input or None once exhausted.  For other stages, called with one input
+           and returns the output passed downstream, or None to drop it.  With
+           batch_size > 1 it is called with a list of inputs and returns a list.
+    workers - number of threads running func
+    batch_size, batch_wait - collect up to batch_size inputs, waiting at most
+           batch_wait seconds after the first one, per call
+    on_error - called with each input whose func call raised
+    """
+    def __init__(self, name, func, workers=1, batch_size=1, batch_wait=0, on_error=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.on_error = on_error
+
+
+class Pipeline(object):
+    def __init__(self, name, source, stages, queue_size, report_interval=5, tags=None):
+        self.name = name
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+        self.tags = tags or []
+        self.queues = [Queue.Queue(maxsize=queue_size) for stage in stages]
+        self._running = dict((stage.name, stage.workers) for stage in [source] + stages)
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def run(self):
+        """
+        Run until the source is exhausted and every stage has drained its queue
+        """
+        threads = [threading.Thread(target=self._run_source, name="{0}-{1}".format(self.name, self.source.name))
+                   for i in xrange(self.source.workers)]
+        for index, stage in enumerate(self.stages):
+            threads.extend(threading.Thread(target=self._run_stage, args=(index,), name="{0}-{1}".format(self.name, stage.name))
+                           for i in xrange(stage.workers))
+        reporter = threading.Thread(target=self._report, name="{0}-report".format(self.name))
+        reporter.daemon = True
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        reporter.start()
+        for thread in threads:
+            thread.join()
+        self._done.set()
+        reporter.join()
+
+    def queue_depths(self):
+        return dict((stage.name, queue.qsize()) for stage, queue in zip(self.stages, self.queues))
+
+    def _report(self):
+        while True:
+            for stage_name, depth in self.queue_depths().items():
+                statsd.gauge("open_ended_assessment.grading_controller.pipeline.queue_depth", depth,
+                             tags=self.tags + ["stage:{0}".format(stage_name)])
+            if self._done.is_set():
+                return
+            self._done.wait(self.report_interval)
+
+    def _emit(self, index, outputs):
+        """
+        Pass the outputs of stage index-1 (or of the source for index 0) downstream
+        """
+        if index >= len(self.queues):
+            return
+        for output in outputs:
+            if output is not None:
+                self.queues[index].put(output)
+
+    def _finish(self, stage, index):
+        """
+        Called when a worker of stage exits.  The last one stops the next stage.
+        """
+        with self._lock:
+            self._running[stage.name] -= 1
+            last = self._running[stage.name] == 0
+        if last and index < len(self.queues):
+            for i in xrange(self.stages[index].workers):
+                self.queues[index].put(_STOP)
+
+    def _fail(self, stage, inputs):
+        log.exception("Error in pipeline {0} stage {1}".format(self.name, stage.name))
+        statsd.increment("open_ended_assessment.grading_controller.pipeline.error",
+                         tags=self.tags + ["stage:{0}".format(stage.name)])
+        if stage.on_error is not None:
+            for value in inputs:
+                try:
+                    stage.on_error(value)
+                except Exception:
+                    log.exception("Error cleaning up after stage {0}".format(stage.name))
+
+    def _timed(self, stage, start, count):
+        elapsed = time.time() - start
+        metrics.histogram("pipeline.stage_time", elapsed, self.tags + ["stage:{0}".format(stage.name)])
+        if _observers:
+            _observe(self.name, stage.name, elapsed, count)
+
+    def _run_source(self):
+        try:
+            while True:
+                start = time.time()
+                try:
+                    value = self.source.func()
+                except Exception:
+                    self._fail(self.source, [])
+                    return
+                if value is None:
+                    return
+                self._timed(self.source, start, 1)
+                self._emit(0, [value])
+        finally:
+            self._finish(self.source, 0)
+
+    def _take(self, stage, queue):
+        """
+        Return (inputs, stopped): up to stage.batch_size inputs from queue, and
+        whether the stop sentinel was seen.
+        """
+        value = queue.get()
+        if value is _STOP:
+            return [], True
+        inputs = [value]
+        deadline = time.time() + stage.batch_wait
+        while len(inputs) < stage.batch_size:
+            try:
+                value = queue.get(timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                break
+            if value is _STOP:
+                return inputs, True
+            inputs.append(value)
+        return inputs, False
+
+    def _run_stage(self, index):
+        stage = self.stages[index]
+        queue = self.queues[index]
+        try:
+            stopped = False
+            while not stopped:
+                inputs, stopped = self._take(stage, queue)
+                if not inputs:
+                    continue
+                start = time.time()
+                try:
+                    if stage.batch_size > 1:
+                        outputs = stage.func(inputs) or []
+                    else:
+                        outputs = [stage.func(inputs[0])]
+                except Exception:
+                    self._fail(stage, inputs)
+                    continue
+                self._timed(stage, start, len(inputs))
+                self._emit(index + 1, outputs)
+        finally:
+            self._finish(stage, index + 1)
@@ -0,0 +1,196 @@
+"""
+On-demand profiling of the worker.
+
+A profiling session profiles the next N submissions, with cProfile, in every
+thread that processes them: the pipeline stage functions and the celery
+render tasks are wrapped with profiled().  Sessions start when a worker starts
+with PROFILE_ITEMS set, or when a worker process receives SIGUSR2.  cProfile
+measures wall clock time, so time blocked on inkscape processes and on network
+calls shows up under the calls that waited; the CPU time used by child
+processes over the session is reported too.  Once the N submissions are done,
+the merged stats and a summary of the top hotspots are written to PROFILE_DIR.
+
+With no session running, a profiled function costs one global lookup per call.
+"""
+from django.conf import settings
+import cProfile
+import logging
+import os
+import pstats
+import resource
+import signal
+import socket
+import threading
+import time
+
+from statsd import statsd
+
+log = logging.getLogger(__name__)
+
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _children_cpu():
+    """
+    CPU seconds used by the child processes of this process, running or reaped.
+    Running children are only counted where /proc is available.
+    """
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    total = usage.ru_utime + usage.ru_stime
+    pid = str(os.getpid())
+    try:
+        pids = [name for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return total
+    for child in pids:
+        try:
+            with open("/proc/{0}/stat".format(child)) as f:
+                #The command name may contain spaces, fields follow its closing paren
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        if fields[1] == pid:
+            total += (int(fields[11]) + int(fields[12])) / float(_CLOCK_TICKS)
+    return total
+
+
+class ProfileSession(object):
+    def __init__(self, items, directory, top=30):
+        self.items = items
+        self.directory = directory
+        self.top = top
+        self.done = 0
+        self.active = 0
+        self.closed = False
+        self.start = time.time()
+        self.start_children_cpu = _children_cpu()
+        self._profiles = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _profile(self):
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+        return profile
+
+    def call(self, func, *args, **kwargs):
+        with self._lock:
+            closed = self.closed
+            if not closed:
+                self.active += 1
+        if closed:
+            return func(*args, **kwargs)
+        profile = self._profile()
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                self.active -= 1
+                dump = self.closed and self.active == 0
+            if dump:
+                self.dump()
+
+    def item_done(self):
+        with self._lock:
+            self.done += 1
+            if self.closed or self.done < self.items:
+                return
+            self.closed = True
+            dump = self.active == 0
+        if dump:
+            self.dump()
+
+    def dump(self):
+        """
+        Write the merged stats and the hotspot summary.  Runs once all profiled
+        calls have returned.
+        """
+        global _session
+        with _session_lock:
+            if _session is self:
+                _session = None
+        if not self._profiles:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        base = os.path.join(self.directory, "profile-{0}-{1}-{2}".format(socket.gethostname(), os.getpid(),
+                                                                        time.strftime("%Y%m%d-%H%M%S")))
+        stats = pstats.Stats(*self._profiles)
+        stats.dump_stats(base + ".prof")
+        with open(base + ".txt", 'w') as f:
+            f.write("Items profiled: {0}\n".format(self.done))
+            f.write("Wall time: {0:.3f}s\n".format(time.time() - self.start))
+            f.write("Child process CPU time: {0:.3f}s\n".format(_children_cpu() - self.start_children_cpu))
+            f.write("Threads profiled: {0}\n\n".format(len(self._profiles)))
+            stats.stream = f
+            f.write("Top {0} by own time, including time waiting:\n".format(self.top))
+            stats.sort_stats('time').print_stats(self.top)
+            f.write("Top {0} by cumulative time:\n".format(self.top))
+            stats.sort_stats('cumulative').print_stats(self.top)
+        log.info("Profile of {0} items written to {1}.prof, summary in {1}.txt".format(self.done, base))
+        statsd.increment("open_ended_assessment.grading_controller.profiling.dump")
+
+
+_session = None
+_session_lock = threading.Lock()
+_setup_pid = None
+
+
+def start(items):
+    """
+    Profile the next items submissions, unless a session is already running
+    """
+    global _session
+    if items <= 0:
+        return
+    with _session_lock:
+        if _session is None:
+            _session = ProfileSession(items, settings.PROFILE_DIR, settings.PROFILE_TOP)
+            log.info("Profiling the next {0} items".format(items))
+
+
+def profiled(func):
+    """
+    Run func, any callable, under the current profiling session, if any
+    """
+    def wrapper(*args, **kwargs):
+        session = _session
+        if session is None:
+            return func(*args, **kwargs)
+        return session.call(func, *args, **kwargs)
+    return wrapper
+
+
+def item_done():
+    """
+    Count a submission as processed, successfully or not
+    """
+    session = _session
+    if session is not None:
+        session.item_done()
+
+
+def _on_signal(signum, frame):
+    #Not from the handler itself: the interrupted main thread may hold _session_lock
+    threading.Thread(target=start, args=(settings.PROFILE_SIGNAL_ITEMS,), name="profiling-start").start()
+
+
+def setup():
+    """
+    Once per worker process: listen for SIGUSR2 and start the PROFILE_ITEMS
+    session.  The handler can only be installed from the main thread.
+    """
+    global _setup_pid
+    if _setup_pid == os.getpid():
+        return
+    _setup_pid = os.getpid()
+    try:
+        signal.signal(signal.SIGUSR2, _on_signal)
+    except ValueError:
+        log.warning("Not in the main thread, SIGUSR2 will not start profiling")
+    start(settings.PROFILE_ITEMS)
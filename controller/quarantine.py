@@ -0,0 +1,231 @@
+"""
+Quarantine for poison submissions.
+
+Submissions are checked before any work is spent on them: both xqueue fields
+must be JSON objects, the body must carry the fields a certificate is built
+from, the names must be text an svg can hold and the template must exist.  A
+submission failing the check can never succeed and goes straight to the
+dead-letter store.  One that passes but keeps failing to assemble or render
+is buried after QUARANTINE_MAX_FAILURES failures, counted in the django cache
+across workers and runs.  xqueue hands buried submissions out again, they are
+then dropped on sight instead of taking render capacity.
+
+The dead-letter store is an SQLite database at QUARANTINE_PATH holding each
+buried submission with the reason, for an operator to inspect and release
+with manage.py dead_letters.
+"""
+from django.conf import settings
+from django.core.cache import cache
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from statsd import statsd
+
+from . import template_registry
+
+log = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dead_letters (
+    key TEXT PRIMARY KEY,
+    queue_name TEXT,
+    header TEXT,
+    body TEXT,
+    reason TEXT NOT NULL,
+    failures INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    deliveries INTEGER NOT NULL DEFAULT 1
+)
+"""
+
+#Fields of the xqueue body a certificate is built from
+REQUIRED_FIELDS = ("student_id", "student_name", "course_name", "template_pdf")
+
+#Characters XML 1.0, hence svg, cannot hold even escaped
+_INVALID_XML_CHARS = re.compile(u"[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+
+class DeadLetters(object):
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_SCHEMA)
+
+    def add(self, key, queue_name, header, body, reason, failures):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO dead_letters "
+                               "(key, queue_name, header, body, reason, failures, created, last_seen) "
+                               "VALUES (?, ?, ?, ?, ?, ?, COALESCE((SELECT created FROM dead_letters WHERE key = ?), ?), ?)",
+                               (key, queue_name, header, body, reason, failures, key, now, now))
+
+    def contains(self, key):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM dead_letters WHERE key = ?", (key,)).fetchone() is not None
+
+    def seen(self, key):
+        """
+        Count another delivery of buried submission key
+        """
+        with self._lock:
+            self._conn.execute("UPDATE dead_letters SET deliveries = deliveries + 1, last_seen = ? WHERE key = ?",
+                               (time.time(), key))
+
+    def entries(self):
+        """
+        (key, queue_name, header, body, reason, failures, created, last_seen, deliveries) tuples, oldest first
+        """
+        with self._lock:
+            return self._conn.execute("SELECT key, queue_name, header, body, reason, failures, created, last_seen, "
+                                      "deliveries FROM dead_letters ORDER BY created").fetchall()
+
+    def remove(self, key):
+        with self._lock:
+            return self._conn.execute("DELETE FROM dead_letters WHERE key = ?", (key,)).rowcount > 0
+
+
+_store = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store, _store_pid
+    with _store_lock:
+        if _store is None or _store_pid != os.getpid():
+            _store = DeadLetters(settings.QUARANTINE_PATH)
+            _store_pid = os.getpid()
+        return _store
+
+
+def _load_object(text, name):
+    try:
+        value = json.loads(text)
+    except (TypeError, ValueError):
+        return None, "{0} is not valid JSON".format(name)
+    if not isinstance(value, dict):
+        return None, "{0} is not a JSON object".format(name)
+    return value, ""
+
+
+def validate(content):
+    """
+    Check a parsed queue object before any render work.  Returns (success, reason).
+    """
+    if not isinstance(content, dict):
+        return False, "Queue object is not a dict"
+    header, reason = _load_object(content.get("xqueue_header"), "xqueue_header")
+    if header is None:
+        return False, reason
+    body, reason = _load_object(content.get("xqueue_body"), "xqueue_body")
+    if body is None:
+        return False, reason
+
+    missing = [field for field in REQUIRED_FIELDS if body.get(field) in (None, "")]
+    if missing:
+        return False, "xqueue_body is missing {0}".format(", ".join(missing))
+    for field in ("student_name", "course_name", "template_pdf"):
+        if not isinstance(body[field], basestring):
+            return False, "{0} is not a string".format(field)
+        if _INVALID_XML_CHARS.search(body[field]):
+            return False, "{0} holds characters an svg cannot".format(field)
+
+    template = template_registry.template_filename(body["template_pdf"])
+    if os.path.basename(template) != template:
+        return False, u"Template name {0} is not a file name".format(template)
+    if not os.path.isfile(template_registry.registry.source_path(template)):
+        return False, u"Template {0} does not exist".format(template)
+    return True, ""
+
+
+def _failures_key(key):
+    return "submission-failures-{0}".format(key)
+
+
+def _buried_key(key):
+    return "submission-buried-{0}".format(key)
+
+
+def _queue_name(content):
+    try:
+        return json.loads(content["xqueue_header"]).get("queue_name")
+    except Exception:
+        return None
+
+
+def is_buried(key):
+    """
+    Whether submission key is quarantined, on this node or, while the cache
+    remembers it, on another one.  Every submission is checked, so this only
+    reads.
+    """
+    return get_store().contains(key) or bool(cache.get(_buried_key(key)))
+
+
+def dropped(key):
+    """
+    Count a delivery of buried submission key that was dropped on sight
+    """
+    get_store().seen(key)
+    statsd.increment("open_ended_assessment.grading_controller.quarantine.dropped")
+
+
+def bury(key, content, reason, failures=0):
+    """
+    Move submission key to the dead-letter store.  content is the parsed queue
+    object, or the raw one if it could not be parsed.
+    """
+    if isinstance(content, dict):
+        header, body = content.get("xqueue_header"), content.get("xqueue_body")
+    else:
+        header, body = None, content
+    queue_name = _queue_name(content) if isinstance(content, dict) else None
+    log.error(u"Quarantining submission {0} after {1} failures: {2}".format(key, failures, reason))
+    get_store().add(key, queue_name, header, body, reason, failures)
+    cache.set(_buried_key(key), True, settings.QUARANTINE_FAILURE_TTL)
+    cache.delete(_failures_key(key))
+    statsd.increment("open_ended_assessment.grading_controller.quarantine.buried",
+                     tags=["queue_name:{0}".format(queue_name), "invalid:{0}".format(failures == 0)])
+
+
+def record_failure(key, content, reason):
+    """
+    Count a failure of a valid submission to assemble or render.  Buries it
+    once it failed QUARANTINE_MAX_FAILURES times within
+    QUARANTINE_FAILURE_TTL.  Returns whether it was buried.
+    """
+    cache_key = _failures_key(key)
+    cache.add(cache_key, 0, settings.QUARANTINE_FAILURE_TTL)
+    try:
+        failures = cache.incr(cache_key)
+    except ValueError:
+        #Expired in between
+        cache.set(cache_key, 1, settings.QUARANTINE_FAILURE_TTL)
+        failures = 1
+    statsd.increment("open_ended_assessment.grading_controller.quarantine.failure")
+    if failures < settings.QUARANTINE_MAX_FAILURES:
+        log.warning(u"Submission {0} failed ({1} of {2}): {3}".format(key, failures, settings.QUARANTINE_MAX_FAILURES,
+                                                                      reason))
+        return False
+    bury(key, content, reason, failures)
+    return True
+
+
+def release(key):
+    """
+    Take submission key out of quarantine, so its next delivery is processed
+    """
+    cache.delete(_buried_key(key))
+    cache.delete(_failures_key(key))
+    return get_store().remove(key)
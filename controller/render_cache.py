@@ -0,0 +1,134 @@
+"""
+Content addressed cache of rendered certificates.
+
+A certificate is fully determined by its template, the user and course names
+and the renderer, so regenerated or redelivered submissions can reuse the pdf
+(and the url it was uploaded to) instead of going through inkscape again.
+Entries live in a size bounded directory and the least recently used ones are
+evicted first.
+"""
+from django.conf import settings
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def cache_key(template_digest, user_name, course_name, renderer_version):
+    h = hashlib.sha1()
+    for part in (template_digest, user_name, course_name, renderer_version):
+        h.update(part.encode("utf8") if isinstance(part, unicode) else part)
+        h.update("\0")
+    return h.hexdigest()
+
+
+class RenderCache(object):
+    """
+    Disk store of <key>.pdf files with a <key>.json sidecar holding the last
+    url the pdf was uploaded to.  The pdf mtime is the LRU clock.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _paths(self, key):
+        return os.path.join(self.directory, key + ".pdf"), os.path.join(self.directory, key + ".json")
+
+    def _entries(self):
+        """
+        Return [(mtime, size, key)] for every cached pdf
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pdf"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name[:-len(".pdf")]))
+        return entries
+
+    def get(self, key):
+        """
+        Return (pdf_path, metadata) for key, or None on a miss
+        """
+        pdf_path, meta_path = self._paths(key)
+        try:
+            os.utime(pdf_path, None)
+            with open(meta_path) as f:
+                metadata = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        return pdf_path, metadata
+
+    def put(self, key, pdf_data, url):
+        """
+        Store pdf_data and the url it was uploaded to
+        """
+        cached_pdf, meta_path = self._paths(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(pdf_data)
+            #A put over an existing entry replaces its size
+            try:
+                replaced = os.path.getsize(cached_pdf)
+            except OSError:
+                replaced = 0
+            os.rename(tmp_path, cached_pdf)
+            with open(meta_path + ".tmp", 'w') as f:
+                json.dump({'url': url, 'url_time': time.time()}, f)
+            os.rename(meta_path + ".tmp", meta_path)
+        except (IOError, OSError):
+            log.exception("Could not store render cache entry {0}".format(key))
+            for path in (tmp_path, meta_path + ".tmp"):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for mtime, size, name in self._entries())
+            else:
+                self._size += len(pdf_data) - replaced
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        Rescans the directory since other worker processes share it.
+        """
+        entries = sorted(self._entries())
+        self._size = sum(size for mtime, size, key in entries)
+        for mtime, size, key in entries:
+            if self._size <= self.max_bytes:
+                break
+            for path in self._paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._size -= size
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = RenderCache(settings.RENDER_CACHE_DIR, settings.RENDER_CACHE_MAX_BYTES)
+        return _cache
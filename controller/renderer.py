@@ -0,0 +1,404 @@
+"""
+Svg to pdf rendering through a pool of long-lived Inkscape processes.
+
+Starting Inkscape (fonts, GTK) costs far more than converting one certificate,
+so the processes are kept running in --shell mode and fed one export command
+per job.  A process is replaced after INKSCAPE_MAX_JOBS_PER_PROCESS jobs, or as
+soon as it crashes or stops answering with a prompt.
+
+Every render has a deadline, RENDER_TIMEOUT seconds or the template's entry in
+RENDER_TEMPLATE_TIMEOUTS.  An inkscape that misses it is killed along with its
+children and the render is retried once on a fresh process, so one hung
+conversion costs a bounded delay instead of stalling the queue.
+"""
+from django.conf import settings
+from subprocess import Popen, PIPE
+import atexit
+import logging
+import os
+import Queue
+import select
+import threading
+import time
+
+from statsd import statsd
+
+from . import util
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+SHELL_PROMPT = ">"
+#Error of the jobs left unfinished when inkscape died during a batch
+BATCH_FAILED = "Batch render failed"
+#Error of a job that missed its deadline on a fresh inkscape too
+TIMED_OUT = "Render timed out"
+#Seconds inkscape gets to quit before it is killed
+CLOSE_TIMEOUT = 5
+
+
+class RenderTimeout(util.ProcessTimeout):
+    """
+    Raised when inkscape misses a deadline.  errors holds the results of the
+    jobs of the batch that finished before it.
+    """
+    def __init__(self, msg, errors=None):
+        util.ProcessTimeout.__init__(self, msg)
+        self.errors = errors or []
+
+
+class RenderFailed(OSError):
+    """
+    Raised when inkscape dies during a batch.  errors holds the results of the
+    jobs of the batch that finished before it.
+    """
+    def __init__(self, msg, errors=None):
+        OSError.__init__(self, msg)
+        self.errors = errors or []
+
+
+def render_timeout(template):
+    """
+    Deadline in seconds for rendering template
+    """
+    return settings.RENDER_TEMPLATE_TIMEOUTS.get(os.path.basename(template), settings.RENDER_TIMEOUT)
+
+
+class InkscapeProcess(object):
+    """
+    One Inkscape process in shell mode.  Not thread safe, the pool hands each
+    process to a single caller at a time.
+    """
+    def __init__(self, inkscape_path):
+        self.jobs_done = 0
+        self._devnull = open(os.devnull, 'w')
+        #In its own process group, so a hung inkscape is killed with its children
+        self.process = Popen([inkscape_path, '--without-gui', '--shell'],
+                             stdin=PIPE, stdout=PIPE, stderr=self._devnull, close_fds=True,
+                             preexec_fn=os.setsid)
+        try:
+            self._read_prompt(time.time() + settings.RENDER_TIMEOUT)
+        except OSError:
+            self.kill()
+            self._devnull.close()
+            raise
+        log.info("Started inkscape shell, pid {0}".format(self.process.pid))
+
+    def _read_prompt(self, deadline):
+        """
+        Read stdout until inkscape shows its prompt again, raise OSError if it
+        exits and RenderTimeout if the deadline passes first
+        """
+        output = ""
+        fd = self.process.stdout.fileno()
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise RenderTimeout("Inkscape shell pid {0} did not answer in time".format(self.process.pid))
+            data = os.read(fd, 1)
+            if not data:
+                raise OSError("Inkscape shell exited with returncode {0}".format(self.process.poll()))
+            output += data
+            if output == SHELL_PROMPT or output.endswith("\n" + SHELL_PROMPT):
+                return output
+
+    def _wait_exit(self, deadline):
+        """
+        Read stdout until inkscape closes it and wait for it to exit, raise
+        RenderTimeout if the deadline passes first
+        """
+        fd = self.process.stdout.fileno()
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise RenderTimeout("Inkscape shell pid {0} did not quit in time".format(self.process.pid))
+            if not os.read(fd, 4096):
+                break
+        while self.process.poll() is None:
+            if time.time() > deadline:
+                raise RenderTimeout("Inkscape shell pid {0} did not quit in time".format(self.process.pid))
+            time.sleep(0.01)
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def export_pdfs(self, jobs, timeouts):
+        """
+        Send every (svg_path, pdf_path) job to inkscape in one write and collect
+        the prompts.  Returns one error message, or None on success, per job.
+        Inkscape works through the jobs in order, so each one has timeouts[i]
+        seconds from the previous prompt.  Raises RenderTimeout, after killing
+        inkscape, when a job takes longer, and OSError if inkscape died before
+        answering every job, RenderFailed if it died during the batch.
+        """
+        commands = "".join("{0} --export-pdf={1}\n".format(svg_path, pdf_path) for svg_path, pdf_path in jobs)
+        try:
+            self.process.stdin.write(commands)
+            self.process.stdin.flush()
+        except (IOError, OSError) as e:
+            raise RenderFailed("Could not send the batch to inkscape: {0}".format(e))
+        errors = []
+        for (svg_path, pdf_path), timeout in zip(jobs, timeouts):
+            try:
+                self._read_prompt(time.time() + timeout)
+            except RenderTimeout as e:
+                self.kill()
+                raise RenderTimeout("Render of {0} took more than {1}s: {2}".format(svg_path, timeout, e), errors)
+            except OSError as e:
+                #The pdf of the job it died on may be truncated
+                raise RenderFailed(str(e), errors)
+            self.jobs_done += 1
+            if not os.path.exists(pdf_path) or os.path.getsize(pdf_path) == 0:
+                errors.append("Inkscape did not export {0}".format(pdf_path))
+            else:
+                errors.append(None)
+        return errors
+
+    def kill(self):
+        util.kill_process_tree(self.process)
+        self.process.wait()
+
+    def close(self):
+        if self.is_alive():
+            try:
+                self.process.stdin.write("quit\n")
+                self.process.stdin.close()
+                self._wait_exit(time.time() + CLOSE_TIMEOUT)
+            except (IOError, OSError, ValueError):
+                self.kill()
+        self._devnull.close()
+
+
+class RendererPool(object):
+    """
+    Bounded pool of warm InkscapeProcess objects, started lazily.
+    """
+    def __init__(self, inkscape_path, size, max_jobs_per_process):
+        self.inkscape_path = inkscape_path
+        self.size = size
+        self.max_jobs_per_process = max_jobs_per_process
+        self._idle = Queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+        self._processes = []
+
+    def _acquire(self):
+        while True:
+            try:
+                return self._idle.get(block=False)
+            except Queue.Empty:
+                pass
+            with self._lock:
+                can_start = self._started < self.size
+                if can_start:
+                    self._started += 1
+            if can_start:
+                try:
+                    return self._spawn()
+                except Exception:
+                    with self._lock:
+                        self._started -= 1
+                    raise
+            #Wake up regularly in case a recycled process freed a slot
+            try:
+                return self._idle.get(timeout=1)
+            except Queue.Empty:
+                continue
+
+    def _spawn(self):
+        statsd.increment("open_ended_assessment.grading_controller.renderer.spawn")
+        process = InkscapeProcess(self.inkscape_path)
+        with self._lock:
+            self._processes.append(process)
+        return process
+
+    def _discard(self, process):
+        process.close()
+        with self._lock:
+            self._processes.remove(process)
+            self._started -= 1
+
+    def _release(self, process, healthy):
+        if not healthy or not process.is_alive() or process.jobs_done >= self.max_jobs_per_process:
+            log.info("Recycling inkscape shell pid {0} after {1} jobs".format(process.process.pid, process.jobs_done))
+            self._discard(process)
+            statsd.increment("open_ended_assessment.grading_controller.renderer.recycle",
+                             tags=["healthy:{0}".format(healthy)])
+        else:
+            self._idle.put(process)
+
+    def render_pdf(self, svg_path, pdf_path, timeout):
+        """
+        Render svg_path to pdf_path on a pooled process.  Raises OSError on failure.
+        """
+        error = self.render_pdfs([(svg_path, pdf_path)], [timeout])[0]
+        if error is not None:
+            raise OSError("Render of {0} failed: {1}".format(svg_path, error))
+
+    def render_pdfs(self, jobs, timeouts):
+        """
+        Render a batch of (svg_path, pdf_path) jobs, with timeouts[i] seconds
+        for job i, on one pooled process.  Returns one error message, or None on
+        success, per job.  A job that times out is retried once on a fresh
+        process, along with the jobs queued behind it.
+        """
+        errors = [None] * len(jobs)
+        pending = range(len(jobs))
+        retried = set()
+        while pending:
+            process = self._acquire()
+            healthy = False
+            try:
+                done = process.export_pdfs([jobs[i] for i in pending], [timeouts[i] for i in pending])
+                healthy = True
+            except RenderTimeout as e:
+                for i, error in zip(pending, e.errors):
+                    errors[i] = error
+                pending = pending[len(e.errors):]
+                late = pending[0]
+                final = late in retried
+                statsd.increment("open_ended_assessment.grading_controller.renderer.timeout",
+                                 tags=["retried:{0}".format(final)])
+                if final:
+                    log.error("{0}, giving up".format(e))
+                    errors[late] = "{0}: {1}".format(TIMED_OUT, e)
+                    pending = pending[1:]
+                else:
+                    log.warning("{0}, retrying on a fresh inkscape".format(e))
+                    statsd.increment("open_ended_assessment.grading_controller.renderer.retry")
+                    retried.add(late)
+                continue
+            except (IOError, OSError) as e:
+                #Only the jobs answered before inkscape died are done
+                done = e.errors if isinstance(e, RenderFailed) else []
+                for i, error in zip(pending, done):
+                    errors[i] = error
+                for i in pending[len(done):]:
+                    errors[i] = "{0}: {1}".format(BATCH_FAILED, e)
+                pending = []
+                continue
+            finally:
+                self._release(process, healthy)
+            for i, error in zip(pending, done):
+                errors[i] = error
+            pending = []
+        return errors
+
+    def utilization(self):
+        with self._lock:
+            started = self._started
+        busy = max(started - self._idle.qsize(), 0)
+        return {'size': self.size, 'started': started, 'busy': busy}
+
+    def close(self):
+        with self._lock:
+            processes = list(self._processes)
+        for process in processes:
+            process.close()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return this process' renderer pool.  Celery forks its workers, so a pool is
+    never shared across a fork.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = RendererPool(settings.INKSCAPE_PATH,
+                                 settings.INKSCAPE_POOL_SIZE,
+                                 settings.INKSCAPE_MAX_JOBS_PER_PROCESS)
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def pool_utilization():
+    """
+    Size, started and busy processes of this process' renderer pool, if it has one
+    """
+    if _pool is None or _pool_pid != os.getpid():
+        return None
+    return _pool.utilization()
+
+metrics.add_source("renderer_pool", pool_utilization)
+
+
+def render_pdf(svg_path, pdf_path, timeout=None):
+    """
+    Render svg_path to pdf_path within timeout seconds, RENDER_TIMEOUT by
+    default.  Raises OSError on failure.
+    """
+    timeout = timeout or settings.RENDER_TIMEOUT
+    if settings.INKSCAPE_SHELL_MODE:
+        get_pool().render_pdf(svg_path, pdf_path, timeout)
+        return
+
+    for attempt in (1, 2):
+        x = Popen([settings.INKSCAPE_PATH, svg_path, '--export-pdf=%s' % pdf_path], preexec_fn=os.setsid)
+        try:
+            util.waitForResponse(x, timeout)
+            return
+        except util.ProcessTimeout as e:
+            statsd.increment("open_ended_assessment.grading_controller.renderer.timeout",
+                             tags=["retried:{0}".format(attempt == 2)])
+            if attempt == 2:
+                log.error("Render of {0} timed out again, giving up".format(svg_path))
+                raise
+            log.warning("Render of {0} timed out, retrying: {1}".format(svg_path, e))
+            statsd.increment("open_ended_assessment.grading_controller.renderer.retry")
+
+
+def render_pdfs(jobs, timeouts=None):
+    """
+    Render a batch of (svg_path, pdf_path) jobs, with timeouts[i] seconds for
+    job i, RENDER_TIMEOUT by default.  Returns one error message, or None on
+    success, per job.
+    """
+    timeouts = [timeout or settings.RENDER_TIMEOUT for timeout in (timeouts or [None] * len(jobs))]
+    if settings.INKSCAPE_SHELL_MODE:
+        return get_pool().render_pdfs(jobs, timeouts)
+
+    errors = []
+    for (svg_path, pdf_path), timeout in zip(jobs, timeouts):
+        try:
+            render_pdf(svg_path, pdf_path, timeout)
+            errors.append(None)
+        except util.ProcessTimeout as e:
+            errors.append("{0}: {1}".format(TIMED_OUT, e))
+        except OSError as e:
+            if e.errno is not None:
+                #inkscape could not be started at all, like a pool failing to spawn one
+                raise
+            errors.append(str(e))
+    return errors
+
+
+_version = None
+
+
+def renderer_version():
+    """
+    Version string of the configured inkscape, used to key cached renders
+    """
+    global _version
+    if _version is None:
+        try:
+            with open(os.devnull, 'w') as devnull:
+                output = Popen([settings.INKSCAPE_PATH, '--version'], stdout=PIPE, stderr=devnull).communicate()[0]
+            _version = output.strip() or settings.INKSCAPE_PATH
+        except OSError:
+            log.exception("Could not get the inkscape version")
+            return settings.INKSCAPE_PATH
+    return _version
+
+
+def _close_pool():
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close()
+
+atexit.register(_close_pool)
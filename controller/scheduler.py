@@ -0,0 +1,80 @@
+"""
+Adaptive xqueue polling.
+
+A queue that had work is polled again right away, so a steady stream of
+submissions is drained continuously.  Every poll that finds the queue empty
+doubles the wait before the next one, up to a ceiling, so idle queues cost
+few requests.  A little jitter keeps workers polling the same queue from
+moving in lockstep.
+"""
+import random
+import time
+
+from statsd import statsd
+
+
+class QueuePoller(object):
+    """
+    Poll schedule of one queue.
+
+    The last poll that found the queue empty bounds when the next submission
+    could have landed, so the time from it to the first render after the queue
+    has work again is reported as the time to first render.
+    """
+    def __init__(self, queue_name, min_interval, max_interval, jitter=0.1):
+        self.queue_name = queue_name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.delay = 0
+        self.next_poll = 0
+        self.last_empty = None
+        self._waiting_since = None
+
+    def due(self, now=None):
+        return (now or time.time()) >= self.next_poll
+
+    def found_empty(self, now=None):
+        """
+        Back off after a poll that found nothing
+        """
+        now = now or time.time()
+        self.last_empty = now
+        self.delay = min(self.max_interval, max(self.min_interval, self.delay * 2))
+        self.next_poll = now + self.delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def found_items(self, now=None):
+        """
+        Poll again immediately after a poll that found work
+        """
+        now = now or time.time()
+        if self._waiting_since is None and self.last_empty is not None:
+            self._waiting_since = self.last_empty
+        self.delay = 0
+        self.next_poll = now
+
+    def rendered(self, now=None):
+        """
+        Called after each render, reports the time to first render once per
+        idle to busy transition
+        """
+        if self._waiting_since is None:
+            return
+        now = now or time.time()
+        statsd.histogram("open_ended_assessment.grading_controller.scheduler.time_to_first_render",
+                         now - self._waiting_since, tags=["queue_name:{0}".format(self.queue_name)])
+        self._waiting_since = None
+
+
+def wait_for_next(pollers, deadline):
+    """
+    Sleep until the first of pollers is due, or until deadline.  Returns False
+    once the deadline has passed.
+    """
+    now = time.time()
+    if now >= deadline:
+        return False
+    next_poll = min(poller.next_poll for poller in pollers)
+    if next_poll > now:
+        time.sleep(min(next_poll, deadline) - now)
+    return time.time() < deadline
@@ -0,0 +1,175 @@
+"""
+Bounded scratch space for the files inkscape reads and writes.
+
+Inkscape's shell mode only takes file names, so the assembled svg and the pdf
+it exports still need paths.  They are kept in a per-process directory under
+SCRATCH_DIR, tmpfs (/dev/shm) by default, so they never reach the disk: the
+pdf is read back once into memory and uploaded from that buffer.  The space
+used is capped at SCRATCH_QUOTA_BYTES per process; allocations wait for room,
+up to SCRATCH_WAIT seconds, which pushes back on the assembly stage instead of
+filling up memory.  Every allocation is undone by release().  The directories
+of dead processes are removed, but for the files their journal still points
+to, which stay until the submission is resumed.
+"""
+from django.conf import settings
+import errno
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from statsd import statsd
+
+from . import journal
+
+log = logging.getLogger(__name__)
+
+
+class ScratchFull(Exception):
+    pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+class ScratchSpace(object):
+    def __init__(self, directory, quota, wait):
+        self.directory = directory
+        self.quota = quota
+        self.wait = wait
+        self.used = 0
+        self._sizes = {}
+        self._cond = threading.Condition()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _reserve(self, nbytes):
+        """
+        Account for nbytes, waiting for other allocations to be released if
+        the quota is used up.  A single allocation larger than the quota is let
+        through once the space is empty.
+        """
+        deadline = time.time() + self.wait
+        with self._cond:
+            while self.used and self.used + nbytes > self.quota:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    statsd.increment("open_ended_assessment.grading_controller.scratch.full")
+                    raise ScratchFull("Scratch space {0} full: {1} of {2} bytes used".format(
+                        self.directory, self.used, self.quota))
+                self._cond.wait(remaining)
+            self.used += nbytes
+
+    def _unreserve(self, nbytes):
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+    def allocate(self, suffix, nbytes):
+        """
+        Return the path of a new empty file with room for nbytes, e.g. for a
+        renderer to write to
+        """
+        self._reserve(nbytes)
+        try:
+            fd, path = tempfile.mkstemp(suffix=suffix, dir=self.directory)
+            os.close(fd)
+        except Exception:
+            self._unreserve(nbytes)
+            raise
+        with self._cond:
+            self._sizes[path] = nbytes
+        return path
+
+    def write(self, suffix, data):
+        """
+        Return the path of a new file holding data
+        """
+        path = self.allocate(suffix, len(data))
+        try:
+            with open(path, 'wb') as f:
+                f.write(data)
+        except Exception:
+            self.release(path)
+            raise
+        return path
+
+    def release(self, path):
+        """
+        Remove path and give back its room.  Files of other processes, e.g.
+        recovered from the journal of a dead worker, are only removed.
+        """
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        with self._cond:
+            nbytes = self._sizes.pop(path, 0)
+        if nbytes:
+            self._unreserve(nbytes)
+
+
+def _remove_dead(root, keep=None):
+    """
+    Remove the scratch directories of dead processes.  keep holds the files
+    the journal still points to: they and their directory are left for the
+    submission to be resumed, every other file goes.
+    """
+    for name in os.listdir(root):
+        if not name.startswith("certificates-"):
+            continue
+        try:
+            pid = int(name[len("certificates-"):])
+        except ValueError:
+            continue
+        if pid == os.getpid() or _pid_alive(pid):
+            continue
+        path = os.path.join(root, name)
+        if keep is None:
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        try:
+            filenames = os.listdir(path)
+        except OSError:
+            continue
+        for filename in filenames:
+            file_path = os.path.join(path, filename)
+            if os.path.normpath(file_path) not in keep:
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
+
+
+_scratch = None
+_scratch_pid = None
+_scratch_lock = threading.Lock()
+
+
+def get_scratch():
+    """
+    Return this process' scratch space
+    """
+    global _scratch, _scratch_pid
+    with _scratch_lock:
+        if _scratch is None or _scratch_pid != os.getpid():
+            directory = os.path.join(settings.SCRATCH_DIR, "certificates-{0}".format(os.getpid()))
+            _scratch = ScratchSpace(directory, settings.SCRATCH_QUOTA_BYTES, settings.SCRATCH_WAIT)
+            _scratch_pid = os.getpid()
+            try:
+                keep = journal.referenced_paths(settings.JOURNAL_DIR) if settings.JOURNAL_ENABLED else None
+                _remove_dead(settings.SCRATCH_DIR, keep)
+            except OSError:
+                log.exception("Could not clean up {0}".format(settings.SCRATCH_DIR))
+        return _scratch
@@ -1,17 +1,23 @@
 import functools
-from django.core.cache import cache
 
-def single_instance_task(timeout):
+from . import leases
+
+def single_instance_task(timeout, instances=1):
+    """
+    Run the task only if one of its instances lease slots is free.  The lease
+    is renewed while the task runs and expires timeout seconds after a worker
+    running it dies.
+    """
     def task_exc(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             lock_id = "celery-single-instance-" + func.__name__
-            acquire_lock = lambda: cache.add(lock_id, "true", timeout)
-            release_lock = lambda: cache.delete(lock_id)
-            if acquire_lock():
+            lease = leases.acquire_slot(lock_id, instances, timeout)
+            if lease is not None:
                 try:
-                    func(*args, **kwargs)
+                    with leases.Heartbeat([lease]):
+                        func(*args, **kwargs)
                 finally:
-                    release_lock()
+                    lease.release()
         return wrapper
     return task_exc
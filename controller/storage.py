@@ -0,0 +1,456 @@
+"""
+Storage backends for the rendered certificates, chosen by STORAGE_BACKEND.
+
+"s3": S3Storage.  Connections are kept per thread and reused between uploads,
+the bucket handle is looked up once, and content, ACL and metadata go out in a
+single PUT.  Setting S3_HOST points the client at a local S3 stand-in (path
+style addressing, optional plain http).
+
+"local": LocalStorage, files under STORAGE_LOCAL_DIR served from
+STORAGE_LOCAL_URL.  Needs no network, e.g. for tests and benchmarks.
+
+"write_behind": WriteBehindStorage.  The certificate is written locally and
+its S3 url, computed without a request, is posted back right away.  A
+background replicator uploads it to S3, retrying with exponential backoff from
+a durable SQLite log at STORAGE_REPLICATION_LOG, so S3 latency and outages are
+off the critical path.  The url resolves once the replica is up.  A
+certificate not replicated within STORAGE_REPLICATION_MAX_AGE is given up on,
+its local copy is kept for an operator.
+"""
+from django.conf import settings
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib
+import uuid
+
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+from boto.s3.key import Key
+from statsd import statsd
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+
+class Storage(object):
+    """
+    Interface of the storage backends
+    """
+    def upload(self, data, key_name, filename, expires_in):
+        """
+        Store data under key_name, with filename as its download name.
+        Returns a url valid for at least expires_in seconds.
+        """
+        raise NotImplementedError
+
+    def url_if_exists(self, key_name, expires_in):
+        """
+        Return a url valid for expires_in seconds if key_name was already
+        stored, else None
+        """
+        raise NotImplementedError
+
+
+class S3Storage(Storage):
+    def __init__(self, access_key, secret_key, bucket_name, host=None, port=None, is_secure=True,
+                 create_bucket=True, signed_urls=True):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.bucket_name = bucket_name.lower()
+        self.host = host
+        self.port = port
+        self.is_secure = is_secure
+        self.create_bucket = create_bucket
+        self.signed_urls = signed_urls
+        self._local = threading.local()
+        self._bucket_checked = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        kwargs = {'is_secure': self.is_secure}
+        if self.host:
+            kwargs.update(host=self.host, calling_format=OrdinaryCallingFormat())
+        if self.port:
+            kwargs['port'] = self.port
+        return S3Connection(self.access_key, self.secret_key, **kwargs)
+
+    def _ensure_bucket(self, conn):
+        """
+        Create the bucket if needed, once per process rather than once per upload
+        """
+        with self._lock:
+            if self._bucket_checked:
+                return
+            if self.create_bucket:
+                try:
+                    conn.create_bucket(self.bucket_name)
+                except Exception:
+                    conn.get_bucket(self.bucket_name)
+            self._bucket_checked = True
+
+    def bucket(self):
+        """
+        Return this thread's bucket handle.  The connection behind it keeps its
+        http connections alive between uploads.
+        """
+        bucket = getattr(self._local, 'bucket', None)
+        if bucket is None:
+            conn = self._connect()
+            self._ensure_bucket(conn)
+            bucket = conn.get_bucket(self.bucket_name, validate=False)
+            self._local.bucket = bucket
+        return bucket
+
+    def upload(self, data, key_name, filename, expires_in):
+        """
+        Upload data as a public-read key with its filename metadata in one
+        request.  Returns a url valid for expires_in seconds.
+        """
+        k = Key(self.bucket())
+        k.key = key_name
+        k.set_metadata('filename', filename)
+        k.set_contents_from_string(data, policy="public-read")
+        return k.generate_url(expires_in, query_auth=self.signed_urls)
+
+    def url_if_exists(self, key_name, expires_in):
+        """
+        Return a url valid for expires_in seconds if key_name was already
+        uploaded, else None.  Costs one HEAD request.
+        """
+        k = self.bucket().get_key(key_name)
+        if k is None:
+            return None
+        return k.generate_url(expires_in, query_auth=self.signed_urls)
+
+    def url(self, key_name, expires_in):
+        """
+        Url key_name will have once uploaded, computed without any request
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn.generate_url(expires_in, 'GET', self.bucket_name, key_name, query_auth=self.signed_urls)
+
+
+class LocalStorage(Storage):
+    """
+    Certificates as files under directory, served from base_url
+    """
+    def __init__(self, directory, base_url):
+        self.directory = directory
+        self.base_url = base_url
+
+    def path(self, key_name):
+        path = os.path.normpath(os.path.join(self.directory, key_name))
+        if not path.startswith(os.path.normpath(self.directory) + os.sep):
+            raise ValueError(u"Key {0} is outside {1}".format(key_name, self.directory))
+        return path
+
+    def url(self, key_name):
+        return self.base_url + urllib.quote(key_name.encode("utf8"))
+
+    def write(self, data, key_name):
+        """
+        Write data to the file of key_name atomically.  Returns its path.
+        """
+        path = self.path(key_name)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                #Created by another thread in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return path
+
+    def upload(self, data, key_name, filename, expires_in):
+        self.write(data, key_name)
+        return self.url(key_name)
+
+    def url_if_exists(self, key_name, expires_in):
+        if not os.path.exists(self.path(key_name)):
+            return None
+        return self.url(key_name)
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS replicas (
+    key_name TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    staged TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error TEXT
+)
+"""
+
+
+class ReplicationLog(object):
+    """
+    Durable list of the local files still to upload to S3.  Every store of a
+    key is staged in a local file of its own, named in its row, so replicating
+    and removing one generation never touches a newer one.  Worker processes on
+    one node can share the log: rows are leased to one replicator at a time,
+    one row per upload so the lease only has to outlast a single request.
+    """
+    def __init__(self, path, lease_seconds=60):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(_SCHEMA)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS replicas_next_attempt ON replicas (next_attempt)")
+        self.added = threading.Event()
+
+    def add(self, key_name, filename, staged):
+        """
+        Record staged as the latest local file of key_name.  Returns the staged
+        file it supersedes, if any.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT staged FROM replicas WHERE key_name = ?", (key_name,)).fetchone()
+                self._conn.execute("INSERT OR REPLACE INTO replicas (key_name, filename, staged, created, next_attempt) "
+                                   "VALUES (?, ?, ?, ?, ?)", (key_name, filename, staged, now, now))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        self.added.set()
+        return row[0] if row is not None else None
+
+    def take(self, limit):
+        """
+        Lease up to limit replicas that are due to this process and return
+        them as (key_name, filename, staged, attempts, created, lease) tuples.
+        lease identifies this holder to remove and failed.
+        """
+        now = time.time()
+        lease = now + self.lease_seconds
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute("SELECT key_name, filename, staged, attempts, created FROM replicas "
+                                          "WHERE next_attempt <= ? ORDER BY created LIMIT ?", (now, limit)).fetchall()
+                self._conn.executemany("UPDATE replicas SET next_attempt = ? WHERE key_name = ?",
+                                       [(lease, row[0]) for row in rows])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [row + (lease,) for row in rows]
+
+    def remove(self, key_name, staged, lease):
+        """
+        Forget key_name, unless it was stored again since staged or its lease
+        ran out and another replicator took it.  Returns whether it was removed.
+        """
+        with self._lock:
+            return self._conn.execute("DELETE FROM replicas WHERE key_name = ? AND staged = ? AND next_attempt = ?",
+                                      (key_name, staged, lease)).rowcount > 0
+
+    def failed(self, key_name, staged, lease, attempts, error, delay):
+        """
+        Schedule the retry of key_name, unless it was stored again since staged
+        or its lease ran out and another replicator took it.  Returns whether
+        it was rescheduled.
+        """
+        with self._lock:
+            return self._conn.execute("UPDATE replicas SET attempts = ?, next_attempt = ?, last_error = ? "
+                                      "WHERE key_name = ? AND staged = ? AND next_attempt = ?",
+                                      (attempts, time.time() + delay, error, key_name, staged, lease)).rowcount > 0
+
+    def contains(self, key_name):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM replicas WHERE key_name = ?", (key_name,)).fetchone() is not None
+
+    def next_due(self):
+        with self._lock:
+            return self._conn.execute("SELECT MIN(next_attempt) FROM replicas").fetchone()[0]
+
+    def pending(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM replicas").fetchone()[0]
+
+
+class WriteBehindStorage(Storage):
+    """
+    Writes to local, hands out the urls of remote, and replicates to remote in
+    a background thread
+    """
+    def __init__(self, local, remote, replication_log, retry_delay, max_retry_delay, max_age, batch_size=20,
+                 idle_wait=5):
+        self.local = local
+        self.remote = remote
+        self.log = replication_log
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.idle_wait = idle_wait
+        self.thread = threading.Thread(target=self._run, name="storage-replicator")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def upload(self, data, key_name, filename, expires_in):
+        """
+        Durable once this returns: the file and its replication log row are written
+        """
+        staged = "{0}.{1}".format(key_name, uuid.uuid4().hex)
+        self.local.write(data, staged)
+        superseded = self.log.add(key_name, filename, staged)
+        if superseded is not None:
+            self._remove_staged(superseded)
+        return self.remote.url(key_name, expires_in)
+
+    def _remove_staged(self, staged):
+        try:
+            os.remove(self.local.path(staged))
+        except OSError:
+            pass
+
+    def url_if_exists(self, key_name, expires_in):
+        if self.log.contains(key_name):
+            return self.remote.url(key_name, expires_in)
+        return self.remote.url_if_exists(key_name, expires_in)
+
+    def _run(self):
+        while True:
+            try:
+                replicated = self.replicate_batch()
+            except Exception:
+                log.exception("Error replicating certificates")
+                replicated = 0
+            statsd.gauge("open_ended_assessment.grading_controller.storage.replication_pending", self.log.pending())
+            if replicated < self.batch_size:
+                self._wait()
+
+    def _wait(self):
+        """
+        Sleep until a certificate is stored or the next retry is due
+        """
+        next_due = self.log.next_due()
+        timeout = self.idle_wait if next_due is None else min(self.idle_wait, max(next_due - time.time(), 0))
+        self.log.added.wait(timeout)
+        self.log.added.clear()
+
+    def replicate_batch(self):
+        """
+        Upload up to batch_size local files that are due.  Returns how many
+        were taken.
+        """
+        taken = 0
+        while taken < self.batch_size:
+            rows = self.log.take(1)
+            if not rows:
+                break
+            taken += 1
+            self.replicate(*rows[0])
+        return taken
+
+    def replicate(self, key_name, filename, staged, attempts, created, lease):
+        try:
+            with open(self.local.path(staged), 'rb') as f:
+                data = f.read()
+            with metrics.Timer("s3.request_time", ["operation:replicate"]):
+                self.remote.upload(data, key_name, filename, 0)
+            success, error = True, None
+        except Exception as e:
+            success, error = False, repr(e)
+        statsd.increment("open_ended_assessment.grading_controller.storage.replicate",
+                         tags=["success:{0}".format(success)])
+        if success:
+            if self.log.remove(key_name, staged, lease):
+                statsd.histogram("open_ended_assessment.grading_controller.storage.replication_lag",
+                                 time.time() - created)
+                self._remove_staged(staged)
+            #Otherwise the file went with a newer store of the key, or is the replicator's that took over the lease
+            return
+
+        attempts += 1
+        if time.time() - created > self.max_age:
+            if self.log.remove(key_name, staged, lease):
+                log.error(u"Giving up replicating {0} after {1} attempts, its local copy stays at {2}.  Error: {3}".format(
+                    key_name, attempts, self.local.path(staged), error))
+                statsd.increment("open_ended_assessment.grading_controller.storage.replication_expired")
+            return
+        delay = min(self.max_retry_delay, self.retry_delay * 2 ** (attempts - 1))
+        log.warning(u"Could not replicate {0}, retrying in {1}s.  Error: {2}".format(key_name, delay, error))
+        if not self.log.failed(key_name, staged, lease, attempts, error, delay):
+            log.warning(u"Replication lease of {0} ran out while uploading it".format(key_name))
+
+
+_storage = None
+_storage_pid = None
+_storage_lock = threading.Lock()
+
+
+def _s3_storage():
+    return S3Storage(settings.AWS_ACCESS_KEY_ID,
+                     settings.AWS_SECRET_ACCESS_KEY,
+                     settings.S3_BUCKETNAME,
+                     host=settings.S3_HOST,
+                     port=settings.S3_PORT,
+                     is_secure=settings.S3_IS_SECURE,
+                     signed_urls=settings.S3_SIGNED_URLS)
+
+
+def get_storage():
+    """
+    Return this process' storage backend, starting the replicator of a
+    write-behind one on first use
+    """
+    global _storage, _storage_pid
+    with _storage_lock:
+        if _storage is None or _storage_pid != os.getpid():
+            backend = settings.STORAGE_BACKEND
+            if backend == "s3":
+                _storage = _s3_storage()
+            elif backend == "local":
+                _storage = LocalStorage(settings.STORAGE_LOCAL_DIR, settings.STORAGE_LOCAL_URL)
+            elif backend == "write_behind":
+                _storage = WriteBehindStorage(LocalStorage(settings.STORAGE_LOCAL_DIR, settings.STORAGE_LOCAL_URL),
+                                              _s3_storage(),
+                                              ReplicationLog(settings.STORAGE_REPLICATION_LOG),
+                                              settings.STORAGE_REPLICATION_RETRY_DELAY,
+                                              settings.STORAGE_REPLICATION_MAX_RETRY_DELAY,
+                                              settings.STORAGE_REPLICATION_MAX_AGE).start()
+            else:
+                raise ValueError("Unknown STORAGE_BACKEND {0}".format(backend))
+            _storage_pid = os.getpid()
+        return _storage
+
+
+def replication_pending():
+    """
+    Certificates waiting for their S3 replica, if this process writes behind
+    """
+    if _storage is None or _storage_pid != os.getpid() or not isinstance(_storage, WriteBehindStorage):
+        return None
+    return _storage.log.pending()
+
+metrics.add_source("replication_pending", replication_pending)
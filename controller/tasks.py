@@ -1,14 +1,27 @@
 from django.conf import settings
 from django.db import transaction
+from django.core.exceptions import ImproperlyConfigured
 
 import time
+import threading
 import logging
 from statsd import statsd
-import random
 from django import db
-from tempfile import NamedTemporaryFile
-import re
 from . import util
+from . import template_registry
+from . import renderer
+from . import pipeline
+from . import render_cache
+from . import overlay
+from . import scheduler
+from . import leases
+from . import outbox
+from . import journal
+from . import xqueue_session as xqueue_session_pool
+from . import metrics
+from . import profiling
+from . import scratch
+from . import quarantine
 import gc
 from statsd import statsd
 import project_urls
@@ -21,127 +34,627 @@ import urlparse
 import xml.dom.minidom
 import codecs
 
-from subprocess import Popen
-
 log = logging.getLogger(__name__)
 
 
 @periodic_task(run_every=settings.TIME_BETWEEN_XQUEUE_PULLS)
-@single_instance_task(60*10)
+@single_instance_task(settings.XQUEUE_LEASE_TTL, instances=settings.XQUEUE_PULLERS)
 @transaction.commit_manually
 def pull_from_xqueue():
   """
-  Constant loop that pulls from queue and posts to grading controller
+  Poll the queues and process submissions for XQUEUE_POLL_RUN_SECONDS.  The
+  periodic task restarts the loop when it ends.  Every queue has its own loop,
+  so a backlog on one queue does not hold up the others; at most
+  XQUEUE_MAX_ACTIVE_QUEUES of them are drained at a time.
   """
   log.info(' [*] Pulling from xqueues...')
+  profiling.setup()
+  metrics.start_publisher()
 
-  #Define sessions for logging into xqueue and controller
-  xqueue_session = util.xqueue_login()
-
-  #Sleep for some time to allow other pull_from_xqueue processes to get behind/ahead
-  time_sleep_value = random.uniform(0, .1)
-  time.sleep(time_sleep_value)
+  if settings.OUTBOX_ENABLED:
+      #Starts the sender, which also delivers results left over by earlier runs
+      outbox.get_outbox()
 
-  #Loop through each queue that is given in arguments
-  for queue_name in settings.CERTIFICATE_QUEUES_TO_PULL_FROM:
-      #Check for new submissions on xqueue, and send to controller
-      pull_from_single_queue(queue_name,xqueue_session)
+  deadline = time.time() + settings.XQUEUE_POLL_RUN_SECONDS
+  slots = threading.BoundedSemaphore(settings.XQUEUE_MAX_ACTIVE_QUEUES)
+  threads = [threading.Thread(target=poll_queue, args=(queue_name, deadline, slots), name="poll-{0}".format(queue_name))
+             for queue_name in settings.CERTIFICATE_QUEUES_TO_PULL_FROM]
+  for thread in threads:
+      thread.start()
+  for thread in threads:
+      thread.join()
 
 
   # Log out of the controller session, which deletes the database row.
   #util.controller_logout(controller_session)
 
-def pull_from_single_queue(queue_name,xqueue_session):
+def poll_queue(queue_name, deadline, slots):
+    """
+    Poll one queue until deadline, draining it whenever one of slots is free
+    """
     try:
-        #Get and parse queue objects
-        success, queue_length= get_queue_length(queue_name,xqueue_session)
-        log.info("success:{}  queue_length: {}".format(success,queue_length))
-        #Check to see if the grading_controller server is up so that we can post to it
-
-
-        #Only post while we were able to get a queue length from the xqueue, there are items in the queue, and the grading controller is up for us to post to.
-        while success and queue_length>0:
-            #Sleep for some time to allow other pull_from_xqueue processes to get behind/ahead
-            time_sleep_value = random.uniform(0, .1)
-            time.sleep(time_sleep_value)
-            success, queue_item = get_from_queue(queue_name, xqueue_session)
-
-            log.info("queue_item: {}".format(queue_item))
-            success, content = util.parse_xobject(queue_item, queue_name)
-            body = json.loads(content["xqueue_body"])
-            course_name= body["course_name"]
-            user_name = body ["student_name"]
-
-            log.info(u"course_name: {}".format(course_name))
-            log.info(u"user_name: {}".format(user_name))
-            template = os.path.splitext(body["template_pdf"])[0] + ".svg"
-            log.info(u"template: {}".format(template))
-
-            lines_template = ""
-            with open("templates/{}".format(template), 'r') as f:
-              lines_template = "".join([line.strip('\n') for line in f.readlines()])
-
-            lines_template=unicode(lines_template,'unicode-escape')
-            svg_line=lines_template
-
-
-
-            svg_line=re.sub( re.escape('==user_name==') , user_name, svg_line)
-            svg_line=re.sub( re.escape('==course_name=='), course_name, svg_line)
-
-            svg_file = NamedTemporaryFile(delete=False)
-            svg_file.write(svg_line.encode("utf8"))
-            svg_file.flush()
-            #Post to grading controller here!
-            if  success:
-                #TODO !!!
-                #Post to controller
-                # post_data = util._http_post(
-                #     controller_session,
-                #     urlparse.urljoin(settings.CERTIFICATE_CONTROLLER_INTERFACE['url'],
-                #                      post_url),
-                #     content,
-                #     settings.REQUESTS_TIMEOUT,gm
-                #     )
-              f= NamedTemporaryFile(delete=False)
-              f.close()
-              log.info(f.name)
-              x = Popen(['/usr/bin/inkscape', svg_file.name, \
-                  '--export-pdf=%s' % f.name])
-              try:
-
-                  util.waitForResponse(x)
-                  f.close()
-                  s3_key = "{}.{}".format(util.make_hashkey(content["xqueue_header"]),"pdf")
-                  success,pdf_url = util.upload_to_s3(f.name,body["student_id"],s3_key)
-                  if success:
-                    log.info("url: {}".format(pdf_url) )
-                    body["url"]=pdf_url
-                    body["download_uuid"] = ""
-                    body["verify_uuid"] = ""
-                    content["xqueue_body"]= json.dumps(body)
-                    post_one_submission_back_to_queue(content,xqueue_session)
-
-                  os.remove(f.name)
-                  os.remove(svg_file.name)
-              except OSError, e:
-                  os.remove(f.name)
-                  os.remove(svg_file.name)
-                  return False
-
-
-                  statsd.increment("open_ended_assessment.grading_controller.pull_from_xqueue",
-                                   tags=["success:True", "queue_name:{0}".format(queue_name)])
-            else:
-                log.error("Error getting queue item or no queue items to get.")
-                statsd.increment("open_ended_assessment.grading_controller.pull_from_xqueue",
-                                 tags=["success:False", "queue_name:{0}".format(queue_name)])
+        xqueue_session = xqueue_session_pool.get_session()
+    except Exception:
+        log.exception("Could not log in to xqueue for {0}".format(queue_name))
+        return
+
+    poller = scheduler.QueuePoller(queue_name, settings.XQUEUE_POLL_MIN_INTERVAL, settings.XQUEUE_POLL_MAX_INTERVAL)
+    while True:
+        if poller.due():
+            with slots:
+                pull_from_single_queue(queue_name, xqueue_session, poller)
+        if not scheduler.wait_for_next([poller], deadline):
+            break
 
-            success, queue_length= get_queue_length(queue_name, xqueue_session)
+
+def pull_from_single_queue(queue_name, xqueue_session, poller=None):
+    """
+    Drain queue_name, if one of its puller slots is free.  The first fetch
+    doubles as the emptiness check, so an idle queue costs one request per poll
+    and a busy one no get_queuelen at all.  A drain stops after
+    XQUEUE_MAX_ITEMS_PER_DRAIN submissions to give other queues a turn.
+    """
+    lease = leases.acquire_slot("xqueue-pull-{0}".format(queue_name), settings.XQUEUE_PULLERS_PER_QUEUE,
+                                settings.XQUEUE_LEASE_TTL)
+    if lease is None:
+        #Enough other workers are draining it already
+        if poller is not None:
+            poller.found_empty()
+        return
+
+    try:
+        with leases.Heartbeat([lease]):
+            pending = recovered_items(queue_name) if settings.JOURNAL_ENABLED else []
+            if not pending:
+                first = fetch_item(queue_name, xqueue_session)
+                if first is None:
+                    metrics.recorder.queue_depth(queue_name, 0)
+                    if poller is not None:
+                        poller.found_empty()
+                    return
+                pending = [first]
+
+            if poller is not None:
+                poller.found_items()
+            reader = QueueReader(queue_name, xqueue_session, pending, settings.XQUEUE_MAX_ITEMS_PER_DRAIN)
+            if settings.CERTIFICATE_DISPATCH_MODE == "celery":
+                dispatch(queue_name, reader)
+            else:
+                build_pipeline(queue_name, xqueue_session, reader, poller).run()
+            record_queue_depth(queue_name, xqueue_session, reader)
+            if poller is not None:
+                if reader.exhausted:
+                    poller.found_empty()
+                else:
+                    poller.found_items()
     except Exception:
         log.exception("Error getting submission")
         statsd.increment("open_ended_assessment.grading_controller.pull_from_xqueue",
                          tags=["success:Exception", "queue_name:{0}".format(queue_name)])
+        if poller is not None:
+            poller.found_empty()
+    finally:
+        lease.release()
+
+
+def record_queue_depth(queue_name, xqueue_session, reader):
+    """
+    Note the depth of queue_name after a drain: known to be 0 if it ran dry,
+    asked from xqueue otherwise
+    """
+    if reader.exhausted:
+        metrics.recorder.queue_depth(queue_name, 0)
+        return
+    success, length = get_queue_length(queue_name, xqueue_session)
+    if success:
+        metrics.recorder.queue_depth(queue_name, length)
+
+
+def recovered_items(queue_name):
+    """
+    Queue objects of queue_name that a crashed worker on this node had in
+    flight, according to its journal
+    """
+    contents = []
+    for key, state in journal.take_recovered(queue_name):
+        #The claim belongs to the dead worker, unless a redelivery was claimed since
+        leases.break_claim("submission", key)
+        contents.append(state['content'])
+    return contents
+
+
+class QueueReader(object):
+    """
+    Source of parsed submissions from one queue: pending, already fetched or
+    recovered ones, then fetches until the queue is empty or max_items were read.
+    """
+    def __init__(self, queue_name, xqueue_session, pending, max_items):
+        self.queue_name = queue_name
+        self.xqueue_session = xqueue_session
+        self.pending = list(reversed(pending))
+        self.max_items = max_items
+        self.count = 0
+        self.exhausted = False
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            if self.pending:
+                self.count += 1
+                return self.pending.pop()
+            if self.exhausted or (self.max_items and self.count >= self.max_items):
+                return None
+            self.count += 1
+        content = fetch_item(self.queue_name, self.xqueue_session)
+        if content is None:
+            with self._lock:
+                self.count -= 1
+                self.exhausted = True
+        return content
+
+
+def dispatch(queue_name, reader):
+    """
+    Enqueue a render_and_deliver task for every submission reader returns
+    """
+    content = reader()
+    while content is not None:
+        render_and_deliver.apply_async(args=[content, queue_name])
+        statsd.increment("open_ended_assessment.grading_controller.dispatch",
+                         tags=["queue_name:{0}".format(queue_name)])
+        content = reader()
+
+
+class DeliveryError(Exception):
+    pass
+
+
+@task(acks_late=True, ignore_result=True,
+      max_retries=settings.CERTIFICATE_RENDER_MAX_RETRIES,
+      rate_limit=settings.CERTIFICATE_RENDER_RATE_LIMIT)
+def render_and_deliver(content, queue_name):
+    """
+    Render, upload and post back one submission dispatched by pull_from_xqueue.
+    The message is only acknowledged once this returns, so a submission held by
+    a worker that dies is redelivered.  Failures are retried with exponential
+    backoff; a retry after a successful upload finds the url in the render
+    cache and only posts back.
+    """
+    countdown = settings.CERTIFICATE_RENDER_RETRY_DELAY * 2 ** render_and_deliver.request.retries
+    try:
+        item = prepare_item(content)
+    except Exception as e:
+        #Out of scratch space, disk trouble, or a failure counted towards quarantining the submission
+        log.warning(u"Could not prepare submission: {0}, retrying in {1}s".format(e, countdown))
+        raise render_and_deliver.retry(exc=e, countdown=countdown)
+    if item is None:
+        if quarantine.is_buried(submission_key(content)):
+            return
+        #Claimed by another worker, which may have died: wait for the claim to be released or expire
+        raise render_and_deliver.retry(countdown=countdown)
+
+    profiling.setup()
+    metrics.start_publisher()
+    try:
+        profiling.profiled(deliver_item)(item, queue_name)
+    except Exception as e:
+        #Release the claim before the retry can be picked up
+        cleanup_item(item)
+        log.warning(u"{0}, retrying in {1}s".format(e, countdown))
+        raise render_and_deliver.retry(exc=e, countdown=countdown)
+    finally:
+        profiling.item_done()
+    cleanup_item(item)
+
+
+def deliver_item(item, queue_name):
+    render_batch([item])
+    upload_item(item)
+    if 'url' not in item:
+        raise DeliveryError(u"Could not render or upload {0}".format(item['template']))
+    if not post_item(item, queue_name, xqueue_session_pool.get_session()):
+        raise DeliveryError("Could not post back to xqueue")
+
+
+def build_pipeline(queue_name, xqueue_session, reader, poller=None):
+    """
+    Fetch, svg assembly, rendering, upload and post back each run in their own
+    threads, joined by bounded queues.  The pipeline stops once reader, its
+    source of queue objects, returns None.
+    """
+    def render(items):
+        items = render_batch(items)
+        if poller is not None and any(item['rendered'] for item in items):
+            poller.rendered()
+        return items
+
+    def finish(item):
+        cleanup_item(item)
+        profiling.item_done()
+
+    def on_error(item):
+        finish(item)
+        statsd.increment("open_ended_assessment.grading_controller.pull_from_xqueue",
+                         tags=["success:Exception", "queue_name:{0}".format(queue_name)])
+
+    def post_and_cleanup(item):
+        #An item whose post raises is finished by on_error instead
+        post_item(item, queue_name, xqueue_session)
+        finish(item)
+
+    return pipeline.Pipeline(
+        "pull-{0}".format(queue_name),
+        pipeline.Stage("fetch", profiling.profiled(reader), workers=settings.FETCH_WORKERS),
+        [
+            pipeline.Stage("assemble", profiling.profiled(prepare_item), workers=settings.ASSEMBLE_WORKERS),
+            pipeline.Stage("render", profiling.profiled(render), workers=settings.RENDER_WORKERS,
+                           batch_size=settings.RENDER_BATCH_SIZE,
+                           batch_wait=settings.RENDER_BATCH_WAIT_MS / 1000.0,
+                           on_error=on_error),
+            pipeline.Stage("upload", profiling.profiled(upload_item), workers=settings.UPLOAD_WORKERS, on_error=on_error),
+            pipeline.Stage("post", profiling.profiled(post_and_cleanup), workers=settings.POST_WORKERS, on_error=on_error),
+        ],
+        settings.PIPELINE_QUEUE_SIZE,
+        tags=["queue_name:{0}".format(queue_name)],
+    )
+
+
+def fetch_item(queue_name, xqueue_session):
+    """
+    Fetch and parse the next submission.  Returns None once the queue is empty
+    or cannot be read.
+    """
+    while True:
+        success, queue_item = get_from_queue(queue_name, xqueue_session)
+        if not success:
+            log.info("No more queue items to get: {0}".format(queue_item))
+            return None
+
+        log.info("queue_item: {}".format(queue_item))
+        success, content = util.parse_xobject(queue_item, queue_name)
+        if success:
+            return content
+        statsd.increment("open_ended_assessment.grading_controller.pull_from_xqueue",
+                         tags=["success:False", "queue_name:{0}".format(queue_name)])
+        key = util.make_hashkey(queue_item)
+        if quarantine.is_buried(key):
+            quarantine.dropped(key)
+        else:
+            quarantine.bury(key, queue_item, content)
+
+
+def submission_key(content):
+    """
+    Identifier of a submission across deliveries
+    """
+    try:
+        header = json.loads(content["xqueue_header"])
+        if header.get("submission_key"):
+            return header["submission_key"]
+    except Exception:
+        pass
+    return util.make_hashkey(content.get("xqueue_header") if isinstance(content, dict) else content)
+
+
+def admit_item(content):
+    """
+    Check a queue object before any work is spent on it.  Returns False for
+    quarantined ones, and for invalid ones, which are quarantined.
+    """
+    key = submission_key(content)
+    if quarantine.is_buried(key):
+        log.info("Dropping quarantined submission {0}".format(key))
+        quarantine.dropped(key)
+        return False
+    success, reason = quarantine.validate(content)
+    if not success:
+        quarantine.bury(key, content, reason)
+        return False
+    return True
+
+
+def prepare_item(content):
+    """
+    Claim one parsed queue object and build its svg.  Returns the item dict
+    passed through the render and delivery steps, or None if another worker is
+    processing the same submission or it is quarantined.  Items found in the
+    render cache come back already rendered, or already uploaded, and skip
+    those stages.
+    """
+    if not admit_item(content):
+        return None
+    header = json.loads(content["xqueue_header"])
+    key = submission_key(content)
+    claim = leases.claim("submission", key, settings.SUBMISSION_CLAIM_TTL)
+    if claim is None:
+        log.info("Submission {0} is being processed by another worker".format(header.get("submission_id")))
+        return None
+    try:
+        return build_item(content, header, key, claim)
+    except Exception as e:
+        claim.release()
+        #Out of scratch space or disk trouble is not the submission's fault
+        if not isinstance(e, (scratch.ScratchFull, EnvironmentError)):
+            quarantine.record_failure(key, content, u"Could not assemble: {0!r}".format(e))
+        raise
+
+
+def build_item(content, header, key, claim):
+    body = json.loads(content["xqueue_body"])
+    course_name= body["course_name"]
+    user_name = body ["student_name"]
+
+    log.info(u"course_name: {}".format(course_name))
+    log.info(u"user_name: {}".format(user_name))
+    template = template_registry.template_filename(body["template_pdf"])
+    log.info(u"template: {}".format(template))
+    compiled = template_registry.registry.get(template)
+
+    overlay_mode = settings.RENDER_MODE == "overlay" and overlay.get_renderer().supports(template)
+    item = {
+        'key': key,
+        'queue_name': header.get('queue_name'),
+        'start': time.time(),
+        'content': content,
+        'body': body,
+        'template': template,
+        'svg_path': None,
+        'pdf_path': None,
+        'pdf_data': None,
+        'rendered': False,
+        'overlay': overlay_mode,
+        'cache_key': None,
+        'claim': claim,
+    }
+    if settings.JOURNAL_ENABLED and resume_item(item):
+        return item
+
+    try:
+        assemble_item(item, compiled, user_name, course_name)
+        journal_record(item, "fetched", queue_name=item['queue_name'], content=content,
+                       svg_path=item['svg_path'], pdf_path=item['pdf_path'])
+        if 'url' in item:
+            journal_record(item, "uploaded", url=item['url'])
+        elif item['rendered']:
+            journal_record(item, "rendered")
+    except Exception:
+        release_files(item)
+        raise
+    return item
+
+
+def assemble_item(item, compiled, user_name, course_name):
+    """
+    Write the svg to render to the scratch space, and reserve room for the
+    pdf, unless the render cache has the certificate or it is stamped onto a
+    background in memory
+    """
+    if settings.RENDER_CACHE_ENABLED:
+        version = renderer.renderer_version()
+        if item['overlay']:
+            version = "overlay:" + version
+        item['cache_key'] = render_cache.cache_key(compiled.digest, user_name, course_name, version)
+        hit = lookup_render_cache(item)
+        metrics.recorder.count("render_cache_hits" if hit else "render_cache_misses")
+        if hit:
+            return
+
+    if item['overlay']:
+        #Stamped onto the template background by the render stage, no svg needed
+        return
+
+    scratch_space = scratch.get_scratch()
+    item['svg_path'] = scratch_space.write(".svg", compiled.render(user_name=user_name, course_name=course_name))
+    item['pdf_path'] = scratch_space.allocate(".pdf", settings.SCRATCH_PDF_RESERVE_BYTES)
+
+
+def resume_item(item):
+    """
+    Pick up a submission where the journal says it was left: an uploaded one
+    only needs posting back, a rendered one whose pdf survived only uploading.
+    Temp files that cannot be reused are removed.  Returns True if resumed.
+    """
+    state = journal.get_journal().get(item['key'])
+    if state is None:
+        return False
+
+    pdf_path = state.get('pdf_path')
+    stale = [state.get('svg_path'), pdf_path]
+    if state.get('url'):
+        item['url'] = state['url']
+    elif state['stage'] == "rendered" and pdf_path and os.path.exists(pdf_path):
+        item['pdf_path'] = pdf_path
+        with open(pdf_path, 'rb') as f:
+            item['pdf_data'] = f.read()
+        item['rendered'] = True
+        stale.remove(pdf_path)
+    for path in stale:
+        if path is not None:
+            scratch.get_scratch().release(path)
+    if 'url' not in item and not item['rendered']:
+        return False
+
+    statsd.increment("open_ended_assessment.grading_controller.journal.resumed", tags=["stage:{0}".format(state['stage'])])
+    return True
+
+
+def journal_record(item, stage, **data):
+    if settings.JOURNAL_ENABLED:
+        journal.get_journal().record(item['key'], stage, **data)
+
+
+def lookup_render_cache(item):
+    """
+    Fill item from the render cache.  A cached url that is recent enough, or an
+    existing S3 object for this submission, skips straight to post back.  A
+    cached pdf skips rendering.  Returns True on a hit.
+    """
+    if settings.RENDER_CACHE_CHECK_S3:
+        success, pdf_url = util.find_in_s3(item['body']["student_id"], s3_key_for(item))
+        if success and pdf_url:
+            item['url'] = pdf_url
+            statsd.increment("open_ended_assessment.grading_controller.render_cache",
+                             tags=["hit:True", "source:s3"])
+            return True
+
+    entry = render_cache.get_cache().get(item['cache_key'])
+    if entry is not None:
+        cached_pdf, metadata = entry
+        if metadata.get('url') and time.time() - metadata.get('url_time', 0) < settings.RENDER_CACHE_URL_MAX_AGE:
+            item['url'] = metadata['url']
+            statsd.increment("open_ended_assessment.grading_controller.render_cache",
+                             tags=["hit:True", "source:url"])
+            return True
+        try:
+            with open(cached_pdf, 'rb') as f:
+                item['pdf_data'] = f.read()
+            item['rendered'] = True
+            statsd.increment("open_ended_assessment.grading_controller.render_cache",
+                             tags=["hit:True", "source:pdf"])
+            return True
+        except (IOError, OSError):
+            #Evicted by another worker in the meantime
+            pass
+
+    statsd.increment("open_ended_assessment.grading_controller.render_cache", tags=["hit:False"])
+    return False
+
+
+def render_batch(items):
+    """
+    Render every item of a batch that still needs it.  Overlay items are stamped
+    in process, the others go to inkscape in a single renderer invocation.
+    """
+    to_render = [item for item in items if not item['rendered'] and 'url' not in item]
+    for item in [item for item in to_render if item['overlay']]:
+        render_overlay(item)
+    to_render = [item for item in to_render if not item['overlay']]
+    if not to_render:
+        return items
+    start = time.time()
+    errors = renderer.render_pdfs([(item['svg_path'], item['pdf_path']) for item in to_render],
+                                  [renderer.render_timeout(item['template']) for item in to_render])
+    failed = [i for i, error in enumerate(errors) if error is not None and error.startswith(renderer.BATCH_FAILED)]
+    if failed and len(to_render) > 1:
+        #One bad svg can take down inkscape and its whole batch: render those again alone to blame only the culprit
+        for i in failed:
+            item = to_render[i]
+            errors[i] = renderer.render_pdfs([(item['svg_path'], item['pdf_path'])],
+                                             [renderer.render_timeout(item['template'])])[0]
+    elapsed = time.time() - start
+    for item, error in zip(to_render, errors):
+        #Done with the svg, give its room back right away
+        scratch.get_scratch().release(item['svg_path'])
+        item['svg_path'] = None
+        blame = error is not None and not error.startswith(renderer.TIMED_OUT)
+        if error is None:
+            try:
+                with open(item['pdf_path'], 'rb') as f:
+                    item['pdf_data'] = f.read()
+            except (IOError, OSError) as e:
+                error = str(e)
+        item['rendered'] = error is None
+        if error is not None:
+            log.error(u"Could not render {0}: {1}".format(item['template'], error))
+            #Only inkscape failing on the svg alone counts towards quarantine, not a slow or troubled machine
+            if blame:
+                quarantine.record_failure(item['key'], item['content'], u"Could not render: {0}".format(error))
+        else:
+            journal_record(item, "rendered", pdf_path=item['pdf_path'])
+            #Share of the batch
+            metrics.histogram("certificate.render_time", elapsed / len(to_render), metrics.item_tags(item) + ["mode:inkscape"])
+            metrics.recorder.sample("render_time", elapsed / len(to_render))
+
+    statsd.histogram("open_ended_assessment.grading_controller.renderer.batch_size", len(to_render))
+    statsd.histogram("open_ended_assessment.grading_controller.renderer.batch_item_time", elapsed / len(to_render))
+    return items
+
+
+def render_overlay(item):
+    body = item['body']
+    start = time.time()
+    try:
+        item['pdf_data'] = overlay.get_renderer().render_pdf_data(item['template'], body["student_name"], body["course_name"])
+        item['rendered'] = True
+        journal_record(item, "rendered")
+        metrics.histogram("certificate.render_time", time.time() - start, metrics.item_tags(item) + ["mode:overlay"])
+        metrics.recorder.sample("render_time", time.time() - start)
+    except Exception as e:
+        log.exception(u"Could not stamp {0}".format(item['template']))
+        #Only a failure of the submission itself counts towards its quarantine
+        if not isinstance(e, (scratch.ScratchFull, EnvironmentError, overlay.UnsupportedTemplate,
+                              ImproperlyConfigured)):
+            quarantine.record_failure(item['key'], item['content'], u"Could not stamp: {0!r}".format(e))
+    statsd.histogram("open_ended_assessment.grading_controller.renderer.overlay_time", time.time() - start)
+
+
+def s3_key_for(item):
+    return "{}.{}".format(util.make_hashkey(item['content']["xqueue_header"]),"pdf")
+
+
+def upload_item(item):
+    """
+    Upload a rendered certificate and store its url in the item
+    """
+    if not item['rendered'] or 'url' in item:
+        return item
+    metrics.histogram("certificate.pdf_size", len(item['pdf_data']), metrics.item_tags(item))
+    success,pdf_url = util.upload_to_s3(item['pdf_data'],item['body']["student_id"],s3_key_for(item))
+    if success:
+        log.info("url: {}".format(pdf_url) )
+        item['url'] = pdf_url
+        journal_record(item, "uploaded", url=pdf_url)
+        if item['cache_key'] is not None:
+            render_cache.get_cache().put(item['cache_key'], item['pdf_data'], pdf_url)
+    return item
+
+
+def post_item(item, queue_name, xqueue_session):
+    """
+    Post the url of an uploaded certificate back to xqueue.  Returns whether
+    xqueue accepted it.
+    """
+    success = 'url' in item
+    posted = False
+    if success:
+        content = item['content']
+        body = item['body']
+        body["url"]=item['url']
+        body["download_uuid"] = ""
+        body["verify_uuid"] = ""
+        content["xqueue_body"]= json.dumps(body)
+        if settings.OUTBOX_ENABLED:
+            #Recorded durably, the outbox sender posts it back
+            outbox.get_outbox().add(queue_name, content["xqueue_header"], content["xqueue_body"])
+            posted = True
+        else:
+            posted = post_one_submission_back_to_queue(content,xqueue_session)
+        if posted:
+            journal_record(item, "posted")
+            metrics.histogram("certificate.latency", time.time() - item['start'], metrics.item_tags(item))
+            metrics.recorder.item_done(queue_name, time.time() - item['start'])
+
+    statsd.increment("open_ended_assessment.grading_controller.pull_from_xqueue",
+                     tags=["success:{0}".format(success), "queue_name:{0}".format(queue_name)])
+    return posted
+
+
+def release_files(item):
+    """
+    Give back the scratch files and buffer of item
+    """
+    for name in ('svg_path', 'pdf_path'):
+        if item[name] is not None:
+            scratch.get_scratch().release(item[name])
+            item[name] = None
+    item['pdf_data'] = None
+
+
+def cleanup_item(item):
+    release_files(item)
+    #No-op once posted.  Otherwise xqueue will deliver it again.
+    journal_record(item, "abandoned")
+    item['claim'].release()
 
 
 def post_one_submission_back_to_queue(submission,xqueue_session):
@@ -159,6 +672,7 @@ def post_one_submission_back_to_queue(submission,xqueue_session):
             success,msg, submission["xqueue_header"], submission["xqueue_body"]))
     else:
         log.warning("Could not post back.  Error: {0}".format(msg))
+    return success
 
 def get_queue_length(queue_name,xqueue_session):
     """
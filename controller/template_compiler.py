@@ -0,0 +1,201 @@
+"""
+Template compiler: optimizes the raw Inkscape saves in templates/ for rendering.
+
+The compiled artifact is the same drawing without editor only data (named view,
+metadata, guides, inkscape/sodipodi bookkeeping attributes, comments), without
+defs nobody references or empty flowed text, with identical embedded images
+stored once, and with png images losslessly recompressed.  It is written in the
+escaped form read_template expects, so the registry loads it like a source
+template.
+"""
+from lxml import etree
+import base64
+import re
+import struct
+import zlib
+
+from . import template_registry
+
+SVG_NS = "http://www.w3.org/2000/svg"
+XLINK_NS = "http://www.w3.org/1999/xlink"
+INKSCAPE_NS = "http://www.inkscape.org/namespaces/inkscape"
+SODIPODI_NS = "http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
+EDITOR_NAMESPACES = (INKSCAPE_NS, SODIPODI_NS)
+HREF = "{%s}href" % XLINK_NS
+
+#Inkscape lays text lines out from these, they are not editor only
+KEEP_EDITOR_ATTRIBUTES = ("{%s}role" % SODIPODI_NS, "{%s}linespacing" % SODIPODI_NS)
+
+REFERENCE_RE = re.compile(r'url\(\s*#([^)\s]+)\s*\)')
+DATA_URI_RE = re.compile(r'^data:image/([a-z]+);base64,(.*)$', re.S)
+#Attributes that belong on a shared image rather than on the <use> of it
+IMAGE_ATTRIBUTES = ("width", "height", "preserveAspectRatio")
+PNG_SIGNATURE = "\x89PNG\r\n\x1a\n"
+#Chunks a renderer does not need
+PNG_DROP_CHUNKS = ("tEXt", "zTXt", "iTXt", "tIME")
+
+
+class CompileError(Exception):
+    pass
+
+
+def _namespace(tag):
+    return tag[1:].split("}")[0] if tag.startswith("{") else None
+
+
+def strip_editor_data(root):
+    removed = 0
+    for element in list(root.iter(etree.Comment)):
+        element.getparent().remove(element)
+        removed += 1
+    for element in list(root.iter(etree.Element)):
+        if element.getparent() is None:
+            continue
+        if _namespace(element.tag) in EDITOR_NAMESPACES or element.tag == "{%s}metadata" % SVG_NS:
+            element.getparent().remove(element)
+            removed += 1
+    for element in root.iter(etree.Element):
+        for name in list(element.attrib):
+            if _namespace(name) in EDITOR_NAMESPACES and name not in KEEP_EDITOR_ATTRIBUTES:
+                del element.attrib[name]
+                removed += 1
+    return removed
+
+
+def remove_empty_flowed_text(root):
+    removed = 0
+    for element in list(root.iter("{%s}flowRoot" % SVG_NS)):
+        text = "".join(para.xpath("string()") for para in element.iter("{%s}flowPara" % SVG_NS))
+        if not text.strip():
+            element.getparent().remove(element)
+            removed += 1
+    return removed
+
+
+def _references(root):
+    referenced = set()
+    for element in root.iter(etree.Element):
+        for name, value in element.attrib.items():
+            if name == HREF and value.startswith("#"):
+                referenced.add(value[1:])
+            else:
+                referenced.update(REFERENCE_RE.findall(value))
+    return referenced
+
+
+def remove_unused_defs(root):
+    """
+    Drop defs children nobody references, until nothing else can be removed
+    (a gradient may only have been used by another unused one).
+    """
+    removed = 0
+    while True:
+        referenced = _references(root)
+        unused = [element for defs in root.iter("{%s}defs" % SVG_NS) for element in defs
+                  if isinstance(element.tag, basestring) and element.get("id") not in referenced]
+        if not unused:
+            return removed
+        for element in unused:
+            element.getparent().remove(element)
+        removed += len(unused)
+
+
+def recompress_png(data):
+    """
+    Losslessly recompress a png: merge the IDAT chunks, deflate them at the
+    highest level and drop text and time chunks.  Returns data unchanged if
+    that is not smaller.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+    chunks = []
+    idat = []
+    position = len(PNG_SIGNATURE)
+    while position < len(data):
+        length, kind = struct.unpack(">I4s", data[position:position + 8])
+        chunks.append((kind, data[position + 8:position + 8 + length]))
+        position += 12 + length
+    for kind, body in chunks:
+        if kind == "IDAT":
+            idat.append(body)
+    compressed = zlib.compress(zlib.decompress("".join(idat)), 9)
+
+    out = [PNG_SIGNATURE]
+    for kind, body in chunks:
+        if kind in PNG_DROP_CHUNKS:
+            continue
+        if kind == "IDAT":
+            if idat is None:
+                continue
+            body, idat = compressed, None
+        out.append(struct.pack(">I4s", len(body), kind) + body + struct.pack(">I", zlib.crc32(kind + body) & 0xffffffff))
+    result = "".join(out)
+    return result if len(result) < len(data) else data
+
+
+def optimize_images(root):
+    """
+    Recompress embedded pngs, and store images with identical data and size
+    once in defs, each occurrence becoming a <use> of it.
+    Returns (images recompressed, images deduplicated).
+    """
+    recompressed = 0
+    by_content = {}
+    for image in root.iter("{%s}image" % SVG_NS):
+        match = DATA_URI_RE.match(image.get(HREF, ""))
+        if match is None:
+            continue
+        kind, encoded = match.groups()
+        data = base64.b64decode("".join(encoded.split()))
+        if kind == "png":
+            optimized = recompress_png(data)
+            if optimized is not data:
+                data = optimized
+                recompressed += 1
+        image.set(HREF, "data:image/{0};base64,{1}".format(kind, base64.b64encode(data)))
+        key = tuple(image.get(name) for name in (HREF,) + IMAGE_ATTRIBUTES)
+        by_content.setdefault(key, []).append(image)
+
+    deduplicated = 0
+    defs = root.find("{%s}defs" % SVG_NS)
+    for key, images in by_content.items():
+        if len(images) < 2:
+            continue
+        if defs is None:
+            defs = etree.SubElement(root, "{%s}defs" % SVG_NS)
+            root.insert(0, defs)
+        shared = etree.SubElement(defs, "{%s}image" % SVG_NS)
+        shared.set("id", "{0}-shared".format(images[0].get("id") or "image{0}".format(deduplicated)))
+        for name, value in zip((HREF,) + IMAGE_ATTRIBUTES, key):
+            if value is not None:
+                shared.set(name, value)
+        for image in images:
+            use = etree.Element("{%s}use" % SVG_NS)
+            for name, value in image.attrib.items():
+                if name != HREF and name not in IMAGE_ATTRIBUTES:
+                    use.set(name, value)
+            use.set(HREF, "#" + shared.get("id"))
+            image.getparent().replace(image, use)
+            deduplicated += 1
+    return recompressed, deduplicated
+
+
+def compile_template(source):
+    """
+    Compile decoded template source (as returned by read_template).
+
+    Returns (artifact, stats): artifact is the escaped text to write to disk,
+    stats a dict of what was removed or rewritten.
+    """
+    root = etree.fromstring(source.encode("utf8"))
+    stats = {'editor_data': strip_editor_data(root),
+             'empty_flowed_text': remove_empty_flowed_text(root),
+             'unused_defs': remove_unused_defs(root)}
+    stats['recompressed_images'], stats['deduplicated_images'] = optimize_images(root)
+
+    compiled = etree.tostring(root, encoding=unicode)
+    if sorted(template_registry.SLOT_RE.findall(compiled)) != sorted(template_registry.SLOT_RE.findall(source)):
+        raise CompileError("Placeholders did not survive compilation")
+
+    artifact = '<?xml version="1.0" encoding="UTF-8" standalone="no"?>' + compiled.encode("unicode-escape")
+    return artifact, stats
@@ -0,0 +1,120 @@
+"""
+Compiled certificate templates.
+
+Each svg template is read and decoded once, then split into static segments
+around its ==user_name== / ==course_name== slots.  Rendering a certificate is
+then a join of the pre-encoded segments with the escaped values, instead of a
+full file read and two regex passes over the whole document per item.
+"""
+from django.conf import settings
+from xml.sax.saxutils import escape
+import hashlib
+import logging
+import os
+import re
+import threading
+
+log = logging.getLogger(__name__)
+
+SLOT_RE = re.compile(r'==(user_name|course_name)==')
+
+#Escape quotes as well so that a slot placed inside an attribute stays valid
+_XML_ENTITIES = {'"': "&quot;", "'": "&apos;"}
+
+
+def template_filename(template_pdf):
+    """
+    Map the template_pdf field of an xqueue body to its svg template filename
+    """
+    return os.path.splitext(template_pdf)[0] + ".svg"
+
+
+def read_template(path):
+    """
+    Read an svg template the way the certificates have always been built:
+    newlines stripped, lines joined and \\u escapes decoded.
+    """
+    with open(path, 'r') as f:
+        lines_template = "".join([line.strip('\n') for line in f.readlines()])
+    return unicode(lines_template, 'unicode-escape')
+
+
+def xml_escape(value):
+    """
+    Escape a value for substitution into an svg document
+    """
+    return escape(value, _XML_ENTITIES)
+
+
+class CompiledTemplate(object):
+    """
+    An svg template split into utf8 encoded static segments and the slot
+    names between them.
+    """
+    def __init__(self, path, mtime, source):
+        self.path = path
+        self.mtime = mtime
+        self.digest = hashlib.sha1(source.encode("utf8")).hexdigest()
+        parts = SLOT_RE.split(source)
+        self.segments = [part.encode("utf8") for part in parts[0::2]]
+        self.slots = parts[1::2]
+
+    def render(self, **values):
+        """
+        Return the utf8 encoded svg with every slot replaced by its escaped value
+        """
+        encoded = dict((name, xml_escape(value).encode("utf8")) for name, value in values.items())
+        out = [self.segments[0]]
+        for slot, segment in zip(self.slots, self.segments[1:]):
+            out.append(encoded[slot])
+            out.append(segment)
+        return "".join(out)
+
+
+class TemplateRegistry(object):
+    """
+    In-process cache of compiled templates, invalidated when the file mtime changes.
+    Artifacts from the compile_templates command in compiled_dir are used in
+    place of the source templates they are not older than.
+    """
+    def __init__(self, template_dir, compiled_dir=None):
+        self.template_dir = template_dir
+        self.compiled_dir = compiled_dir
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def source_path(self, name):
+        return os.path.join(self.template_dir, name)
+
+    def path(self, name):
+        source_path = self.source_path(name)
+        if self.compiled_dir:
+            compiled_path = os.path.join(self.compiled_dir, name)
+            try:
+                if os.path.getmtime(compiled_path) >= os.path.getmtime(source_path):
+                    return compiled_path
+            except OSError:
+                pass
+        return source_path
+
+    def get(self, name):
+        """
+        Return the CompiledTemplate for name, compiling it on first use or after
+        the file changed.  Raises OSError/IOError if the template does not exist.
+        """
+        path = self.path(name)
+        mtime = os.path.getmtime(path)
+        compiled = self._templates.get(name)
+        if compiled is None or compiled.path != path or compiled.mtime != mtime:
+            log.info(u"Compiling template {0}".format(path))
+            compiled = CompiledTemplate(path, mtime, read_template(path))
+            with self._lock:
+                self._templates[name] = compiled
+        return compiled
+
+    def render(self, name, user_name, course_name):
+        return self.get(name).render(user_name=user_name, course_name=course_name)
+
+
+registry = TemplateRegistry(settings.CERTIFICATE_TEMPLATE_DIR,
+                            settings.COMPILED_TEMPLATE_DIR if settings.USE_COMPILED_TEMPLATES else None)
@@ -0,0 +1,21 @@
+#The django 1.4 test runner only looks in controller.tests
+from django.conf import settings
+
+#controller.tasks binds its celery tasks on import; the tests need no result store
+settings.CELERY_RESULT_BACKEND = "cache"
+settings.CELERY_CACHE_BACKEND = "locmem://"
+
+from .test_template_registry import *
+from .test_pipeline import *
+from .test_render_cache import *
+from .test_leases import *
+from .test_concurrency import *
+from .test_outbox import *
+from .test_status import *
+from .test_scratch import *
+from .test_quarantine import *
+from .test_benchmark import *
+from .test_tasks import *
+from .test_renderer import *
+from .test_overlay import *
+from .test_storage import *
@@ -0,0 +1,77 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.test.utils import override_settings
+from django.utils import unittest
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+
+from controller import leases
+from controller import quarantine
+from controller import render_cache
+from controller import scratch
+
+#Stands in for inkscape when run one process per certificate
+FAKE_INKSCAPE = """#!{python}
+import re, sys
+if "--version" in sys.argv:
+    print("Inkscape 0.48.4 r9939")
+    sys.exit(0)
+open(re.search(r'--export-pdf=(\\S+)', " ".join(sys.argv)).group(1), 'w').write("%PDF-fake")
+"""
+
+
+class BenchmarkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved_caches = leases.cache, quarantine.cache
+        inkscape = os.path.join(self.directory, "inkscape")
+        with open(inkscape, 'w') as f:
+            f.write(FAKE_INKSCAPE.format(python=sys.executable))
+        os.chmod(inkscape, os.stat(inkscape).st_mode | stat.S_IEXEC)
+        #Also undoes the settings the benchmark points at its own directories
+        self.override = override_settings(INKSCAPE_PATH=inkscape,
+                                          INKSCAPE_SHELL_MODE=False,
+                                          RENDER_CACHE_DIR=os.path.join(self.directory, "render_cache"),
+                                          COMPILED_TEMPLATE_DIR=os.path.join(self.directory, "compiled_templates"),
+                                          OVERLAY_BACKGROUND_DIR=os.path.join(self.directory, "overlay_backgrounds"),
+                                          SCRATCH_DIR=self.directory)
+        self.override.enable()
+        scratch._scratch = None
+        self.output = os.path.join(self.directory, "report.json")
+
+    def tearDown(self):
+        self.override.disable()
+        leases.cache, quarantine.cache = self.saved_caches
+        quarantine._store = render_cache._cache = scratch._scratch = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    @override_settings(XQUEUE_MAX_ITEMS_PER_DRAIN=5)
+    def test_delivers_more_items_than_one_drain_takes(self):
+        call_command('benchmark_pipeline', items=12, storage='local', output=self.output, outbox_timeout=60)
+        with open(self.output) as f:
+            report = json.load(f)
+        self.assertEqual(report['delivered'], 12)
+
+    def test_runs_are_isolated(self):
+        quarantine_path = os.path.join(self.directory, "quarantine.sqlite")
+        render_cache_dir = settings.RENDER_CACHE_DIR
+        #Puller slots left held by an earlier run that was killed
+        slots = ["xqueue-pull-certificate-benchmark"] + ["xqueue-pull-certificate-benchmark-{0}".format(i)
+                                                        for i in range(settings.XQUEUE_PULLERS_PER_QUEUE)]
+        cache = leases.cache
+        for key in slots:
+            cache.set(key, "dead", 600)
+        try:
+            with override_settings(QUARANTINE_PATH=quarantine_path):
+                call_command('benchmark_pipeline', items=3, storage='local', output=self.output, outbox_timeout=60)
+        finally:
+            for key in slots:
+                cache.delete(key)
+        with open(self.output) as f:
+            self.assertEqual(json.load(f)['delivered'], 3)
+        self.assertFalse(os.path.exists(quarantine_path))
+        self.assertFalse(os.path.exists(render_cache_dir))
@@ -0,0 +1,138 @@
+from django.conf import settings
+from django.test.utils import override_settings
+from django.utils import unittest
+import os
+import threading
+import time
+
+from controller import concurrency
+from controller import storage
+from controller import util
+
+
+class AIMDLimiterTest(unittest.TestCase):
+    def test_failure_halves_the_limit(self):
+        limiter = concurrency.AIMDLimiter("test", 8, 1, 8, 1.0)
+        limiter.release(limiter.acquire(), False)
+        self.assertEqual(limiter.state()['limit'], 4)
+        limiter.release(limiter.acquire(), False)
+        self.assertEqual(limiter.state()['limit'], 2)
+
+    def test_slow_call_halves_the_limit(self):
+        limiter = concurrency.AIMDLimiter("test", 8, 1, 8, 0.01)
+        start = limiter.acquire()
+        time.sleep(0.05)
+        limiter.release(start, True)
+        self.assertEqual(limiter.state()['limit'], 4)
+
+    def test_never_below_the_minimum(self):
+        limiter = concurrency.AIMDLimiter("test", 2, 2, 8, 1.0)
+        for i in range(5):
+            limiter.release(limiter.acquire(), False)
+        self.assertEqual(limiter.state()['limit'], 2)
+
+    def test_one_decrease_per_slow_spell(self):
+        limiter = concurrency.AIMDLimiter("test", 8, 1, 8, 1.0)
+        starts = [limiter.acquire() for i in range(4)]
+        for start in starts:
+            limiter.release(start, False)
+        self.assertEqual(limiter.state()['limit'], 4)
+
+    def test_grows_back_additively_when_saturated(self):
+        limiter = concurrency.AIMDLimiter("test", 2, 1, 4, 1.0)
+        for i in range(20):
+            starts = [limiter.acquire() for j in range(limiter.state()['limit'])]
+            for start in starts:
+                limiter.release(start, True)
+        self.assertEqual(limiter.state()['limit'], 4)
+
+    def test_does_not_grow_unused(self):
+        limiter = concurrency.AIMDLimiter("test", 2, 1, 8, 1.0)
+        for i in range(20):
+            limiter.release(limiter.acquire(), True)
+        self.assertEqual(limiter.state()['limit'], 2)
+
+    def test_caps_calls_in_flight(self):
+        limiter = concurrency.AIMDLimiter("test", 3, 1, 3, 10.0)
+        peak = [0]
+        lock = threading.Lock()
+        def call():
+            start = limiter.acquire()
+            with lock:
+                peak[0] = max(peak[0], limiter.state()['in_flight'])
+            time.sleep(0.02)
+            limiter.release(start, True)
+        threads = [threading.Thread(target=call) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(peak[0], 3)
+        self.assertEqual(limiter.state()['in_flight'], 0)
+
+
+@concurrency.limited("test-reserved")
+def reserved_call(success):
+    return success, ""
+
+
+class ReservationTest(unittest.TestCase):
+    def setUp(self):
+        self.override = override_settings(ADAPTIVE_CONCURRENCY_ENABLED=True)
+        self.override.enable()
+        self.limiter = concurrency._limiters["test-reserved"] = concurrency.AIMDLimiter("test-reserved", 4, 1, 4, 10.0)
+
+    def tearDown(self):
+        concurrency._limiters.pop("test-reserved", None)
+        self.override.disable()
+
+    def test_limited_call_runs_in_the_reserved_slot(self):
+        starts = [self.limiter.acquire() for i in range(3)]
+        done = []
+        def call():
+            with concurrency.Reservation("test-reserved"):
+                self.assertEqual(self.limiter.state()['in_flight'], 4)
+                done.append(reserved_call(True))
+        thread = threading.Thread(target=call)
+        thread.start()
+        thread.join(2)
+        self.assertEqual(done, [(True, "")])
+        for start in starts:
+            self.limiter.release(start, True)
+        self.assertEqual(self.limiter.state()['in_flight'], 0)
+
+    def test_unused_reservation_gives_the_slot_back(self):
+        with concurrency.Reservation("test-reserved"):
+            pass
+        self.assertEqual(self.limiter.state(), {'limit': 4, 'in_flight': 0, 'max': 4})
+
+    def test_failed_reserved_call_decreases_the_limit(self):
+        with concurrency.Reservation("test-reserved"):
+            reserved_call(False)
+            #Only the first call uses the reservation
+            reserved_call(True)
+        self.assertEqual(self.limiter.state(), {'limit': 2, 'in_flight': 0, 'max': 4})
+
+
+class SlowStorage(object):
+    def url_if_exists(self, key_name, expires_in):
+        raise IOError("S3 is down")
+
+
+class LimitedTest(unittest.TestCase):
+    def setUp(self):
+        self.override = override_settings(ADAPTIVE_CONCURRENCY_ENABLED=True)
+        self.override.enable()
+        self.saved = storage._storage, storage._storage_pid
+        storage._storage, storage._storage_pid = SlowStorage(), os.getpid()
+        concurrency._limiters.pop("s3", None)
+
+    def tearDown(self):
+        storage._storage, storage._storage_pid = self.saved
+        concurrency._limiters.pop("s3", None)
+        self.override.disable()
+
+    def test_s3_lookups_count_towards_the_s3_limit(self):
+        self.assertEqual(util.find_in_s3("path", "name.pdf")[0], False)
+        limiter = concurrency.get_limiter("s3")
+        self.assertTrue(limiter.state()['limit'] < settings.S3_CONCURRENCY_MAX)
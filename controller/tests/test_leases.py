@@ -0,0 +1,136 @@
+from django.core.cache import cache, get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test.utils import override_settings
+from django.utils import unittest
+import socket
+import subprocess
+import tempfile
+import time
+import uuid
+
+from controller import leases
+
+
+class LeaseTest(unittest.TestCase):
+    def setUp(self):
+        self.name = "test-{0}".format(uuid.uuid4().hex)
+
+    def test_only_one_holder(self):
+        first = leases.Lease(self.name, 60)
+        second = leases.Lease(self.name, 60)
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        first.release()
+        self.assertTrue(second.acquire())
+        second.release()
+
+    def test_release_leaves_a_lease_taken_over_by_another_worker(self):
+        first = leases.Lease(self.name, 60)
+        first.acquire()
+        cache.set(self.name, "someone-else", 60)
+        first.release()
+        self.assertEqual(cache.get(self.name), "someone-else")
+        self.assertFalse(first.renew())
+
+    def test_expired_lease_can_be_taken(self):
+        first = leases.Lease(self.name, 1)
+        self.assertTrue(first.acquire())
+        time.sleep(1.5)
+        second = leases.Lease(self.name, 60)
+        self.assertTrue(second.acquire())
+        self.assertFalse(first.renew())
+        second.release()
+
+    def test_slots(self):
+        held = [leases.acquire_slot(self.name, 2, 60) for i in range(3)]
+        self.assertTrue(held[0] is not None and held[1] is not None)
+        self.assertTrue(held[2] is None)
+        for lease in held[:2]:
+            lease.release()
+
+    def test_claim(self):
+        claim = leases.claim("test", self.name, 60)
+        self.assertTrue(claim is not None)
+        self.assertTrue(leases.claim("test", self.name, 60) is None)
+        claim.release()
+        again = leases.claim("test", self.name, 60)
+        self.assertTrue(again is not None)
+        again.release()
+
+    def test_heartbeat_renews(self):
+        lease = leases.Lease(self.name, 1)
+        lease.acquire()
+        with leases.Heartbeat([lease], interval=0.2):
+            time.sleep(1.5)
+            self.assertFalse(leases.Lease(self.name, 60).acquire())
+        lease.release()
+
+    def test_claims_are_kept_alive_while_held(self):
+        claim = leases.claim("test", self.name, 2)
+        time.sleep(3)
+        self.assertTrue(leases.claim("test", self.name, 60) is None)
+        claim.release()
+        again = leases.claim("test", self.name, 60)
+        self.assertTrue(again is not None)
+        again.release()
+
+
+class KeepAliveTest(unittest.TestCase):
+    def test_forgets_released_leases(self):
+        keep_alive = leases.KeepAlive()
+        lease = leases.Lease("test-{0}".format(uuid.uuid4().hex), 0.3)
+        lease.acquire()
+        keep_alive.add(lease)
+        time.sleep(0.2)
+        keep_alive.renew_due()
+        self.assertEqual(keep_alive.held(), 1)
+        lease.release()
+        keep_alive.renew_due()
+        self.assertEqual(keep_alive.held(), 0)
+        self.assertEqual(cache.get(lease.key), None)
+
+
+class CheckCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = leases.cache
+
+    def tearDown(self):
+        leases.cache = self.saved
+
+    def test_refuses_a_file_based_cache(self):
+        leases.cache = get_cache('django.core.cache.backends.filebased.FileBasedCache', LOCATION=tempfile.gettempdir())
+        self.assertRaises(ImproperlyConfigured, leases.check_cache)
+
+    def test_refuses_the_in_memory_cache_in_production(self):
+        leases.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        with override_settings(DEBUG=True, TESTING=False):
+            leases.check_cache()
+        with override_settings(DEBUG=False, TESTING=False):
+            self.assertRaises(ImproperlyConfigured, leases.check_cache)
+
+
+class BreakClaimTest(unittest.TestCase):
+    def setUp(self):
+        self.name = uuid.uuid4().hex
+        self.key = "claim-test-{0}".format(self.name)
+
+    def tearDown(self):
+        cache.delete(self.key)
+
+    def test_breaks_the_claim_of_a_dead_worker(self):
+        process = subprocess.Popen(["true"])
+        process.wait()
+        cache.set(self.key, "{0}:{1}:x".format(socket.gethostname(), process.pid), 60)
+        self.assertTrue(leases.break_claim("test", self.name))
+        self.assertEqual(cache.get(self.key), None)
+
+    def test_leaves_a_live_worker_alone(self):
+        claim = leases.claim("test", self.name, 60)
+        self.assertFalse(leases.break_claim("test", self.name))
+        self.assertEqual(cache.get(self.key), claim.token)
+        claim.release()
+
+    def test_leaves_other_nodes_alone(self):
+        cache.set(self.key, "another-host:1:x", 60)
+        self.assertFalse(leases.break_claim("test", self.name))
+        self.assertEqual(cache.get(self.key), "another-host:1:x")
@@ -0,0 +1,129 @@
+from django.test.utils import override_settings
+from django.utils import unittest
+import shutil
+import tempfile
+import os
+import threading
+import time
+
+from controller import concurrency
+from controller import outbox
+from controller import util
+from controller import xqueue_session
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = outbox.Outbox(os.path.join(self.directory, "outbox.sqlite"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_taken_results_are_leased(self):
+        self.outbox.add("queue", "header", "body")
+        rows = self.outbox.take(10)
+        self.assertEqual([row[1:4] for row in rows], [("queue", "header", "body")])
+        self.assertEqual(self.outbox.take(10), [])
+        self.assertEqual(self.outbox.pending(), 1)
+
+    def test_remove(self):
+        self.outbox.add("queue", "header", "body")
+        row = self.outbox.take(10)[0]
+        self.assertTrue(self.outbox.remove(row[0], row[6]))
+        self.assertEqual(self.outbox.pending(), 0)
+        self.assertEqual(self.outbox.next_due(), None)
+
+    def test_failed_results_come_back_after_the_delay(self):
+        self.outbox.add("queue", "header", "body")
+        row = self.outbox.take(10)[0]
+        result_id = row[0]
+        self.assertTrue(self.outbox.failed(result_id, row[6], 1, "down", 0.2))
+        self.assertEqual(self.outbox.take(10), [])
+        time.sleep(0.3)
+        rows = self.outbox.take(10)
+        self.assertEqual(rows[0][0], result_id)
+        self.assertEqual(rows[0][4], 1)
+
+    def test_shared_between_connections(self):
+        other = outbox.Outbox(self.outbox.path)
+        for i in range(5):
+            self.outbox.add("queue", "header", str(i))
+        first = self.outbox.take(3)
+        second = other.take(10)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertFalse(set(row[0] for row in first) & set(row[0] for row in second))
+
+    def test_expired_lease_leaves_the_new_holder_alone(self):
+        self.outbox.lease_seconds = 0.1
+        self.outbox.add("queue", "header", "body")
+        first = self.outbox.take(10)[0]
+        time.sleep(0.2)
+        self.outbox.lease_seconds = 60
+        second = self.outbox.take(10)[0]
+        self.assertFalse(self.outbox.failed(first[0], first[6], 1, "down", 0))
+        self.assertFalse(self.outbox.remove(first[0], first[6]))
+        self.assertEqual(self.outbox.take(10), [])
+        self.assertTrue(self.outbox.remove(second[0], second[6]))
+
+
+class OutboxSenderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = outbox.Outbox(os.path.join(self.directory, "outbox.sqlite"), lease_seconds=0.3)
+        self.posted = []
+        self.saved = util.post_results_to_xqueue, xqueue_session.get_session
+        xqueue_session.get_session = lambda: None
+        util.post_results_to_xqueue = self.post
+
+    def tearDown(self):
+        util.post_results_to_xqueue, xqueue_session.get_session = self.saved
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def post(self, session, header, body):
+        self.posted.append(body)
+        time.sleep(0.2)
+        return True, ""
+
+    def test_batch_longer_than_the_lease_posts_each_result_once(self):
+        for i in range(5):
+            self.outbox.add("queue", "header", str(i))
+        sender = outbox.OutboxSender(self.outbox, 5, 1, 10, 60)
+        other = outbox.OutboxSender(outbox.Outbox(self.outbox.path, lease_seconds=0.3), 5, 1, 10, 60)
+        thread = threading.Thread(target=other.send_batch)
+        thread.start()
+        sender.send_batch()
+        thread.join()
+        self.assertEqual(sorted(self.posted), [str(i) for i in range(5)])
+        self.assertEqual(self.outbox.pending(), 0)
+
+    @override_settings(ADAPTIVE_CONCURRENCY_ENABLED=True)
+    def test_results_are_leased_once_xqueue_has_a_slot(self):
+        saved = concurrency._limiters.get("xqueue")
+        limiter = concurrency._limiters["xqueue"] = concurrency.AIMDLimiter("xqueue", 1, 1, 1, 10.0)
+        try:
+            self.outbox.add("queue", "header", "body")
+            start = limiter.acquire()
+            thread = threading.Thread(target=outbox.OutboxSender(self.outbox, 5, 1, 10, 60).send_batch)
+            thread.start()
+            time.sleep(0.5)
+            #Still due: waiting for the slot took longer than the lease would last
+            self.assertTrue(self.outbox.next_due() <= time.time())
+            self.assertEqual(self.posted, [])
+            limiter.release(start, True)
+            thread.join()
+        finally:
+            concurrency._limiters["xqueue"] = saved
+            if saved is None:
+                del concurrency._limiters["xqueue"]
+        self.assertEqual(self.posted, ["body"])
+        self.assertEqual(self.outbox.pending(), 0)
+
+    def test_failed_posts_are_retried(self):
+        util.post_results_to_xqueue = lambda session, header, body: (False, "down")
+        self.outbox.add("queue", "header", "body")
+        sender = outbox.OutboxSender(self.outbox, 5, 10, 60, 60)
+        self.assertEqual(sender.send_batch(), 1)
+        self.assertEqual(self.outbox.pending(), 1)
+        self.assertEqual(sender.send_batch(), 0)
@@ -0,0 +1,96 @@
+from django.test.utils import override_settings
+from django.utils import unittest
+from cStringIO import StringIO
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from reportlab.pdfgen import canvas
+
+from controller import overlay
+from controller import renderer
+
+SVG = """<svg xmlns="http://www.w3.org/2000/svg" width="800" height="600">
+<text x="100" y="200" style="font-family:{font};font-size:24px">==user_name==</text>
+<text x="100" y="300" style="font-family:{font};font-size:16px">==course_name==</text>
+</svg>"""
+
+
+class Compiled(object):
+    def __init__(self, path, digest):
+        self.path = path
+        self.digest = digest
+        self.slots = ["user_name", "course_name"]
+
+
+def blank_pdf():
+    packet = StringIO()
+    c = canvas.Canvas(packet, pagesize=(800, 600))
+    c.showPage()
+    c.save()
+    return packet.getvalue()
+
+
+class SlowRenderer(overlay.OverlayRenderer):
+    def __init__(self, *args):
+        overlay.OverlayRenderer.__init__(self, *args)
+        self.renders = []
+
+    def _render_background(self, template_overlay, course_name, path):
+        self.renders.append(template_overlay.digest)
+        if template_overlay.digest == "slow":
+            time.sleep(0.5)
+        with open(path, 'wb') as f:
+            f.write(blank_pdf())
+
+
+class OverlayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.override = override_settings(OVERLAY_FONTS={}, OVERLAY_FALLBACK_FONT=None)
+        self.override.enable()
+        self.saved = renderer._version
+        renderer._version = "test"
+
+    def tearDown(self):
+        renderer._version = self.saved
+        self.override.disable()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def template(self, digest, font="Sans"):
+        path = os.path.join(self.directory, digest + ".svg")
+        with open(path, 'w') as f:
+            f.write(SVG.format(font=font))
+        return Compiled(path, digest)
+
+    def test_unconfigured_font_keeps_full_renders(self):
+        self.assertRaises(overlay.UnsupportedTemplate, overlay.TemplateOverlay, self.template("a", "Unknown Font"))
+
+    def test_font_that_does_not_load_keeps_full_renders(self):
+        with override_settings(OVERLAY_FONTS={"Missing Font": os.path.join(self.directory, "missing.ttf")}):
+            self.assertRaises(overlay.UnsupportedTemplate, overlay.TemplateOverlay, self.template("a", "Missing Font"))
+
+    @override_settings(OVERLAY_FALLBACK_FONT="Helvetica")
+    def test_fallback_font_is_opt_in(self):
+        template_overlay = overlay.TemplateOverlay(self.template("a", "Other Font"))
+        self.assertEqual(template_overlay.slots[0].font_name(), "Helvetica")
+
+    @override_settings(OVERLAY_FALLBACK_FONT="Helvetica")
+    def test_slow_background_does_not_block_other_templates(self):
+        backgrounds = SlowRenderer(os.path.join(self.directory, "backgrounds"), 10, False)
+        fast = overlay.TemplateOverlay(self.template("fast"))
+        slow = overlay.TemplateOverlay(self.template("slow"))
+        backgrounds.background(fast, None)
+        threads = [threading.Thread(target=backgrounds.background, args=(slow, None)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        start = time.time()
+        backgrounds.background(fast, None)
+        self.assertTrue(time.time() - start < 0.2)
+        for thread in threads:
+            thread.join()
+        #Both waited for the one render of the slow background
+        self.assertEqual(backgrounds.renders, ["fast", "slow"])
@@ -0,0 +1,90 @@
+from django.utils import unittest
+import threading
+import time
+
+from controller import pipeline
+
+
+class PipelineTest(unittest.TestCase):
+    def source(self, values):
+        values = list(reversed(values))
+        lock = threading.Lock()
+        def read():
+            with lock:
+                return values.pop() if values else None
+        return read
+
+    def test_every_input_reaches_the_last_stage(self):
+        out = []
+        p = pipeline.Pipeline("test", pipeline.Stage("source", self.source(range(100)), workers=2), [
+            pipeline.Stage("double", lambda x: x * 2, workers=3),
+            pipeline.Stage("collect", out.append, workers=1),
+        ], queue_size=5)
+        p.run()
+        self.assertEqual(sorted(out), [x * 2 for x in range(100)])
+
+    def test_batches(self):
+        batches = []
+        def batch(items):
+            batches.append(len(items))
+            return items
+        p = pipeline.Pipeline("test", pipeline.Stage("source", self.source(range(10))), [
+            pipeline.Stage("batch", batch, batch_size=4, batch_wait=0.5),
+        ], queue_size=20)
+        p.run()
+        self.assertEqual(sum(batches), 10)
+        self.assertTrue(max(batches) <= 4)
+
+    def test_failed_inputs_go_to_on_error_once(self):
+        failed = []
+        out = []
+        def stage(x):
+            if x % 3 == 0:
+                raise ValueError(x)
+            return x
+        p = pipeline.Pipeline("test", pipeline.Stage("source", self.source(range(9))), [
+            pipeline.Stage("maybe", stage, workers=2, on_error=failed.append),
+            pipeline.Stage("collect", out.append),
+        ], queue_size=5)
+        p.run()
+        self.assertEqual(sorted(failed), [0, 3, 6])
+        self.assertEqual(sorted(out), [1, 2, 4, 5, 7, 8])
+
+    def test_none_outputs_are_dropped(self):
+        out = []
+        p = pipeline.Pipeline("test", pipeline.Stage("source", self.source(range(6))), [
+            pipeline.Stage("odd", lambda x: x if x % 2 else None),
+            pipeline.Stage("collect", out.append),
+        ], queue_size=5)
+        p.run()
+        self.assertEqual(sorted(out), [1, 3, 5])
+
+    def test_source_error_stops_the_pipeline(self):
+        calls = []
+        def source():
+            calls.append(1)
+            if len(calls) > 3:
+                raise IOError("down")
+            return len(calls)
+        out = []
+        p = pipeline.Pipeline("test", pipeline.Stage("source", source), [
+            pipeline.Stage("collect", out.append),
+        ], queue_size=5)
+        p.run()
+        self.assertEqual(sorted(out), [1, 2, 3])
+
+    def test_full_queue_blocks_upstream(self):
+        seen = []
+        release = threading.Event()
+        def slow(x):
+            release.wait()
+            return x
+        p = pipeline.Pipeline("test", pipeline.Stage("source", self.source(range(20))), [
+            pipeline.Stage("slow", slow),
+        ], queue_size=2)
+        thread = threading.Thread(target=p.run)
+        thread.start()
+        time.sleep(0.3)
+        self.assertTrue(p.queue_depths()['slow'] <= 2)
+        release.set()
+        thread.join()
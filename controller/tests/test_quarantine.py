@@ -0,0 +1,91 @@
+from django.test.utils import override_settings
+from django.utils import unittest
+import json
+import os
+import shutil
+import tempfile
+
+from controller import quarantine
+
+
+class DeadLettersTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = quarantine.DeadLetters(os.path.join(self.directory, "dead_letters.sqlite"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_add_and_remove(self):
+        self.store.add("key", "queue", "header", "body", "broken", 3)
+        entries = self.store.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0][:6], ("key", "queue", "header", "body", "broken", 3))
+        self.assertTrue(self.store.remove("key"))
+        self.assertFalse(self.store.remove("key"))
+        self.assertEqual(self.store.entries(), [])
+
+    def test_readd_keeps_creation_time(self):
+        self.store.add("key", "queue", "header", "body", "broken", 3)
+        created = self.store.entries()[0][6]
+        self.store.add("key", "queue", "header", "body", "still broken", 4)
+        entries = self.store.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0][4], "still broken")
+        self.assertEqual(entries[0][6], created)
+
+    def test_seen_counts_deliveries(self):
+        self.assertFalse(self.store.contains("key"))
+        self.store.add("key", "queue", "header", "body", "broken", 3)
+        self.assertTrue(self.store.contains("key"))
+        self.store.seen("key")
+        self.assertEqual(self.store.entries()[0][8], 2)
+
+
+class IsBuriedTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.override = override_settings(QUARANTINE_PATH=os.path.join(self.directory, "dead_letters.sqlite"))
+        self.override.enable()
+        quarantine._store = None
+
+    def tearDown(self):
+        self.override.disable()
+        quarantine._store = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_check_does_not_write(self):
+        quarantine.get_store().add("key", "queue", "header", "body", "broken", 3)
+        last_seen = quarantine.get_store().entries()[0][7]
+        self.assertTrue(quarantine.is_buried("key"))
+        self.assertFalse(quarantine.is_buried("other-key-{0}".format(os.getpid())))
+        entries = quarantine.get_store().entries()
+        self.assertEqual((entries[0][7], entries[0][8]), (last_seen, 1))
+        quarantine.dropped("key")
+        self.assertEqual(quarantine.get_store().entries()[0][8], 2)
+
+
+class ValidateTest(unittest.TestCase):
+    def content(self, **body):
+        fields = {"student_id": 1, "student_name": u"Name", "course_name": u"Course", "template_pdf": u"missing.pdf"}
+        fields.update(body)
+        return {"xqueue_header": json.dumps({"queue_name": "certificates"}), "xqueue_body": json.dumps(fields)}
+
+    def test_rejects_broken_json(self):
+        self.assertEqual(quarantine.validate({"xqueue_header": "{", "xqueue_body": "{}"}),
+                         (False, "xqueue_header is not valid JSON"))
+        self.assertEqual(quarantine.validate({"xqueue_header": "{}", "xqueue_body": "[]"}),
+                         (False, "xqueue_body is not a JSON object"))
+
+    def test_rejects_missing_fields(self):
+        success, reason = quarantine.validate(self.content(student_name=""))
+        self.assertFalse(success)
+        self.assertTrue("student_name" in reason)
+
+    def test_rejects_control_characters(self):
+        success, reason = quarantine.validate(self.content(student_name=u"Na\x00me"))
+        self.assertEqual((success, reason), (False, "student_name holds characters an svg cannot"))
+
+    def test_rejects_paths_and_unknown_templates(self):
+        self.assertFalse(quarantine.validate(self.content(template_pdf=u"../settings.py"))[0])
+        self.assertFalse(quarantine.validate(self.content())[0])
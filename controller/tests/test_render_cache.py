@@ -0,0 +1,52 @@
+from django.utils import unittest
+import os
+import shutil
+import tempfile
+import time
+
+from controller import render_cache
+
+
+class RenderCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_put_and_get(self):
+        cache = render_cache.RenderCache(self.directory, 1000)
+        self.assertEqual(cache.get("a"), None)
+        cache.put("a", "pdf", "http://example.com/a.pdf")
+        pdf_path, metadata = cache.get("a")
+        with open(pdf_path) as f:
+            self.assertEqual(f.read(), "pdf")
+        self.assertEqual(metadata['url'], "http://example.com/a.pdf")
+
+    def test_evicts_least_recently_used(self):
+        cache = render_cache.RenderCache(self.directory, 250)
+        cache.put("a", "x" * 100, "a")
+        os.utime(os.path.join(self.directory, "a.pdf"), (time.time() - 20, time.time() - 20))
+        cache.put("b", "x" * 100, "b")
+        os.utime(os.path.join(self.directory, "b.pdf"), (time.time() - 10, time.time() - 10))
+        cache.get("a")
+        cache.put("c", "x" * 100, "c")
+        self.assertTrue(cache.get("a") is not None)
+        self.assertEqual(cache.get("b"), None)
+        self.assertTrue(cache.get("c") is not None)
+
+    def test_key_depends_on_every_part(self):
+        key = render_cache.cache_key("digest", u"Name", u"Course", "1")
+        self.assertEqual(key, render_cache.cache_key("digest", u"Name", u"Course", "1"))
+        self.assertNotEqual(key, render_cache.cache_key("digest", u"Name", u"Course", "2"))
+        self.assertNotEqual(render_cache.cache_key("a", u"bc", u"", "1"), render_cache.cache_key("ab", u"c", u"", "1"))
+
+    def test_put_over_an_entry_counts_it_once(self):
+        cache = render_cache.RenderCache(self.directory, 250)
+        cache.put("a", "x" * 100, "a")
+        cache.put("b", "x" * 100, "b")
+        for i in range(3):
+            cache.put("a", "x" * 100, "a")
+        self.assertEqual(cache._size, 200)
+        self.assertTrue(cache.get("a") is not None)
+        self.assertTrue(cache.get("b") is not None)
@@ -0,0 +1,86 @@
+from django.utils import unittest
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from controller import renderer
+
+#Stands in for inkscape --shell.  A job whose svg holds "crash" gets half a
+#pdf before inkscape dies.  With a "linger" file next to it, it never quits.
+FAKE_INKSCAPE = """#!{python}
+import os, re, sys, time
+sys.stdout.write("Inkscape interactive shell mode\\n>")
+sys.stdout.flush()
+while True:
+    line = sys.stdin.readline().strip()
+    if not line or line == "quit":
+        if os.path.exists(os.path.join(os.path.dirname(sys.argv[0]), "linger")):
+            time.sleep(100)
+        break
+    svg_path = line.split()[0]
+    pdf_path = re.search(r'--export-pdf=(\\S+)', line).group(1)
+    content = open(svg_path).read()
+    if "crash" in content:
+        open(pdf_path, 'w').write("%PDF-trunc")
+        sys.exit(3)
+    open(pdf_path, 'w').write("%PDF-fake")
+    sys.stdout.write("\\n>")
+    sys.stdout.flush()
+"""
+
+
+class RendererPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.inkscape = os.path.join(self.directory, "inkscape")
+        with open(self.inkscape, 'w') as f:
+            f.write(FAKE_INKSCAPE.format(python=sys.executable))
+        os.chmod(self.inkscape, os.stat(self.inkscape).st_mode | stat.S_IEXEC)
+        self.pool = renderer.RendererPool(self.inkscape, 1, 100)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def job(self, name, content="<svg/>"):
+        svg_path = os.path.join(self.directory, name + ".svg")
+        with open(svg_path, 'w') as f:
+            f.write(content)
+        return svg_path, os.path.join(self.directory, name + ".pdf")
+
+    def test_batch(self):
+        jobs = [self.job(str(i)) for i in range(3)]
+        self.assertEqual(self.pool.render_pdfs(jobs, [5] * 3), [None] * 3)
+        for svg_path, pdf_path in jobs:
+            self.assertTrue(os.path.getsize(pdf_path) > 0)
+
+    def test_crash_fails_every_job_not_answered(self):
+        jobs = [self.job("before"), self.job("poison", "crash"), self.job("after")]
+        errors = self.pool.render_pdfs(jobs, [5] * 3)
+        self.assertEqual(errors[0], None)
+        #The half written pdf of the crashing job is no success
+        self.assertTrue(os.path.getsize(jobs[1][1]) > 0)
+        self.assertTrue(errors[1].startswith(renderer.BATCH_FAILED))
+        self.assertTrue(errors[2].startswith(renderer.BATCH_FAILED))
+        self.assertEqual(self.pool.render_pdfs([self.job("again")], [5]), [None])
+
+    def test_close_kills_an_inkscape_that_does_not_quit(self):
+        process = renderer.InkscapeProcess(self.inkscape)
+        open(os.path.join(self.directory, "linger"), 'w').close()
+        saved = renderer.CLOSE_TIMEOUT
+        renderer.CLOSE_TIMEOUT = 0.5
+        try:
+            start = time.time()
+            process.close()
+        finally:
+            renderer.CLOSE_TIMEOUT = saved
+        self.assertTrue(time.time() - start < 5)
+        self.assertFalse(process.is_alive())
+
+    def test_close(self):
+        process = renderer.InkscapeProcess(self.inkscape)
+        process.close()
+        self.assertEqual(process.process.returncode, 0)
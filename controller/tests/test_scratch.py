@@ -0,0 +1,104 @@
+from django.test.utils import override_settings
+from django.utils import unittest
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from controller import journal
+from controller import scratch
+
+
+class ScratchSpaceTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_write_and_release(self):
+        space = scratch.ScratchSpace(self.directory, 100, 1)
+        path = space.write(".svg", "x" * 40)
+        with open(path) as f:
+            self.assertEqual(f.read(), "x" * 40)
+        self.assertEqual(space.used, 40)
+        space.release(path)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(space.used, 0)
+
+    def test_full_space_raises_after_waiting(self):
+        space = scratch.ScratchSpace(self.directory, 100, 0.2)
+        space.allocate(".pdf", 80)
+        start = time.time()
+        self.assertRaises(scratch.ScratchFull, space.allocate, ".pdf", 40)
+        self.assertTrue(time.time() - start >= 0.2)
+
+    def test_waits_for_room(self):
+        space = scratch.ScratchSpace(self.directory, 100, 5)
+        path = space.allocate(".pdf", 80)
+        threading.Timer(0.2, space.release, [path]).start()
+        second = space.allocate(".pdf", 40)
+        self.assertEqual(space.used, 40)
+        space.release(second)
+
+    def test_oversized_allocation_passes_when_empty(self):
+        space = scratch.ScratchSpace(self.directory, 100, 0.1)
+        path = space.allocate(".pdf", 500)
+        space.release(path)
+        self.assertEqual(space.used, 0)
+
+    def test_release_of_unknown_file_keeps_accounting(self):
+        space = scratch.ScratchSpace(self.directory, 100, 1)
+        space.allocate(".pdf", 30)
+        other = os.path.join(self.directory, "recovered.pdf")
+        open(other, 'w').close()
+        space.release(other)
+        self.assertFalse(os.path.exists(other))
+        self.assertEqual(space.used, 30)
+
+
+class RemoveDeadTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal_dir = os.path.join(self.directory, "journal")
+        os.mkdir(self.journal_dir)
+        self.override = override_settings(SCRATCH_DIR=self.directory, JOURNAL_DIR=self.journal_dir,
+                                          JOURNAL_ENABLED=True)
+        self.override.enable()
+        scratch._scratch = None
+        process = subprocess.Popen(["true"])
+        process.wait()
+        self.dead = os.path.join(self.directory, "certificates-{0}".format(process.pid))
+        os.mkdir(self.dead)
+        self.dead_pid = process.pid
+
+    def tearDown(self):
+        scratch._scratch = None
+        self.override.disable()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def file(self, name):
+        path = os.path.join(self.dead, name)
+        open(path, 'w').close()
+        return path
+
+    def test_keeps_only_the_files_the_journal_points_to(self):
+        rendered = self.file("rendered.pdf")
+        fetched_svg = self.file("fetched.svg")
+        orphan = self.file("orphan.svg")
+        posted = self.file("posted.pdf")
+        records = [{'key': "a", 'stage': "rendered", 'pdf_path': rendered, 'svg_path': fetched_svg},
+                   {'key': "b", 'stage': "fetched", 'pdf_path': posted},
+                   {'key': "b", 'stage': "posted"}]
+        with open(os.path.join(self.journal_dir, "journal-{0}-{1}.log".format(journal._HOST, self.dead_pid)), 'w') as f:
+            f.write("".join(json.dumps(record) + "\n" for record in records))
+        scratch.get_scratch()
+        self.assertEqual(sorted(os.listdir(self.dead)), ["fetched.svg", "rendered.pdf"])
+
+    def test_removes_a_directory_the_journal_does_not_need(self):
+        self.file("crashed-before-fetched.svg")
+        scratch.get_scratch()
+        self.assertFalse(os.path.exists(self.dead))
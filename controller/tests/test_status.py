@@ -0,0 +1,48 @@
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import unittest
+import json
+import os
+import shutil
+import tempfile
+
+from controller import leases
+from controller import metrics
+from controller import views
+
+
+class StatusTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = metrics.cache
+
+    def tearDown(self):
+        metrics.cache = self.saved
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def shared_cache(self):
+        #A client of its own, as in another process, over the same storage
+        return get_cache('django.core.cache.backends.filebased.FileBasedCache', LOCATION=self.directory)
+
+    def status(self):
+        return views.status(RequestFactory().get("/certificate_controller/status/"))
+
+    def test_serves_the_snapshot_another_process_published(self):
+        metrics.cache = self.shared_cache()
+        metrics.publish()
+        metrics.cache = self.shared_cache()
+        response = self.status()
+        self.assertEqual(response.status_code, 200)
+        workers = json.loads(response.content)['workers']
+        self.assertEqual([worker['pid'] for worker in workers], [os.getpid()])
+
+    def test_no_snapshot_is_unavailable(self):
+        metrics.cache = self.shared_cache()
+        self.assertEqual(self.status().status_code, 503)
+
+    @override_settings(DEBUG=False, TESTING=False)
+    def test_refuses_a_cache_private_to_each_process(self):
+        self.assertRaises(ImproperlyConfigured, leases.check_cache,
+                          get_cache('django.core.cache.backends.locmem.LocMemCache'))
@@ -0,0 +1,121 @@
+from django.utils import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from controller import storage
+
+
+class FakeRemote(object):
+    def __init__(self):
+        self.objects = {}
+        self.down = False
+        self.delay = 0
+        self.before_upload = None
+        self.uploads = []
+
+    def upload(self, data, key_name, filename, expires_in):
+        if self.before_upload is not None:
+            hook, self.before_upload = self.before_upload, None
+            hook()
+        time.sleep(self.delay)
+        if self.down:
+            raise IOError("S3 is down")
+        self.uploads.append(key_name)
+        self.objects[key_name] = data
+        return self.url(key_name, expires_in)
+
+    def url(self, key_name, expires_in):
+        return "http://s3/" + key_name
+
+
+class WriteBehindStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.remote = FakeRemote()
+        self.storage = self.write_behind()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write_behind(self, max_age=60, lease_seconds=60, batch_size=20):
+        return storage.WriteBehindStorage(storage.LocalStorage(os.path.join(self.directory, "files"), "file:///"),
+                                          self.remote,
+                                          storage.ReplicationLog(os.path.join(self.directory, "replication.sqlite"),
+                                                                 lease_seconds),
+                                          0, 0, max_age, batch_size)
+
+    def local_files(self):
+        return os.listdir(os.path.join(self.directory, "files"))
+
+    def test_replicates_and_removes_the_local_copy(self):
+        self.assertEqual(self.storage.upload("pdf", "a.pdf", "a.pdf", 0), "http://s3/a.pdf")
+        self.assertEqual(self.storage.url_if_exists("a.pdf", 0), "http://s3/a.pdf")
+        self.assertEqual(self.storage.replicate_batch(), 1)
+        self.assertEqual(self.remote.objects, {"a.pdf": "pdf"})
+        self.assertEqual(self.storage.log.pending(), 0)
+        self.assertEqual(self.local_files(), [])
+
+    def test_store_during_replication_keeps_the_new_copy(self):
+        self.storage = self.write_behind(batch_size=1)
+        self.storage.upload("old", "a.pdf", "a.pdf", 0)
+        self.remote.before_upload = lambda: self.storage.upload("new", "a.pdf", "a.pdf", 0)
+        self.storage.replicate_batch()
+        self.assertEqual(self.storage.log.pending(), 1)
+        self.assertEqual(len(self.local_files()), 1)
+        self.storage.replicate_batch()
+        self.assertEqual(self.remote.objects, {"a.pdf": "new"})
+        self.assertEqual(self.local_files(), [])
+
+    def test_restore_replaces_the_pending_copy(self):
+        self.storage.upload("old", "a.pdf", "a.pdf", 0)
+        self.storage.upload("new", "a.pdf", "a.pdf", 0)
+        self.assertEqual(len(self.local_files()), 1)
+        self.storage.replicate_batch()
+        self.assertEqual(self.remote.objects, {"a.pdf": "new"})
+
+    def test_gives_up_after_max_age_and_keeps_the_file(self):
+        self.storage = self.write_behind(max_age=-1)
+        self.remote.down = True
+        self.storage.upload("pdf", "a.pdf", "a.pdf", 0)
+        self.storage.replicate_batch()
+        self.assertEqual(self.storage.log.pending(), 0)
+        self.assertEqual(len(self.local_files()), 1)
+
+    def test_failed_replication_is_retried(self):
+        self.remote.down = True
+        self.storage.upload("pdf", "a.pdf", "a.pdf", 0)
+        self.storage.replicate_batch()
+        self.assertEqual(self.storage.log.pending(), 1)
+        self.remote.down = False
+        self.storage.replicate_batch()
+        self.assertEqual(self.remote.objects, {"a.pdf": "pdf"})
+
+    def test_batch_longer_than_the_lease_uploads_each_file_once(self):
+        self.storage = self.write_behind(lease_seconds=0.3)
+        other = self.write_behind(lease_seconds=0.3)
+        self.remote.delay = 0.2
+        for i in range(5):
+            self.storage.upload("pdf", "{0}.pdf".format(i), "{0}.pdf".format(i), 0)
+        #Starts once the leases of a whole batch would have run out
+        thread = threading.Timer(0.35, other.replicate_batch)
+        thread.start()
+        self.storage.replicate_batch()
+        thread.join()
+        self.assertEqual(sorted(self.remote.uploads), ["{0}.pdf".format(i) for i in range(5)])
+        self.assertEqual(self.storage.log.pending(), 0)
+        self.assertEqual(self.local_files(), [])
+
+    def test_expired_lease_leaves_the_new_holder_alone(self):
+        replication_log = storage.ReplicationLog(os.path.join(self.directory, "replication.sqlite"), 0.1)
+        replication_log.add("a.pdf", "a.pdf", "a.pdf.1")
+        first = replication_log.take(10)[0]
+        time.sleep(0.2)
+        replication_log.lease_seconds = 60
+        second = replication_log.take(10)[0]
+        self.assertFalse(replication_log.failed("a.pdf", "a.pdf.1", first[5], 1, "down", 0))
+        self.assertFalse(replication_log.remove("a.pdf", "a.pdf.1", first[5]))
+        self.assertEqual(replication_log.take(10), [])
+        self.assertTrue(replication_log.remove("a.pdf", "a.pdf.1", second[5]))
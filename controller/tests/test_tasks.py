@@ -0,0 +1,186 @@
+from django.test.utils import override_settings
+from django.utils import unittest
+import json
+import os
+import shutil
+import tempfile
+
+from controller import journal
+from controller import overlay
+from controller import profiling
+from controller import quarantine
+from controller import renderer
+from controller import scratch
+from controller import tasks
+
+
+class Retried(Exception):
+    pass
+
+
+class RenderAndDeliverTest(unittest.TestCase):
+    content = {"xqueue_header": json.dumps({"submission_id": 1, "submission_key": "key"}), "xqueue_body": "{}"}
+
+    def setUp(self):
+        self.saved = tasks.prepare_item
+        self.retries = []
+        tasks.render_and_deliver.retry = self.retry
+
+    def tearDown(self):
+        tasks.prepare_item = self.saved
+        del tasks.render_and_deliver.retry
+
+    def retry(self, exc=None, countdown=None):
+        self.retries.append(exc)
+        return Retried()
+
+    def fail_prepare(self, error):
+        def prepare_item(content):
+            raise error
+        tasks.prepare_item = prepare_item
+
+    def test_scratch_full_is_retried(self):
+        error = scratch.ScratchFull("full")
+        self.fail_prepare(error)
+        self.assertRaises(Retried, tasks.render_and_deliver, self.content, "queue")
+        self.assertEqual(self.retries, [error])
+
+    def test_disk_errors_are_retried(self):
+        error = IOError("disk")
+        self.fail_prepare(error)
+        self.assertRaises(Retried, tasks.render_and_deliver, self.content, "queue")
+        self.assertEqual(self.retries, [error])
+
+
+class RenderBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.override = override_settings(SCRATCH_DIR=self.directory)
+        self.override.enable()
+        scratch._scratch = None
+        self.saved = renderer.render_pdfs, quarantine.record_failure
+        self.failures = []
+        self.batches = []
+        quarantine.record_failure = lambda key, content, reason: self.failures.append(key)
+
+    def tearDown(self):
+        renderer.render_pdfs, quarantine.record_failure = self.saved
+        scratch._scratch = None
+        self.override.disable()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def item(self, key):
+        svg_path = os.path.join(self.directory, key + ".svg")
+        open(svg_path, 'w').close()
+        return {'key': key, 'content': {}, 'template': "template.svg", 'overlay': False, 'rendered': False,
+                'svg_path': svg_path, 'pdf_path': os.path.join(self.directory, key + ".pdf")}
+
+    def render(self, results):
+        def render_pdfs(jobs, timeouts=None):
+            self.batches.append(len(jobs))
+            return [results[os.path.basename(svg_path)[:-len(".svg")]].pop(0) for svg_path, pdf_path in jobs]
+        renderer.render_pdfs = render_pdfs
+
+    def test_timeouts_and_missing_pdfs_are_not_blamed(self):
+        self.render({'slow': [renderer.TIMED_OUT + ": killed"], 'lost': [None]})
+        items = tasks.render_batch([self.item("slow"), self.item("lost")])
+        self.assertEqual([item['rendered'] for item in items], [False, False])
+        self.assertEqual(self.failures, [])
+
+    def test_crash_is_blamed_on_the_job_that_crashes_alone(self):
+        failed = renderer.BATCH_FAILED + ": exited"
+        def render_pdfs(jobs, timeouts=None):
+            self.batches.append(len(jobs))
+            if len(jobs) > 1:
+                return [failed] * len(jobs)
+            svg_path, pdf_path = jobs[0]
+            if "poison" in svg_path:
+                return [failed]
+            open(pdf_path, 'w').write("%PDF")
+            return [None]
+        renderer.render_pdfs = render_pdfs
+        items = tasks.render_batch([self.item("poison"), self.item("innocent")])
+        self.assertEqual(self.batches, [2, 1, 1])
+        self.assertEqual(self.failures, ["poison"])
+        self.assertEqual([item['rendered'] for item in items], [False, True])
+
+    def test_export_failure_is_blamed(self):
+        self.render({'broken': ["Inkscape did not export broken.pdf"]})
+        tasks.render_batch([self.item("broken")])
+        self.assertEqual(self.failures, ["broken"])
+
+    def test_overlay_configuration_errors_are_not_blamed(self):
+        class Unstampable(object):
+            def render_pdf_data(self, template, user_name, course_name):
+                raise overlay.UnsupportedTemplate("No font")
+        saved = overlay.get_renderer
+        overlay.get_renderer = Unstampable
+        try:
+            item = dict(self.item("stamped"), overlay=True, body={"student_name": u"Name", "course_name": u"Course"})
+            tasks.render_batch([item])
+        finally:
+            overlay.get_renderer = saved
+        self.assertFalse(item['rendered'])
+        self.assertEqual(self.failures, [])
+
+
+class ResumeItemTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.override = override_settings(SCRATCH_DIR=self.directory)
+        self.override.enable()
+        scratch._scratch = None
+        self.saved = journal.get_journal
+        self.state = None
+        journal.get_journal = lambda: self
+
+    def tearDown(self):
+        journal.get_journal = self.saved
+        scratch._scratch = None
+        self.override.disable()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def get(self, key):
+        return self.state
+
+    def test_stale_files_go_back_to_the_scratch_space(self):
+        space = scratch.get_scratch()
+        used = space.used
+        svg_path = space.write(".svg", "x" * 100)
+        self.state = {'stage': "assembled", 'svg_path': svg_path, 'pdf_path': None}
+        self.assertFalse(tasks.resume_item({'key': "key", 'rendered': False}))
+        self.assertFalse(os.path.exists(svg_path))
+        self.assertEqual(space.used, used)
+
+
+class BuildPipelineTest(unittest.TestCase):
+    stubbed = ("prepare_item", "render_batch", "upload_item", "post_item", "cleanup_item")
+
+    def setUp(self):
+        self.saved = dict((name, getattr(tasks, name)) for name in self.stubbed)
+        self.saved_item_done = profiling.item_done
+        self.cleaned = []
+        self.done = []
+        tasks.prepare_item = lambda content: {'key': content, 'rendered': True}
+        tasks.render_batch = lambda items: items
+        tasks.upload_item = lambda item: item
+        tasks.post_item = self.post_item
+        tasks.cleanup_item = lambda item: self.cleaned.append(item['key'])
+        profiling.item_done = lambda: self.done.append(1)
+
+    def tearDown(self):
+        for name, func in self.saved.items():
+            setattr(tasks, name, func)
+        profiling.item_done = self.saved_item_done
+
+    def post_item(self, item, queue_name, xqueue_session):
+        if item['key'] == "bad":
+            raise IOError("xqueue is down")
+        return True
+
+    def test_each_item_is_finished_once(self):
+        contents = ["good", "bad"]
+        reader = lambda: contents.pop() if contents else None
+        tasks.build_pipeline("queue", None, reader).run()
+        self.assertEqual(sorted(self.cleaned), ["bad", "good"])
+        self.assertEqual(len(self.done), 2)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from django.conf import settings
+from django.utils import unittest
+from xml.dom import minidom
+import os
+import shutil
+import tempfile
+import time
+
+from controller import template_registry
+from controller.management.commands.benchmark_templates import legacy_render
+
+TEMPLATE = '<svg><text title="==course_name==">==user_name==</text>\n<text>==course_name==</text></svg>\n'
+
+
+class TemplateRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.compiled = os.path.join(self.directory, "compiled")
+        os.mkdir(self.compiled)
+        self.write("t.svg", TEMPLATE)
+        self.registry = template_registry.TemplateRegistry(self.directory, self.compiled)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, name, content, mtime=None, directory=None):
+        path = os.path.join(directory or self.directory, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_names_are_escaped(self):
+        svg = self.registry.render("t.svg", u'A & B <b>"C"</b>', u"Q&A")
+        self.assertTrue('&amp;' in svg and '&lt;b&gt;' in svg and '&quot;C&quot;' in svg)
+        text = minidom.parseString(svg).getElementsByTagName("text")
+        self.assertEqual(text[0].firstChild.data, u'A & B <b>"C"</b>')
+        self.assertEqual(text[0].getAttribute("title"), u"Q&A")
+
+    def test_same_bytes_as_the_legacy_substitution(self):
+        user_name, course_name = u"Jean-François Dupont", u"Introduction aux certificats"
+        registry = template_registry.TemplateRegistry(settings.CERTIFICATE_TEMPLATE_DIR)
+        names = [name for name in os.listdir(settings.CERTIFICATE_TEMPLATE_DIR) if name.endswith(".svg")]
+        self.assertTrue(names)
+        for name in names:
+            path = os.path.join(settings.CERTIFICATE_TEMPLATE_DIR, name)
+            self.assertEqual(registry.render(name, user_name, course_name),
+                             legacy_render(path, user_name, course_name), name)
+
+    def test_recompiles_when_the_source_changes(self):
+        self.assertTrue("Before" in self.registry.render("t.svg", u"Before", u"Course"))
+        self.write("t.svg", "<svg><text>Changed ==user_name==</text></svg>", time.time() + 10)
+        self.assertEqual(self.registry.render("t.svg", u"After", u"Course"),
+                         "<svg><text>Changed After</text></svg>")
+
+    def test_prefers_a_compiled_artifact_not_older_than_the_source(self):
+        now = time.time()
+        self.write("t.svg", TEMPLATE, now - 10)
+        self.write("t.svg", "<svg>compiled ==user_name==</svg>", now, self.compiled)
+        self.assertEqual(self.registry.render("t.svg", u"Name", u"Course"), "<svg>compiled Name</svg>")
+        #An edited source wins over the stale artifact
+        self.write("t.svg", "<svg>edited ==user_name==</svg>", now + 10)
+        self.assertEqual(self.registry.render("t.svg", u"Name", u"Course"), "<svg>edited Name</svg>")
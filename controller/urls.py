@@ -6,12 +6,17 @@ from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
 
 
+# Worker health and capacity metrics
+#------------------------------------------------------------
+urlpatterns = patterns('controller.views',
+    url(r'^status/$', 'status'),
+)
+
 # General
 #------------------------------------------------------------
-# urlpatterns = patterns('controller.views',
+# urlpatterns += patterns('controller.views',
 #     url(r'^login/$', 'log_in'),
 #     url(r'^logout/$', 'log_out'),
-#     url(r'^status/$', 'status'),
 #     url(r'^get_submission_eta/$', 'request_eta_for_submission'),
 #     url(r'^is_name_unique/$', 'verify_name_uniqueness'),
 #     url(r'^combined_notifications/$', 'check_for_notifications'),
@@ -6,9 +6,13 @@ import requests
 import urlparse
 import project_urls
 import re
+import os
+import signal
+import threading
 
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
+from . import storage
+from . import metrics
+from . import concurrency
 
 from django.http import HttpResponse
 from django.contrib.auth.models import User, Group, Permission
@@ -24,6 +28,7 @@ log = logging.getLogger(__name__)
 _INTERFACE_VERSION = 1
 
 
+
 def parse_xreply(xreply):
     """
     Parse the reply from xqueue. Messages are JSON-serialized dict:
@@ -73,7 +78,7 @@ def parse_xobject(xobject, queue_name):
         content = {'xqueue_header': json.dumps(header),
                    'xqueue_body': json.dumps(body)
         }
-    except ValueError:
+    except (ValueError, KeyError, TypeError, AttributeError):
         error_message = "Unexpected reply from server."
         log.error(error_message)
         return (False, error_message)
@@ -107,6 +112,23 @@ def login(session, url, username, password):
     return success, msg
 
 
+def _request_tags(method):
+    def tags(session, url, *args, **kwargs):
+        return ["method:{0}".format(method), "endpoint:{0}".format(urlparse.urlparse(url).path.strip("/"))]
+    return tags
+
+
+def _xqueue_answered(result):
+    """
+    Whether an _http_get got an answer from xqueue, even one saying the queue
+    is empty
+    """
+    success, msg = result
+    return success or not (msg == "Cannot connect to server." or msg.startswith("Unexpected HTTP status code"))
+
+
+@concurrency.limited("xqueue", _xqueue_answered)
+@metrics.timed("xqueue.request_time", _request_tags("get"))
 def _http_get(session, url, data=None):
     """
     Send an HTTP get request:
@@ -139,6 +161,8 @@ def _http_get(session, url, data=None):
     return parse_xreply(text)
 
 
+@concurrency.limited("xqueue")
+@metrics.timed("xqueue.request_time", _request_tags("post"))
 def _http_post(session, url, data, timeout):
     '''
     Contact grading controller, but fail gently.
@@ -198,18 +222,6 @@ def post_results_to_xqueue(session, header, body):
 
     return success, msg
 
-def xqueue_login():
-    session = requests.session()
-    xqueue_login_url = urlparse.urljoin(settings.XQUEUE_INTERFACE['url'], project_urls.XqueueURLs.log_in)
-    (success, xqueue_msg) = login(
-        session,
-        xqueue_login_url,
-        settings.XQUEUE_INTERFACE['django_auth']['username'],
-        settings.XQUEUE_INTERFACE['django_auth']['password'],
-    )
-
-    return session
-
 def create_xqueue_header_and_body(submission):
     xqueue_header = {
         'submission_id': submission.xqueue_submission_id,
@@ -276,36 +288,54 @@ def sanitize_html(text):
         clean_html = text
     return clean_html
 
-def upload_to_s3(file_path, path, name):
+def _storage_tags(operation):
+    def tags(*args, **kwargs):
+        return ["operation:{0}".format(operation), "backend:{0}".format(settings.STORAGE_BACKEND)]
+    return tags
+
+
+@concurrency.limited("s3")
+@metrics.timed("s3.request_time", _storage_tags("upload"))
+def upload_to_s3(data, path, name):
     '''
-    Upload file to S3 using provided keyname.
+    Store data, the file contents, under the provided keyname with the
+    STORAGE_BACKEND: S3, the local filesystem, or locally then S3 in the
+    background.
 
     Returns:
         public_url: URL to access uploaded file
     '''
     try:
-        conn = S3Connection(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY)
-        bucketname = settings.S3_BUCKETNAME
-        try:
-            bucket = conn.create_bucket(bucketname.lower())
-        except Exception:
-            bucket = conn.get_bucket(bucketname.lower())
-        prefix = getattr(settings, 'S3_PATH_PREFIX')
-        path = u'{0}/{1}'.format(prefix, path)
-        key = u'{path}/{name}'.format(path=removeNonAscii(path), name=removeNonAscii(name))
-        k = Key(bucket)
-        k.key = key
-        k.set_contents_from_filename(file_path)
-        k.set_acl("public-read")
-        k.set_metadata('filename', removeNonAscii(name))
-        public_url = k.generate_url(60*60*24*365) # URL timeout in seconds.
+        public_url = storage.get_storage().upload(data, s3_key_name(path, name), removeNonAscii(name),
+                                                  settings.S3_URL_EXPIRES_IN)
 
         return True, public_url
     except Exception:
-        error = "Could not connect to S3."
+        error = "Could not store the certificate."
         log.exception(error)
         return False, error
 
+@concurrency.limited("s3")
+@metrics.timed("s3.request_time", _storage_tags("find"))
+def find_in_s3(path, name):
+    '''
+    Look for a file already uploaded by upload_to_s3 with the same path and name.
+
+    Returns:
+        success, public_url: public_url is None if the file does not exist
+    '''
+    try:
+        return True, storage.get_storage().url_if_exists(s3_key_name(path, name), settings.S3_URL_EXPIRES_IN)
+    except Exception:
+        error = "Could not look up the certificate."
+        log.exception(error)
+        return False, error
+
+def s3_key_name(path, name):
+    prefix = getattr(settings, 'S3_PATH_PREFIX')
+    path = u'{0}/{1}'.format(prefix, path)
+    return u'{path}/{name}'.format(path=removeNonAscii(path), name=removeNonAscii(name))
+
 def make_hashkey(seed):
     '''
     Generate a hashkey (string)
@@ -315,9 +345,48 @@ def make_hashkey(seed):
     return h.hexdigest()
 
 
-def waitForResponse(x):
-    out, err = x.communicate()
-    if x.returncode < 0:
+class ProcessTimeout(OSError):
+    pass
+
+
+def kill_process_tree(x):
+    """
+    SIGKILL process x and, when it leads its own process group (started with
+    preexec_fn=os.setsid), every process it started.  The caller reaps x.
+    """
+    try:
+        os.killpg(x.pid, signal.SIGKILL)
+    except OSError:
+        #Not a group leader, or already gone
+        try:
+            x.kill()
+        except OSError:
+            pass
+
+
+def waitForResponse(x, timeout=None):
+    """
+    Wait for process x.  Raises OSError if it exits with a nonzero code and,
+    after killing its process tree, ProcessTimeout if it runs longer than
+    timeout seconds.
+    """
+    timed_out = threading.Event()
+    def kill():
+        timed_out.set()
+        kill_process_tree(x)
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+    try:
+        out, err = x.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if timed_out.is_set():
+      raise ProcessTimeout("Process {0} killed after {1}s".format(x.pid, timeout))
+    if x.returncode != 0:
       r = "Popen returncode: " + str(x.returncode)
       raise OSError(r)
 
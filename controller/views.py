@@ -0,0 +1,85 @@
+from django.conf import settings
+from django.views.decorators.http import require_GET
+import collections
+import logging
+import time
+
+from . import metrics
+from . import util
+
+log = logging.getLogger(__name__)
+
+_INTERFACE_VERSION = 1
+
+
+@require_GET
+def status(request):
+    """
+    Worker health and capacity metrics for monitoring and autoscaling, merged
+    from the snapshots live workers publish to the cache.  Never contacts
+    xqueue or S3.  Answers 503 when no worker published recently.
+    """
+    workers = metrics.worker_snapshots()
+    data = merge_snapshots(workers)
+    if not workers:
+        response = util._error_response("No worker reported in the last {0}s".format(
+            3 * settings.METRICS_PUBLISH_INTERVAL), _INTERFACE_VERSION, data)
+        response.status_code = 503
+        return response
+    return util._success_response(data, _INTERFACE_VERSION)
+
+
+def merge_snapshots(workers):
+    now = time.time()
+    queues = {}
+    depth_times = {}
+    samples = collections.defaultdict(list)
+    counts = collections.Counter()
+    pool = {'size': 0, 'started': 0, 'busy': 0}
+    outbox = {}
+    concurrency = {}
+    for worker in workers:
+        for queue_name, queue in worker['queues'].items():
+            merged = queues.setdefault(queue_name, {'depth': None, 'items': 0, 'items_per_second': collections.Counter()})
+            merged['items'] += queue['items']
+            merged['items_per_second'].update(queue['items_per_second'])
+            #The most recent observation wins
+            if queue['depth'] is not None and queue['depth_time'] > depth_times.get(queue_name, 0):
+                merged['depth'] = queue['depth']
+                depth_times[queue_name] = queue['depth_time']
+        for name, values in worker['samples'].items():
+            samples[name].extend(values)
+        counts.update(worker['counts'])
+        if worker.get('renderer_pool'):
+            for key in pool:
+                pool[key] += worker['renderer_pool'][key]
+        if worker.get('outbox_pending') is not None:
+            #Processes of one node share its outbox
+            outbox[worker['host']] = worker['outbox_pending']
+        for downstream, state in (worker.get('concurrency') or {}).items():
+            merged = concurrency.setdefault(downstream, {'limit': 0, 'in_flight': 0, 'max': 0})
+            for key in merged:
+                merged[key] += state[key]
+
+    for queue_name, queue in queues.items():
+        queue['items_per_second'] = dict(queue['items_per_second'])
+        queue['depth_age_seconds'] = now - depth_times[queue_name] if queue_name in depth_times else None
+    lookups = counts['render_cache_hits'] + counts['render_cache_misses']
+    return {
+        'workers': [{'host': worker['host'], 'pid': worker['pid'], 'age_seconds': now - worker['time']}
+                    for worker in workers],
+        'queues': queues,
+        'items_per_second': dict(("{0}s".format(seconds),
+                                  sum(queue['items_per_second'].get("{0}s".format(seconds), 0) for queue in queues.values()))
+                                 for seconds in metrics.RATE_WINDOWS),
+        'render_latency': metrics.summarize(samples['render_time']),
+        'item_latency': metrics.summarize(samples['latency']),
+        'renderer_pool': dict(pool, utilization=float(pool['busy']) / pool['size'] if pool['size'] else None),
+        'render_cache': {
+            'hits': counts['render_cache_hits'],
+            'misses': counts['render_cache_misses'],
+            'hit_rate': float(counts['render_cache_hits']) / lookups if lookups else None,
+        },
+        'outbox_pending': sum(outbox.values()) if outbox else None,
+        'concurrency': concurrency,
+    }
@@ -0,0 +1,155 @@
+"""
+Process-wide, long lived xqueue session.
+
+Every thread of a worker process talks to xqueue through one logged in
+requests session, so cookies and keep-alive connections are reused across
+pulls instead of logging in on every run.  Its connection pool is sized for
+the threads using it at once.  A request answered with 401/403, or redirected
+to the login page because the xqueue session expired, logs in again and is
+retried once.  A failed login raises LoginError instead of leaving a session
+that fails later on.
+"""
+from django.conf import settings
+import logging
+import os
+import threading
+import time
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from statsd import statsd
+
+import project_urls
+from . import util
+
+log = logging.getLogger(__name__)
+
+#Seconds between connection pool gauges
+POOL_REPORT_INTERVAL = 10
+
+
+class LoginError(Exception):
+    pass
+
+
+class XqueueSession(requests.Session):
+    def __init__(self, url, username, password, pool_size):
+        super(XqueueSession, self).__init__()
+        self.login_url = urlparse.urljoin(url, project_urls.XqueueURLs.log_in)
+        self.username = username
+        self.password = password
+        for prefix in ('http://', 'https://'):
+            self.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.generation = 0
+        self.requests_since_login = 0
+        self._login_lock = threading.Lock()
+
+    def login(self):
+        """
+        Log in to xqueue.  Raises LoginError if xqueue refuses.
+        """
+        start = time.time()
+        try:
+            success, msg = util.login(self, self.login_url, self.username, self.password)
+        except Exception as e:
+            success, msg = False, str(e)
+        statsd.histogram("open_ended_assessment.grading_controller.xqueue_session.login_time", time.time() - start,
+                         tags=["success:{0}".format(success)])
+        if not success:
+            log.error("Could not log in to xqueue at {0}: {1}".format(self.login_url, msg))
+            raise LoginError(msg)
+        if self.generation:
+            statsd.histogram("open_ended_assessment.grading_controller.xqueue_session.requests_per_login",
+                             self.requests_since_login)
+        self.generation += 1
+        self.requests_since_login = 0
+
+    def relogin(self, generation):
+        """
+        Log in again, unless another thread already did since generation
+        """
+        with self._login_lock:
+            if self.generation == generation:
+                self.login()
+
+    def needs_login(self, response):
+        if response.status_code in (401, 403):
+            return "status_{0}".format(response.status_code)
+        login_path = urlparse.urlparse(self.login_url).path.rstrip("/")
+        redirects = list(response.history) + [response]
+        for r in redirects:
+            location = r.headers.get('location') if r.status_code in (301, 302, 303, 307) else r.url
+            if location and urlparse.urlparse(location).path.rstrip("/") == login_path:
+                return "login_redirect"
+        return None
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(self.login_url.rstrip("/")):
+            return super(XqueueSession, self).request(method, url, *args, **kwargs)
+
+        generation = self.generation
+        response = super(XqueueSession, self).request(method, url, *args, **kwargs)
+        reason = self.needs_login(response)
+        if reason is not None:
+            log.info("xqueue session expired ({0}), logging in again".format(reason))
+            statsd.increment("open_ended_assessment.grading_controller.xqueue_session.relogin",
+                             tags=["reason:{0}".format(reason)])
+            self.relogin(generation)
+            response = super(XqueueSession, self).request(method, url, *args, **kwargs)
+        self.requests_since_login += 1
+        return response
+
+    def report_pool(self):
+        """
+        Gauge the connections opened to xqueue and how many of them are idle
+        """
+        opened = idle = 0
+        for adapter in self.adapters.values():
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                opened += pool.num_connections
+                if pool.pool is not None:
+                    idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        statsd.gauge("open_ended_assessment.grading_controller.xqueue_session.connections", opened)
+        statsd.gauge("open_ended_assessment.grading_controller.xqueue_session.idle_connections", idle)
+
+
+_session = None
+_session_pid = None
+_last_report = 0
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Return this process' xqueue session, logged in on first use.  Raises
+    LoginError if xqueue refuses the login.
+    """
+    global _session, _session_pid, _last_report
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = XqueueSession(settings.XQUEUE_INTERFACE['url'],
+                                    settings.XQUEUE_INTERFACE['django_auth']['username'],
+                                    settings.XQUEUE_INTERFACE['django_auth']['password'],
+                                    settings.XQUEUE_SESSION_POOL_SIZE)
+            session.login()
+            _session = session
+            _session_pid = os.getpid()
+        else:
+            statsd.increment("open_ended_assessment.grading_controller.xqueue_session.reused")
+        if time.time() - _last_report > POOL_REPORT_INTERVAL:
+            _last_report = time.time()
+            _session.report_pool()
+        return _session
+
+
+def reset_session():
+    """
+    Drop this process' session, e.g. after the xqueue settings changed
+    """
+    global _session
+    with _session_lock:
+        _session = None